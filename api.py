@@ -0,0 +1,274 @@
+"""
+This module serves the conversation engine over HTTP and WebSocket.
+
+The service wraps ConversationBuilder, Conversation and AsyncLLMAgent. No session state is kept
+in the process: every request loads its conversation from a ConversationStore and saves it back,
+so with the MongoDB store any number of uvicorn workers can serve any session. Agent replies are
+streamed over a WebSocket, or returned whole by the HTTP endpoint. Finished conversations are
+saved with MongoPersistence, like in the Streamlit app. Every call to the API is reserved with the
+RateLimiter first, each conversation standing for a user like a session of the Streamlit app, and
+answered with status 429 once a budget is exhausted.
+
+Usage:
+    OPENAI_KEY=... MONGO_CONNECTION_STRING=mongodb://... uvicorn api:build_app --factory --workers 4
+"""
+
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from pydantic import BaseModel, Field, ValidationError
+
+from classes import (
+    AsyncLLMAgent,
+    Conversation,
+    ConversationBuilder,
+    build_evaluation_messages,
+    build_response_messages,
+)
+from config import API_MODEL, API_TEMPERATURE, RATE_LIMIT_SHARED
+from conversation_store import (
+    ConversationConflict,
+    ConversationStore,
+    get_conversation_store,
+)
+from llm_backends import OpenAIBackend
+from mongodb_manager import MongoPersistence, get_persistence
+from rate_limiter import RateLimiter, estimate_tokens, get_rate_limiter
+
+logger = logging.getLogger(__name__)
+
+
+class NewConversation(BaseModel):
+    topic: str | None = None
+    difficulty: str | None = None
+
+
+class UserMessage(BaseModel):
+    message: str = Field(min_length=1)
+
+
+def conversation_state(conversation: Conversation) -> dict:
+    """
+    Returns what the user may see of a conversation. The hidden context is revealed once the
+    conversation is finished.
+    """
+    state = {
+        "conversation_id": conversation.conversation_id,
+        "user_visible_context": conversation.user_visible_context,
+        "messages": list(conversation.messages),
+        "finished": conversation.finished,
+        "remaining_agent_messages": conversation.get_remaining_agent_messages(),
+        "evaluation": conversation.evaluation,
+    }
+    if conversation.finished:
+        state["context"] = conversation.context
+    return state
+
+
+def used_tokens(conversation: Conversation) -> int:
+    return conversation.prompt_tokens + conversation.completion_tokens
+
+
+def create_app(
+    agent: AsyncLLMAgent,
+    store: ConversationStore,
+    persistence: MongoPersistence | None = None,
+    rate_limiter: RateLimiter | None = None,
+    model: str = API_MODEL,
+    temperature: float = API_TEMPERATURE,
+) -> FastAPI:
+    """
+    Builds the service.
+
+    Args:
+        agent (AsyncLLMAgent): The agent generating replies and evaluations.
+        store (ConversationStore): Where the running conversations are kept.
+        persistence (MongoPersistence | None): Where finished conversations are saved, nowhere
+            if None.
+        rate_limiter (RateLimiter | None): The budgets the calls to the API are reserved from,
+            unlimited if None.
+        model (str): The model of the agent replies and evaluations.
+        temperature (float): The temperature of the agent replies and evaluations.
+
+    Returns:
+        FastAPI: The ASGI application.
+    """
+    app = FastAPI(title="Reflective Listening Practice Chatbot")
+    builder = ConversationBuilder()
+
+    async def load(conversation_id: str) -> tuple[Conversation, int]:
+        loaded = await store.load(conversation_id)
+        if loaded is None:
+            raise HTTPException(404, "No such conversation.")
+        return loaded
+
+    @asynccontextmanager
+    async def reserve(conversation: Conversation, messages: list[dict]):
+        """
+        Reserves a call sending `messages` for the conversation, then replaces the estimate by
+        the usage the API reported, none if the call failed or the response cache answered.
+        """
+        if rate_limiter is None:
+            yield
+            return
+        # The limiter waits for its buckets to refill and may query MongoDB
+        estimated_tokens = estimate_tokens(messages)
+        if not await asyncio.to_thread(
+            rate_limiter.acquire, conversation.conversation_id, estimated_tokens
+        ):
+            raise HTTPException(429, "The daily budget is exhausted.")
+        tokens_before = used_tokens(conversation)
+        try:
+            yield
+        finally:
+            await asyncio.to_thread(
+                rate_limiter.record_tokens,
+                conversation.conversation_id,
+                used_tokens(conversation) - tokens_before - estimated_tokens,
+            )
+
+    async def start_turn(conversation_id: str, message: str):
+        conversation, version = await load(conversation_id)
+        if conversation.finished:
+            raise HTTPException(409, "The conversation is finished.")
+        conversation.add_message(message)
+        return conversation, version
+
+    async def finish_turn(conversation: Conversation, version: int, reply: str):
+        conversation.add_message(reply)
+        try:
+            await store.save(conversation, version)
+        except ConversationConflict as error:
+            raise HTTPException(
+                409, "The conversation was changed by another request."
+            ) from error
+        if conversation.finished and persistence is not None:
+            persistence.save_conversation(conversation)
+
+    @app.post("/conversations", status_code=201)
+    async def create_conversation(request: NewConversation | None = None):
+        request = request or NewConversation()
+        try:
+            conversation = builder.build(request.topic, request.difficulty)
+        except LookupError as error:
+            raise HTTPException(404, str(error)) from error
+        await store.save(conversation, 0)
+        return conversation_state(conversation)
+
+    @app.get("/conversations/{conversation_id}")
+    async def get_conversation(conversation_id: str):
+        conversation, _ = await load(conversation_id)
+        return conversation_state(conversation)
+
+    @app.post("/conversations/{conversation_id}/messages")
+    async def send_message(conversation_id: str, request: UserMessage):
+        conversation, version = await start_turn(conversation_id, request.message)
+        async with reserve(conversation, build_response_messages(conversation)):
+            reply = await agent.generate_response(conversation, model, temperature)
+        await finish_turn(conversation, version, reply)
+        return {"agent_message": reply, **conversation_state(conversation)}
+
+    @app.post("/conversations/{conversation_id}/evaluation")
+    async def evaluate(conversation_id: str):
+        conversation, version = await load(conversation_id)
+        if not conversation.finished:
+            raise HTTPException(409, "The conversation is not finished yet.")
+        if conversation.evaluation is None:
+            async with reserve(conversation, build_evaluation_messages(conversation)):
+                conversation.evaluation = await agent.evaluate_conversation(
+                    conversation, model, temperature
+                )
+            try:
+                await store.save(conversation, version)
+            except ConversationConflict:
+                pass  # Evaluated by a concurrent request as well
+            if persistence is not None:
+                persistence.update_conversation(
+                    conversation.conversation_id,
+                    {"evaluation": conversation.evaluation},
+                )
+        return conversation_state(conversation)
+
+    @app.websocket("/conversations/{conversation_id}/stream")
+    async def stream(websocket: WebSocket, conversation_id: str):
+        """
+        Receives {"message": ...} objects and answers each with {"type": "delta", "text": ...}
+        objects as the reply is generated, then {"type": "done", "conversation": ...}. Failed
+        turns are answered with {"type": "error", "status": ..., "detail": ...}.
+        """
+        await websocket.accept()
+        try:
+            while True:
+                data = await websocket.receive_json()
+                try:
+                    message = UserMessage.model_validate(data).message
+                except ValidationError as error:
+                    await websocket.send_json(
+                        {
+                            "type": "error",
+                            "status": 422,
+                            "detail": error.errors(include_context=False),
+                        }
+                    )
+                    continue
+                try:
+                    conversation, version = await start_turn(conversation_id, message)
+                    pieces = []
+                    async with reserve(
+                        conversation, build_response_messages(conversation)
+                    ):
+                        async for text in agent.stream_response(
+                            conversation, model, temperature
+                        ):
+                            pieces.append(text)
+                            await websocket.send_json({"type": "delta", "text": text})
+                    await finish_turn(conversation, version, "".join(pieces))
+                except HTTPException as error:
+                    await websocket.send_json(
+                        {
+                            "type": "error",
+                            "status": error.status_code,
+                            "detail": error.detail,
+                        }
+                    )
+                    continue
+                except Exception:  # pylint: disable=broad-except
+                    # The turn is not saved, so the user can send the message again
+                    logger.exception("Failed to reply in %s.", conversation_id)
+                    await websocket.send_json(
+                        {
+                            "type": "error",
+                            "status": 502,
+                            "detail": "The agent failed to reply.",
+                        }
+                    )
+                    continue
+                await websocket.send_json(
+                    {"type": "done", "conversation": conversation_state(conversation)}
+                )
+        except WebSocketDisconnect:
+            pass
+
+    return app
+
+
+def build_app() -> FastAPI:
+    """
+    Builds the production service from the OPENAI_KEY and MONGO_CONNECTION_STRING environment
+    variables, see the usage above. Nothing is set up when the module is merely imported.
+    """
+    mongo_uri = os.getenv("MONGO_CONNECTION_STRING")
+    if mongo_uri is None:
+        logger.warning(
+            "MONGO_CONNECTION_STRING is not set, so every worker keeps its own conversations "
+            "in memory. Run a single worker, or sessions are not found on the other workers."
+        )
+    return create_app(
+        AsyncLLMAgent(OpenAIBackend(api_key=os.getenv("OPENAI_KEY"))),
+        get_conversation_store(mongo_uri),
+        get_persistence(mongo_uri) if mongo_uri else None,
+        get_rate_limiter(mongo_uri if RATE_LIMIT_SHARED else None),
+    )
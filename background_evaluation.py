@@ -0,0 +1,288 @@
+"""
+This module evaluates conversations in the background while the app keeps rendering.
+
+A BackgroundEvaluator watches a conversation. As soon as Conversation.add_message marks it as
+finished, the conversation is queued to be saved and its evaluation is submitted to a thread
+pool, so the evaluation runs in parallel with the persistence and with the rendering of the
+agent's last reply. The evaluation is written to MongoDB as an update of the saved document, and
+set on the conversation once the app asks for it. In incremental mode every user turn is scored
+with a cheaper model as soon as it arrives, so the final evaluation only has to summarize the
+notes.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Callable
+
+from classes import (
+    Conversation,
+    LLMAgent,
+    build_evaluation_messages,
+    build_turn_evaluation_messages,
+)
+from config import (
+    BACKGROUND_EVALUATION_MAX_PENDING,
+    BACKGROUND_EVALUATION_TTL_SECONDS,
+    BACKGROUND_EVALUATION_WORKERS,
+    EVALUATION_MODEL,
+    EVALUATION_TEMPERATURE,
+    INCREMENTAL_EVALUATION,
+    INCREMENTAL_EVALUATION_MODEL,
+    RESPONSE_CACHE_ENABLED,
+    RESPONSE_CACHE_NEAR_DUPLICATES,
+)
+from mongodb_manager import MongoPersistence, get_persistence
+from response_cache import get_response_cache
+
+logger = logging.getLogger(__name__)
+
+# Called with the chat messages of a request before it is sent, the request is skipped unless
+# it returns True, e.g. to apply the rate limits
+Admit = Callable[[list[dict]], bool]
+
+
+@dataclass
+class _ScoredTurn:
+    index: int
+    note: str
+    prompt_tokens: int
+    completion_tokens: int
+
+
+@dataclass
+class _Evaluation:
+    evaluation: str | None
+    turn_evaluations: list[list]
+    # Spent in the background since the conversation finished
+    prompt_tokens: int
+    completion_tokens: int
+
+
+class BackgroundEvaluator:
+    """
+    This class evaluates the conversations it watches once they are finished.
+
+    The workers only ever see snapshots of the conversations, so they never race with the
+    thread adding messages. Their notes, evaluations and token usage are merged back into the
+    conversation on the thread that owns it: the scored turns whenever a message is added, the
+    evaluation by result(). Results that are never merged, e.g. of abandoned conversations, are
+    dropped beyond `max_pending` conversations and after `ttl` seconds.
+
+    Args:
+        agent (LLMAgent): The agent evaluating the conversations.
+        persistence (MongoPersistence | None): Where finished conversations are saved and their
+            evaluations updated, nowhere if None.
+        model (str): The model of the final evaluation.
+        temperature (float): The temperature of the final evaluation.
+        incremental (bool): Whether to score every user turn as it arrives.
+        turn_model (str): The model scoring the user turns.
+        max_workers (int): The number of evaluations running at once.
+        max_pending (int): The number of conversations whose results are kept until merged.
+        ttl (float): The seconds results are kept until merged.
+    """
+
+    def __init__(
+        self,
+        agent: LLMAgent,
+        persistence: MongoPersistence | None = None,
+        model: str = EVALUATION_MODEL,
+        temperature: float = EVALUATION_TEMPERATURE,
+        incremental: bool = INCREMENTAL_EVALUATION,
+        turn_model: str = INCREMENTAL_EVALUATION_MODEL,
+        max_workers: int = BACKGROUND_EVALUATION_WORKERS,
+        max_pending: int = BACKGROUND_EVALUATION_MAX_PENDING,
+        ttl: float = BACKGROUND_EVALUATION_TTL_SECONDS,
+    ):
+        self.agent = agent
+        self.persistence = persistence
+        self.model = model
+        self.temperature = temperature
+        self.incremental = incremental
+        self.turn_model = turn_model
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix="evaluation"
+        )
+        # conversation_id -> (futures of the unmerged turns or of the evaluation, time added)
+        self._turns: OrderedDict[str, tuple[list[Future], float]] = OrderedDict()
+        self._evaluations: OrderedDict[str, tuple[Future, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def watch(self, conversation: Conversation, admit: Admit | None = None):
+        """
+        Starts evaluating the conversation in the background as soon as it is finished.
+        """
+
+        def on_message(conversation: Conversation):
+            self._merge_turns(conversation)
+            if conversation.finished:
+                conversation.listener = None
+                self._finish(conversation, admit)
+            elif self.incremental and len(conversation.messages) % 2 == 0:
+                # The last message is the user's
+                self._score_turn(conversation, len(conversation.messages) - 1, admit)
+
+        conversation.listener = on_message
+
+    def _add(self, pending: OrderedDict, conversation_id: str, value):
+        now = time.monotonic()
+        with self._lock:
+            pending[conversation_id] = (value, now)
+            pending.move_to_end(conversation_id)
+            while pending and (
+                len(pending) > self.max_pending
+                or now - next(iter(pending.values()))[1] > self.ttl
+            ):
+                pending.popitem(last=False)
+
+    def _score_turn(self, conversation: Conversation, index: int, admit: Admit | None):
+        if admit is not None and not admit(
+            build_turn_evaluation_messages(conversation, index)
+        ):
+            return
+        future = self._executor.submit(
+            self._evaluate_turn, conversation.to_bytes(), index
+        )
+        with self._lock:
+            turns = self._turns.get(conversation.conversation_id, ([], 0.0))[0]
+        self._add(self._turns, conversation.conversation_id, turns + [future])
+
+    def _evaluate_turn(self, snapshot: bytes, index: int) -> _ScoredTurn:
+        conversation = Conversation.from_bytes(snapshot)
+        # Only the usage of this request is merged back
+        conversation.prompt_tokens = conversation.completion_tokens = 0
+        note = self.agent.evaluate_turn(conversation, index, self.turn_model)
+        return _ScoredTurn(
+            index, note, conversation.prompt_tokens, conversation.completion_tokens
+        )
+
+    def _merge_turns(self, conversation: Conversation):
+        """
+        Adds the turns scored so far to the conversation, on the thread that owns it.
+        """
+        with self._lock:
+            entry = self._turns.get(conversation.conversation_id)
+            if entry is None:
+                return
+            done = [future for future in entry[0] if future.done()]
+            pending = [future for future in entry[0] if not future.done()]
+            if pending:
+                self._turns[conversation.conversation_id] = (pending, entry[1])
+            else:
+                del self._turns[conversation.conversation_id]
+        for future in done:
+            if future.exception() is not None:
+                logger.warning("Failed to score a turn: %s", future.exception())
+                continue
+            _add_turn(conversation, future.result())
+
+    def _finish(self, conversation: Conversation, admit: Admit | None):
+        if self.persistence is not None:
+            self.persistence.save_conversation(conversation)
+        with self._lock:
+            turns = self._turns.pop(conversation.conversation_id, ([], 0.0))[0]
+        # Turns were submitted first, so no worker waits for a turn queued behind it
+        future = self._executor.submit(
+            self._evaluate, conversation.to_bytes(), turns, admit
+        )
+        self._add(self._evaluations, conversation.conversation_id, future)
+
+    def _evaluate(
+        self, snapshot: bytes, turns: list[Future], admit: Admit | None
+    ) -> _Evaluation:
+        conversation = Conversation.from_bytes(snapshot)
+        prompt_tokens, completion_tokens = (
+            conversation.prompt_tokens,
+            conversation.completion_tokens,
+        )
+        wait(turns)
+        for future in turns:
+            if future.exception() is not None:
+                logger.warning("Failed to score a turn: %s", future.exception())
+            else:
+                _add_turn(conversation, future.result())
+        if admit is None or admit(build_evaluation_messages(conversation)):
+            conversation.evaluation = self.agent.evaluate_conversation(
+                conversation, self.model, self.temperature
+            )
+            if self.persistence is not None:
+                self.persistence.update_conversation(
+                    conversation.conversation_id,
+                    {
+                        "evaluation": conversation.evaluation,
+                        "turn_evaluations": conversation.turn_evaluations,
+                        "prompt_tokens": conversation.prompt_tokens,
+                        "completion_tokens": conversation.completion_tokens,
+                    },
+                )
+        return _Evaluation(
+            conversation.evaluation,
+            conversation.turn_evaluations,
+            conversation.prompt_tokens - prompt_tokens,
+            conversation.completion_tokens - completion_tokens,
+        )
+
+    def result(
+        self, conversation: Conversation, timeout: float | None = None
+    ) -> str | None:
+        """
+        Waits for the evaluation of a finished conversation, merges it into the conversation and
+        forgets it.
+
+        Returns:
+            str | None: The evaluation, or None if it was not admitted. Errors of the evaluation
+            are raised.
+
+        Raises:
+            KeyError: If the evaluation of the conversation was never started, or was dropped
+                before it was merged.
+            TimeoutError: If it is not done within the timeout, it can then be waited for again.
+        """
+        with self._lock:
+            future = self._evaluations[conversation.conversation_id][0]
+        try:
+            evaluation = future.result(timeout)
+        finally:
+            if future.done():
+                with self._lock:
+                    self._evaluations.pop(conversation.conversation_id, None)
+        conversation.evaluation = evaluation.evaluation
+        conversation.turn_evaluations = evaluation.turn_evaluations
+        conversation.record_usage(
+            evaluation.prompt_tokens, evaluation.completion_tokens
+        )
+        return evaluation.evaluation
+
+    def shutdown(self):
+        """
+        Waits for the running evaluations and stops the workers.
+        """
+        self._executor.shutdown(wait=True)
+
+
+def _add_turn(conversation: Conversation, turn: _ScoredTurn):
+    conversation.turn_evaluations.append([turn.index, turn.note])
+    conversation.record_usage(turn.prompt_tokens, turn.completion_tokens)
+
+
+@lru_cache(maxsize=None)
+def get_background_evaluator(mongo_uri: str | None = None) -> BackgroundEvaluator:
+    """
+    Returns the process-wide BackgroundEvaluator, saving to the given MongoDB if any.
+    """
+    agent = LLMAgent(
+        cache=(
+            get_response_cache(RESPONSE_CACHE_NEAR_DUPLICATES)
+            if RESPONSE_CACHE_ENABLED
+            else None
+        )
+    )
+    return BackgroundEvaluator(
+        agent, get_persistence(mongo_uri) if mongo_uri is not None else None
+    )
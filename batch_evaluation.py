@@ -0,0 +1,192 @@
+"""
+This module re-evaluates the conversations stored by MongoPersistence.
+
+Conversations are streamed from the collection with a cursor in _id order and evaluated in
+chunks with bounded concurrency. The evaluations of a chunk are written back with one bulk
+update under evaluations.<run name>, after which the last processed _id is checkpointed, so an
+interrupted run resumes where it stopped.
+
+Usage:
+    python batch_evaluation.py MONGO_URI --run-name gpt4-2024-06 [--model gpt-4-turbo]
+"""
+
+import argparse
+import asyncio
+import itertools
+import os
+import re
+import time
+from datetime import datetime
+
+from bson import json_util
+from pymongo import UpdateOne
+
+from classes import AsyncLLMAgent, Conversation
+from config import (
+    BATCH_EVALUATION_CHECKPOINT,
+    BATCH_EVALUATION_CHUNK_SIZE,
+    LLM_MAX_CONCURRENCY,
+)
+from llm_backends import OpenAIBackend
+from mongodb_manager import get_persistence
+
+# Run names become part of a field path, so dots and a leading $ are not allowed
+RUN_NAME = re.compile(r"[A-Za-z0-9_-]+")
+
+
+def run_name(value: str) -> str:
+    """
+    Validates the --run-name argument.
+    """
+    if not RUN_NAME.fullmatch(value):
+        raise argparse.ArgumentTypeError(
+            f"{value!r} may only contain letters, digits, '_' and '-'."
+        )
+    return value
+
+
+def load_checkpoint(path: str) -> dict:
+    """
+    Loads the progress of a previous run, or an empty progress if there is none.
+    """
+    if not os.path.exists(path):
+        return {"last_id": None, "evaluated": 0, "failed": 0}
+    with open(path, encoding="utf-8") as file:
+        return json_util.loads(file.read())
+
+
+def save_checkpoint(path: str, checkpoint: dict):
+    """
+    Atomically replaces the checkpoint file.
+    """
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as file:
+        file.write(json_util.dumps(checkpoint))
+    os.replace(temporary_path, path)
+
+
+def iter_conversations(collection, run_name: str, last_id=None, chunk_size=100):
+    """
+    Streams the stored conversations that have not been evaluated by the run yet.
+
+    Yields:
+        list[dict]: Chunks of documents with their _id and conversation, in _id order.
+    """
+    query = {
+        "conversation.finished": True,
+        f"evaluations.{run_name}": {"$exists": False},
+    }
+    if last_id is not None:
+        query["_id"] = {"$gt": last_id}
+    cursor = collection.find(
+        query, projection={"conversation": 1}, sort=[("_id", 1)]
+    ).batch_size(chunk_size)
+    while chunk := list(itertools.islice(cursor, chunk_size)):
+        yield chunk
+
+
+async def evaluate_chunk(
+    agent: AsyncLLMAgent, documents: list[dict], model: str, temperature: float
+) -> list:
+    """
+    Evaluates a chunk of stored conversations concurrently.
+
+    Returns:
+        list: The evaluation, or the raised exception, of every document.
+    """
+    return await asyncio.gather(
+        *(
+            agent.evaluate_conversation(
+                Conversation.from_dict(document["conversation"]), model, temperature
+            )
+            for document in documents
+        ),
+        return_exceptions=True,
+    )
+
+
+async def run(args):
+    collection = get_persistence(args.mongo_uri).conversations
+    checkpoint_path = (
+        args.checkpoint or f"{args.run_name}.{BATCH_EVALUATION_CHECKPOINT}"
+    )
+    checkpoint = load_checkpoint(checkpoint_path)
+    if args.from_start:
+        checkpoint = {"last_id": None, "evaluated": 0, "failed": 0}
+    started = time.monotonic()
+    processed = 0
+    backend = OpenAIBackend(api_key=os.getenv("OPENAI_KEY"))
+    async with AsyncLLMAgent(backend, max_concurrency=args.concurrency) as agent:
+        for documents in iter_conversations(
+            collection, args.run_name, checkpoint["last_id"], args.chunk_size
+        ):
+            results = await evaluate_chunk(
+                agent, documents, args.model, args.temperature
+            )
+            evaluated_at = datetime.now()
+            updates = [
+                UpdateOne(
+                    {"_id": document["_id"]},
+                    {
+                        "$set": {
+                            f"evaluations.{args.run_name}": {
+                                "evaluation": result,
+                                "model": args.model,
+                                "temperature": args.temperature,
+                                "evaluated_at": evaluated_at,
+                            }
+                        }
+                    },
+                )
+                for document, result in zip(documents, results)
+                if not isinstance(result, Exception)
+            ]
+            if updates:
+                collection.bulk_write(updates, ordered=False)
+            checkpoint["last_id"] = documents[-1]["_id"]
+            checkpoint["evaluated"] += len(updates)
+            checkpoint["failed"] += len(documents) - len(updates)
+            save_checkpoint(checkpoint_path, checkpoint)
+
+            processed += len(documents)
+            rate = processed / (time.monotonic() - started)
+            print(
+                f"{checkpoint['evaluated']} evaluated, {checkpoint['failed']} failed "
+                f"({rate:.1f} conversations/s)"
+            )
+            if args.limit is not None and processed >= args.limit:
+                break
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("mongo_uri", help="MongoDB connection string.")
+    parser.add_argument(
+        "--run-name",
+        type=run_name,
+        required=True,
+        help="Name of the evaluation run, used as the key under 'evaluations'.",
+    )
+    parser.add_argument("--model", default="gpt-4-turbo")
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--concurrency", type=int, default=LLM_MAX_CONCURRENCY)
+    parser.add_argument("--chunk-size", type=int, default=BATCH_EVALUATION_CHUNK_SIZE)
+    parser.add_argument(
+        "--checkpoint",
+        help="Checkpoint file, defaults to <run name>." + BATCH_EVALUATION_CHECKPOINT,
+    )
+    parser.add_argument(
+        "--from-start",
+        action="store_true",
+        help="Ignore the checkpoint, e.g. to retry conversations that failed.",
+    )
+    parser.add_argument(
+        "--limit", type=int, help="Stop after roughly this many conversations."
+    )
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""
+This module holds micro-benchmarks for the hot paths of the app.
+
+Usage:
+    python benchmarks.py prompt [--max-messages 10 20 40 80 160] [--repeat 200]
+    python benchmarks.py importtime [--files classes.py streamlit_app.py] [--repeat 5] [--top 10]
+    python benchmarks.py memory [--sessions 10000] [--max-messages 20]
+    python benchmarks.py starters [--sizes 14 1000 10000] [--builds 20000]
+"""
+
+import argparse
+import ast
+import os
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from classes import Conversation, ConversationBuilder, build_response_messages
+from conversation_starters import Starter, StarterCatalog
+
+
+def bench_prompt_building(max_messages_values: list[int], repeat: int) -> list[dict]:
+    """
+    Measures the cost of building the prompt for every agent turn of a full conversation.
+
+    Args:
+        max_messages_values (list[int]): The conversation lengths to measure.
+        repeat (int): How many conversations to simulate per length.
+
+    Returns:
+        list[dict]: One row per length with the mean cost of the first and the last turn
+        and of a turn on average, in microseconds.
+    """
+    builder = ConversationBuilder()
+    rows = []
+    for max_messages in max_messages_values:
+        turn_costs: list[list[float]] = []
+        for _ in range(repeat):
+            conversation = builder.build()
+            conversation.max_messages = max_messages
+            costs = []
+            while not conversation.finished:
+                conversation.add_message("That sounds like it was a lot to deal with.")
+                start = time.perf_counter()
+                build_response_messages(conversation)
+                costs.append(time.perf_counter() - start)
+                conversation.add_message("Yeah, I guess it was.")
+            turn_costs.append(costs)
+        num_turns = len(turn_costs[0])
+        rows.append(
+            {
+                "max_messages": max_messages,
+                "first_turn_us": 1e6 * sum(c[0] for c in turn_costs) / repeat,
+                "last_turn_us": 1e6 * sum(c[-1] for c in turn_costs) / repeat,
+                "mean_turn_us": 1e6
+                * sum(sum(c) for c in turn_costs)
+                / (repeat * num_turns),
+            }
+        )
+    return rows
+
+
+def _played_conversations(sessions: int, max_messages: int) -> list[Conversation]:
+    builder = ConversationBuilder()
+    conversations = []
+    for session in range(sessions):
+        conversation = builder.build()
+        conversation.max_messages = max_messages
+        while not conversation.finished:
+            conversation.add_message(
+                f"Session {session}: so that caught you off guard?"
+            )
+            conversation.add_message(f"Session {session}: yeah, it really did.")
+        conversations.append(conversation)
+    return conversations
+
+
+def _traced_bytes(build) -> tuple[object, int]:
+    tracemalloc.start()
+    try:
+        value = build()
+        return value, tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+
+def _mean_us(function, values) -> float:
+    start = time.perf_counter()
+    for value in values:
+        function(value)
+    return 1e6 * (time.perf_counter() - start) / len(values)
+
+
+def bench_session_memory(sessions: int, max_messages: int) -> dict:
+    """
+    Measures the memory held by the conversations of many live sessions and the cost of
+    serializing them.
+
+    Args:
+        sessions (int): How many finished conversations to hold.
+        max_messages (int): The length of every conversation.
+
+    Returns:
+        dict: The memory per 10k sessions in MB held as Conversation objects, as to_dict
+        dictionaries and as to_bytes snapshots, and the mean serialization costs in microseconds.
+    """
+    conversations, live_bytes = _traced_bytes(
+        lambda: _played_conversations(sessions, max_messages)
+    )
+    dicts, dict_bytes = _traced_bytes(
+        lambda: [conversation.to_dict() for conversation in conversations]
+    )
+    snapshots, snapshot_bytes = _traced_bytes(
+        lambda: [conversation.to_bytes() for conversation in conversations]
+    )
+    per_10k_mb = 10_000 / sessions / 2**20
+    return {
+        "live_mb_per_10k": live_bytes * per_10k_mb,
+        "dict_mb_per_10k": dict_bytes * per_10k_mb,
+        "snapshot_mb_per_10k": snapshot_bytes * per_10k_mb,
+        "to_dict_us": _mean_us(Conversation.to_dict, conversations),
+        "from_dict_us": _mean_us(Conversation.from_dict, dicts),
+        "to_bytes_us": _mean_us(Conversation.to_bytes, conversations),
+        "from_bytes_us": _mean_us(Conversation.from_bytes, snapshots),
+    }
+
+
+def bench_starter_catalog(sizes: list[int], builds: int) -> list[dict]:
+    """
+    Measures loading synthetic starter catalogs and building conversations from them.
+
+    Args:
+        sizes (list[int]): The numbers of starters to measure.
+        builds (int): How many conversations to build per size, half of them for one topic.
+
+    Returns:
+        list[dict]: One row per size with the load time in milliseconds and the mean cost of
+        building a conversation in microseconds.
+    """
+    rows = []
+    for size in sizes:
+        start = time.perf_counter()
+        catalog = StarterCatalog(
+            [
+                Starter(
+                    id=f"synthetic-{index}",
+                    topic=f"topic-{index % 50}",
+                    difficulty=("easy", "medium", "hard")[index % 3],
+                    initial_message=f"Guess what happened to me today ({index})?",
+                    user_visible_context="A friend messages you.",
+                    context=f"The agent had a rough day number {index} and wants to talk.",
+                )
+                for index in range(size)
+            ]
+        )
+        load_ms = 1000 * (time.perf_counter() - start)
+        builder = ConversationBuilder(catalog)
+        any_us = _mean_us(lambda _: builder.build(), range(builds // 2))
+        topic_us = _mean_us(
+            lambda _: builder.build(topic="topic-0"), range(builds // 2)
+        )
+        rows.append(
+            {"size": size, "load_ms": load_ms, "build_us": any_us, "topic_us": topic_us}
+        )
+    return rows
+
+
+def _import_statements(path: str) -> str:
+    """
+    Returns the top-level import statements of a file. streamlit_app.py cannot be imported
+    outside of `streamlit run`, so the cold start of a file is measured as the cost of its imports.
+    """
+    with open(path, encoding="utf-8") as file:
+        source = file.read()
+    return "\n".join(
+        ast.get_source_segment(source, node)
+        for node in ast.parse(source).body
+        if isinstance(node, (ast.Import, ast.ImportFrom))
+    )
+
+
+def _parse_importtime(stderr: str) -> dict[str, int]:
+    """
+    Returns the cumulative import time in microseconds of every module imported at top level.
+    """
+    cumulative = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:") :].split("|")
+        # Nested imports are indented below the module that triggered them
+        if not name[1:].startswith(" "):
+            cumulative[name.strip()] = int(cumulative_us)
+    return cumulative
+
+
+def bench_import_time(paths: list[str], repeat: int, top: int) -> list[dict]:
+    """
+    Measures the cold import time of files with `python -X importtime` in fresh interpreters.
+
+    Args:
+        paths (list[str]): The files to measure.
+        repeat (int): How many interpreters to start per file; the median is reported.
+        top (int): How many of the slowest top-level imports to list per file.
+
+    Returns:
+        list[dict]: One row per file with the median total import time and the slowest
+        imports, in milliseconds.
+    """
+    rows = []
+    for path in paths:
+        code = _import_statements(path)
+        runs = []
+        for _ in range(repeat):
+            completed = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", code],
+                capture_output=True,
+                text=True,
+                check=True,
+                cwd=os.path.dirname(os.path.abspath(path)),
+            )
+            runs.append(_parse_importtime(completed.stderr))
+        modules = set().union(*runs)
+        median_ms = {
+            module: statistics.median(run.get(module, 0) for run in runs) / 1000
+            for module in modules
+        }
+        rows.append(
+            {
+                "file": path,
+                "total_ms": statistics.median(sum(run.values()) for run in runs) / 1000,
+                "slowest": sorted(median_ms.items(), key=lambda item: -item[1])[:top],
+            }
+        )
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    prompt_parser = subparsers.add_parser(
+        "prompt", help="Per-turn prompt building cost as MAX_MESSAGES grows."
+    )
+    prompt_parser.add_argument(
+        "--max-messages", type=int, nargs="+", default=[10, 20, 40, 80, 160]
+    )
+    prompt_parser.add_argument("--repeat", type=int, default=200)
+
+    importtime_parser = subparsers.add_parser(
+        "importtime", help="Cold import time of the app's entry points."
+    )
+    importtime_parser.add_argument(
+        "--files", nargs="+", default=["classes.py", "streamlit_app.py"]
+    )
+    importtime_parser.add_argument("--repeat", type=int, default=5)
+    importtime_parser.add_argument("--top", type=int, default=10)
+
+    memory_parser = subparsers.add_parser(
+        "memory", help="Memory and serialization cost of live sessions."
+    )
+    memory_parser.add_argument("--sessions", type=int, default=10_000)
+    memory_parser.add_argument("--max-messages", type=int, default=20)
+
+    starters_parser = subparsers.add_parser(
+        "starters", help="Starter catalog load and conversation build cost by size."
+    )
+    starters_parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[14, 1000, 10000]
+    )
+    starters_parser.add_argument("--builds", type=int, default=20000)
+
+    args = parser.parse_args()
+    if args.benchmark == "prompt":
+        print(f"{'max_messages':>12} {'first_us':>10} {'last_us':>10} {'mean_us':>10}")
+        for row in bench_prompt_building(args.max_messages, args.repeat):
+            print(
+                f"{row['max_messages']:>12} {row['first_turn_us']:>10.2f} "
+                f"{row['last_turn_us']:>10.2f} {row['mean_turn_us']:>10.2f}"
+            )
+    elif args.benchmark == "importtime":
+        for row in bench_import_time(args.files, args.repeat, args.top):
+            print(f"{row['file']}: {row['total_ms']:.1f} ms")
+            for module, milliseconds in row["slowest"]:
+                print(f"    {module:<40} {milliseconds:>8.1f} ms")
+    elif args.benchmark == "memory":
+        for name, value in bench_session_memory(
+            args.sessions, args.max_messages
+        ).items():
+            print(f"{name:>20}: {value:.2f}")
+    elif args.benchmark == "starters":
+        print(f"{'size':>8} {'load_ms':>10} {'build_us':>10} {'topic_us':>10}")
+        for row in bench_starter_catalog(args.sizes, args.builds):
+            print(
+                f"{row['size']:>8} {row['load_ms']:>10.1f} "
+                f"{row['build_us']:>10.2f} {row['topic_us']:>10.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,16 +2,65 @@
 This module serves to develop a prototype demonstrating how a chatbot can provide reasonable responses via a text interface.
 """
 
+import asyncio
 import json
 import os
 import random
+import re
+import struct
+import sys
+import time
+import uuid
+from array import array
+from collections.abc import Sequence
 from enum import Enum
-from typing import List
+from functools import lru_cache
+from typing import AsyncIterator, Callable, Iterator, List
 
-import openai
+from config import (
+    DEFAULT_INSTRUCTIONS_VERSION,
+    INSTRUCTIONS_VERSIONS,
+    LLM_BACKOFF_BASE_SECONDS,
+    LLM_BACKOFF_MAX_SECONDS,
+    LLM_MAX_CONCURRENCY,
+    LLM_MAX_RETRIES,
+    MAX_MESSAGES,
+    RESPONSE_REPAIR_ATTEMPTS,
+    RESPONSE_REPAIR_MAX_CHARACTERS,
+    RESPONSE_REPAIR_MAX_TOKENS,
+    RESPONSE_REPAIR_MODEL,
+)
+from conversation_starters import Starter, StarterCatalog, get_starter_catalog
+from instrumentation import metrics, span
+from llm_backends import Completion, LLMBackend, OpenAIBackend
+from prompt_budget import PromptBudgetManager
+from prompts import render_next_message_prompt, render_prompt_sections
+from response_cache import ResponseCache
+from response_parsing import (
+    AgentResponseStreamParser,
+    build_repair_messages,
+    parse_agent_response,
+    response_format_for,
+)
 
-from config import INSTRUCTIONS, MAX_MESSAGES, next_message_prompt
-from conversation_starters import STARTERS
+SYSTEM_MESSAGE = (
+    "You are a chatbot designed to help the user practice reflective listening skills."
+)
+
+
+@lru_cache(maxsize=None)
+def retryable_errors() -> tuple[type[Exception], ...]:
+    """
+    Returns the errors worth retrying: the request either never reached the API or the API asked
+    us to back off. openai is only imported once they are needed.
+    """
+    import openai
+
+    return (
+        openai.APIConnectionError,
+        openai.RateLimitError,
+        openai.InternalServerError,
+    )
 
 
 class Speaker(str, Enum):
@@ -23,29 +72,211 @@ class Speaker(str, Enum):
     CHATBOT = "CHATBOT"
 
 
+# Binary snapshot layout: magic, version, fixed-size fields, then length-prefixed UTF-8 strings
+SNAPSHOT_MAGIC = b"CONV"
+SNAPSHOT_VERSION = 3
+_SNAPSHOT_HEADER = struct.Struct("<4sBIIBBQQqII")
+_SNAPSHOT_LENGTH = struct.Struct("<I")
+_NONE_LENGTH = 0xFFFFFFFF
+
+
+class ConversationMessages(Sequence):
+    """
+    This class is a read-only view of the messages of a conversation, which are stored in its
+    transcript buffer.
+    """
+
+    __slots__ = ("_conversation",)
+
+    def __init__(self, conversation: "Conversation"):
+        self._conversation = conversation
+
+    def __len__(self):
+        return len(self._conversation._line_starts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self._conversation._message_at(index)
+
+    def __eq__(self, other):
+        return isinstance(other, Sequence) and list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
 class Conversation:
     """
     This class holds all components of a single conversation.
+
+    Messages are kept in one append-only buffer, the prompt-formatted transcript, along with the
+    offset at which the line of every message starts. The texts of the conversation starter are
+    not copied but looked up by starter_id, unless the conversation has a custom context.
     """
 
+    __slots__ = (
+        "max_messages",
+        "current_speaker",
+        "finished",
+        "starter_id",
+        "_context",
+        "_user_visible_context",
+        "num_of_messages_sent_by_agent",
+        "evaluation",
+        "prompt_tokens",
+        "completion_tokens",
+        "summary",
+        "summarized_messages",
+        "prompt_tokens_saved",
+        "instructions_version",
+        "experiment",
+        "conversation_id",
+        "turn_evaluations",
+        "listener",
+        "_transcript",
+        "_line_starts",
+    )
+
     def __init__(
         self,
         max_messages: int,
         messages: List[str],
         current_speaker: Speaker,
         finished: bool,
-        context: str,
-        user_visible_context: str,
+        context: str | None,
+        user_visible_context: str | None,
         num_of_messages_sent_by_agent: int,
+        prompt_tokens: int = 0,
+        completion_tokens: int = 0,
+        summary: str = "",
+        summarized_messages: int = 0,
+        prompt_tokens_saved: int = 0,
+        starter_id: str | None = None,
+        instructions_version: str = DEFAULT_INSTRUCTIONS_VERSION,
+        experiment: dict | None = None,
+        conversation_id: str | None = None,
+        turn_evaluations: list | None = None,
     ):
         self.max_messages = max_messages
-        self.messages: list[str] = messages
-        self.current_speaker: Speaker = current_speaker  # Default starting speaker
+        self.current_speaker: Speaker = Speaker(
+            current_speaker
+        )  # Default starting speaker
         self.finished: bool = finished
-        self.context: str = context
-        self.user_visible_context: str = user_visible_context
+        self._set_starter(starter_id, context, user_visible_context)
         self.num_of_messages_sent_by_agent = num_of_messages_sent_by_agent
         self.evaluation = None
+        # Token usage reported by the API for all completions of this conversation
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        # Rolling summary of the first `summarized_messages` messages, see prompt_budget.py
+        self.summary = summary
+        self.summarized_messages = summarized_messages
+        self.prompt_tokens_saved = prompt_tokens_saved
+        # Key of config.INSTRUCTIONS_VERSIONS, and the A/B test arm and results, see experiments.py
+        self.instructions_version = instructions_version
+        self.experiment = experiment
+        # Stable ID under which the conversation is saved, so that it can be updated later
+        self.conversation_id = conversation_id or uuid.uuid4().hex
+        # [message index, note] of the user turns scored so far, see background_evaluation.py
+        self.turn_evaluations = turn_evaluations if turn_evaluations is not None else []
+        # Called with the conversation after every added message, not persisted
+        self.listener = None
+        self.messages = messages
+
+    def _set_starter(
+        self,
+        starter_id: str | None,
+        context: str | None,
+        user_visible_context: str | None,
+    ):
+        # Starters are referenced by ID, so that conversations do not each hold their own copy
+        # of the context texts, e.g. after being loaded from MongoDB
+        catalog = get_starter_catalog()
+        if starter_id is None:
+            starter_id = catalog.id_for_context(context)
+        starter = catalog.get(starter_id)
+        if starter is not None and context in (None, starter.context):
+            self._context = None
+        else:
+            self._context = context
+        if starter is not None and user_visible_context in (
+            None,
+            starter.user_visible_context,
+        ):
+            self._user_visible_context = None
+        else:
+            self._user_visible_context = user_visible_context
+        self.starter_id = starter_id if starter is not None else None
+
+    @property
+    def starter(self) -> Starter | None:
+        """
+        The catalog starter of the conversation, or None if it has a custom context.
+        """
+        if self.starter_id is None or self._context is not None:
+            return None
+        return get_starter_catalog()[self.starter_id]
+
+    @property
+    def context(self) -> str:
+        if self._context is not None:
+            return self._context
+        return get_starter_catalog()[self.starter_id].context
+
+    @context.setter
+    def context(self, context: str):
+        self._set_starter(None, context, self.user_visible_context)
+
+    @property
+    def user_visible_context(self) -> str:
+        if self._user_visible_context is not None:
+            return self._user_visible_context
+        # A custom context may come without one
+        if self.starter_id is None:
+            return ""
+        return get_starter_catalog()[self.starter_id].user_visible_context
+
+    @user_visible_context.setter
+    def user_visible_context(self, user_visible_context: str):
+        self._set_starter(self.starter_id, self.context, user_visible_context)
+
+    @property
+    def messages(self) -> ConversationMessages:
+        return ConversationMessages(self)
+
+    @messages.setter
+    def messages(self, messages: Sequence[str]):
+        # Prompt-formatted transcript and the offset at which the line of every message starts
+        self._transcript = ""
+        self._line_starts = array("I")
+        self._append_lines(list(messages))
+
+    def _append_lines(self, messages: list[str]):
+        lines = []
+        offset = len(self._transcript)
+        for index, message in enumerate(messages, len(self._line_starts)):
+            line = f"<{self._speaker_at(index).name}>: {message}\n"
+            self._line_starts.append(offset)
+            offset += len(line)
+            lines.append(line)
+        self._transcript += "".join(lines)
+
+    @staticmethod
+    def _speaker_at(index: int) -> Speaker:
+        return Speaker.CHATBOT if index % 2 == 0 else Speaker.USER
+
+    def _message_at(self, index: int) -> str:
+        count = len(self._line_starts)
+        if index < 0:
+            index += count
+        if not 0 <= index < count:
+            raise IndexError("message index out of range")
+        start = self._line_starts[index] + len(self._speaker_at(index).name) + 4
+        end = (
+            self._line_starts[index + 1] if index + 1 < count else len(self._transcript)
+        )
+        return self._transcript[start : end - 1]
 
     def add_message(self, message: str):
         """
@@ -55,12 +286,14 @@ class Conversation:
         """
 
         if not self.finished:
-            self.messages.append(message)
+            self._append_lines([message])
             if self.current_speaker == Speaker.CHATBOT:
                 self.num_of_messages_sent_by_agent += 1
             if self.get_remaining_agent_messages() <= 0:
                 self.finished = True
             self.switch_speaker()
+            if self.listener is not None:
+                self.listener(self)
 
     def switch_speaker(self):
         """
@@ -70,25 +303,34 @@ class Conversation:
             Speaker.CHATBOT if self.current_speaker == Speaker.USER else Speaker.USER
         )
 
-    def format_messages_for_prompt(self):
+    def format_messages_for_prompt(self, first_message: int = 0):
         """
         This is a helper function that takes the messages and outputs them in a format that can
         be injected into an LLM prompt.
 
+        The transcript is kept up to date as messages are added, so this only slices it.
+
+        Args:
+            first_message (int): Index of the first message to include.
+
         Example:
         <Agent>: I was in the store today and I saw a pigeon walking around inside.
         <User>: Wow. Thats crazy.
         <Agent>: Yeah, it was the only fun thing that happened to me in a while.
 
         """
-        formatted_messages = ""
-        current_speaker = Speaker.CHATBOT
-        for message in self.messages:
-            formatted_messages += f"<{current_speaker.name}>: {message}\n"
-            current_speaker = (
-                Speaker.CHATBOT if current_speaker == Speaker.USER else Speaker.USER
-            )
-        return formatted_messages
+        if first_message == 0:
+            return self._transcript
+        if first_message >= len(self._line_starts):
+            return ""
+        return self._transcript[self._line_starts[first_message] :]
+
+    def record_usage(self, prompt_tokens: int, completion_tokens: int):
+        """
+        Adds the token usage of a completion made for this conversation.
+        """
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
 
     def get_remaining_agent_messages(self):
         """
@@ -109,13 +351,23 @@ class Conversation:
         """
         return {
             "max_messages": self.max_messages,
-            "messages": self.messages,
+            "messages": list(self.messages),
             "current_speaker": self.current_speaker.name,
             "finished": self.finished,
             "context": self.context,
             "user_visible_context": self.user_visible_context,
             "num_of_messages_sent_by_agent": self.num_of_messages_sent_by_agent,
             "evaluation": self.evaluation,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "summary": self.summary,
+            "summarized_messages": self.summarized_messages,
+            "prompt_tokens_saved": self.prompt_tokens_saved,
+            "starter_id": self.starter_id,
+            "instructions_version": self.instructions_version,
+            "experiment": self.experiment,
+            "conversation_id": self.conversation_id,
+            "turn_evaluations": self.turn_evaluations,
         }
 
     @staticmethod
@@ -123,14 +375,133 @@ class Conversation:
         """
         Create a conversation instance from a dictionary.
         """
-        # conversation = Conversation(data["max_messages"])
-        # conversation.messages = data["messages"]
-        # conversation.current_speaker = data["current_speaker"]
-        # conversation.finished = data["finished"]
-        # conversation.context = data["context"]
-        # conversation.user_visible_context = data["user_visible_context"]
-        # conversation.num_of_messages_sent_by_agent = data["num_of_messages_sent_by_agent"]
-        return Conversation(**data)
+        data = dict(data)
+        evaluation = data.pop("evaluation", None)
+        conversation = Conversation(**data)
+        conversation.evaluation = evaluation
+        return conversation
+
+    def to_bytes(self) -> bytes:
+        """
+        Serializes the conversation into a compact binary snapshot. The transcript buffer is
+        written as is, so neither snapshotting nor restoring touches the messages one by one.
+
+        Returns:
+            bytes: The snapshot, to be restored with Conversation.from_bytes.
+        """
+        line_starts = self._line_starts
+        if sys.byteorder == "big":
+            line_starts = array("I", line_starts)
+            line_starts.byteswap()
+        parts = [
+            _SNAPSHOT_HEADER.pack(
+                SNAPSHOT_MAGIC,
+                SNAPSHOT_VERSION,
+                self.max_messages,
+                self.num_of_messages_sent_by_agent,
+                self.current_speaker == Speaker.CHATBOT,
+                self.finished,
+                self.prompt_tokens,
+                self.completion_tokens,
+                self.prompt_tokens_saved,
+                self.summarized_messages,
+                len(line_starts),
+            ),
+            line_starts.tobytes(),
+        ]
+        for text in (
+            self.starter_id,
+            self._context,
+            self._user_visible_context,
+            self.evaluation,
+            self.summary,
+            self.instructions_version,
+            None if self.experiment is None else json.dumps(self.experiment),
+            self.conversation_id,
+            json.dumps(self.turn_evaluations),
+            self._transcript,
+        ):
+            if text is None:
+                parts.append(_SNAPSHOT_LENGTH.pack(_NONE_LENGTH))
+            else:
+                encoded = text.encode("utf-8")
+                parts.append(_SNAPSHOT_LENGTH.pack(len(encoded)))
+                parts.append(encoded)
+        return b"".join(parts)
+
+    @staticmethod
+    def from_bytes(data: bytes):
+        """
+        Restores a conversation from a snapshot made by to_bytes.
+
+        Raises:
+            ValueError: If the data is not a snapshot of a supported version.
+        """
+        (
+            magic,
+            version,
+            max_messages,
+            num_of_messages_sent_by_agent,
+            chatbot_speaks,
+            finished,
+            prompt_tokens,
+            completion_tokens,
+            prompt_tokens_saved,
+            summarized_messages,
+            num_of_messages,
+        ) = _SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or not 1 <= version <= SNAPSHOT_VERSION:
+            raise ValueError(
+                f"Not a conversation snapshot of version 1 to {SNAPSHOT_VERSION}."
+            )
+        offset = _SNAPSHOT_HEADER.size
+        line_starts = array("I")
+        line_starts.frombytes(data[offset : offset + 4 * num_of_messages])
+        if sys.byteorder == "big":
+            line_starts.byteswap()
+        offset += 4 * num_of_messages
+        texts = []
+        # Version 1 snapshots predate instructions_version and experiment, version 2 snapshots
+        # conversation_id and turn_evaluations
+        for _ in range({1: 6, 2: 8}.get(version, 10)):
+            (length,) = _SNAPSHOT_LENGTH.unpack_from(data, offset)
+            offset += _SNAPSHOT_LENGTH.size
+            if length == _NONE_LENGTH:
+                texts.append(None)
+            else:
+                texts.append(str(data[offset : offset + length], "utf-8"))
+                offset += length
+        starter_id, context, user_visible_context, evaluation, summary = texts[:5]
+        instructions_version, experiment, conversation_id, turn_evaluations = (
+            texts[5:-1]
+            + [DEFAULT_INSTRUCTIONS_VERSION, None, None, None][len(texts) - 6 :]
+        )
+        transcript = texts[-1]
+        conversation = Conversation(
+            max_messages=max_messages,
+            messages=(),
+            current_speaker=Speaker.CHATBOT if chatbot_speaks else Speaker.USER,
+            finished=bool(finished),
+            context=context,
+            user_visible_context=user_visible_context,
+            num_of_messages_sent_by_agent=num_of_messages_sent_by_agent,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            summary=summary,
+            summarized_messages=summarized_messages,
+            prompt_tokens_saved=prompt_tokens_saved,
+            starter_id=starter_id,
+            instructions_version=instructions_version,
+            experiment=None if experiment is None else json.loads(experiment),
+            conversation_id=conversation_id,
+            turn_evaluations=(
+                None if turn_evaluations is None else json.loads(turn_evaluations)
+            ),
+        )
+        conversation.evaluation = evaluation
+        conversation._transcript = transcript
+        conversation._line_starts = line_starts
+        return conversation
 
 
 class ConversationBuilder:
@@ -138,28 +509,246 @@ class ConversationBuilder:
     This class is responsible for building and initializing conversations.
     """
 
-    def build(self) -> Conversation:
+    def __init__(self, catalog: StarterCatalog | None = None):
+        self.catalog = catalog if catalog is not None else get_starter_catalog()
+
+    def build(
+        self, topic: str | None = None, difficulty: str | None = None
+    ) -> Conversation:
         """
         Builds a conversation object.
 
+        Args:
+            topic (str | None): The topic of the starter, any topic if None.
+            difficulty (str | None): The difficulty of the starter, any difficulty if None.
+
         Returns:
         Conversation: the built conversation
         """
 
-        chosen_starter = random.choice(STARTERS)
+        return self.build_from_starter(self.catalog.sample(topic, difficulty))
+
+    @staticmethod
+    def build_from_starter(starter: Starter) -> Conversation:
+        """
+        Builds a conversation opening with the given starter.
+        """
         return Conversation(
             max_messages=MAX_MESSAGES,
-            messages=[chosen_starter["initial_message"]],
+            messages=[starter.initial_message],
             current_speaker=Speaker.USER,
             finished=False,
-            context=chosen_starter["context"],
-            user_visible_context=chosen_starter["user_visible_context"],
+            context=None,
+            user_visible_context=None,
             num_of_messages_sent_by_agent=1,
+            starter_id=starter.id,
+        )
+
+
+def build_response_messages(
+    conversation: Conversation, transcript: str | None = None
+) -> list[dict]:
+    """
+    Builds the chat messages used to generate the next agent message.
+
+    Args:
+        conversation (Conversation): The conversation object holding the conversation.
+        transcript (str | None): A compacted transcript to use instead of the full one.
+
+    Returns:
+        list[dict]: The messages to be sent to the chat completion API.
+    """
+    if transcript is None:
+        with span("format_messages_for_prompt"):
+            transcript = conversation.format_messages_for_prompt()
+    starter = conversation.starter
+    with span("next_message_prompt.format"):
+        if (
+            starter is not None
+            and conversation.instructions_version == DEFAULT_INSTRUCTIONS_VERSION
+        ):
+            # Rendered with the instructions and the context when the catalog was loaded
+            prompt = render_prompt_sections(
+                starter.prompt_sections,
+                num_of_remaining_messages=conversation.get_remaining_agent_messages(),
+                conversation=transcript,
+            )
+        else:
+            prompt = render_next_message_prompt(
+                instructions=INSTRUCTIONS_VERSIONS[conversation.instructions_version],
+                num_of_remaining_messages=conversation.get_remaining_agent_messages(),
+                context=conversation.context,
+                conversation=transcript,
+            )
+    return [
+        {"role": "system", "content": SYSTEM_MESSAGE},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def user_turn_indices(conversation: Conversation) -> range:
+    """
+    Returns the indices of the user messages of a conversation.
+    """
+    return range(1, len(conversation.messages), 2)
+
+
+def build_evaluation_messages(conversation: Conversation) -> list[dict]:
+    """
+    Builds the chat messages used to evaluate a finished conversation. Once every user turn has
+    been scored by evaluate_turn, the notes are summarized instead of the whole transcript.
+
+    Args:
+        conversation (Conversation): The conversation object to be evaluated.
+
+    Returns:
+        list[dict]: The messages to be sent to the chat completion API.
+    """
+    scored = {index for index, _ in conversation.turn_evaluations}
+    if scored and scored.issuperset(user_turn_indices(conversation)):
+        notes = "\n".join(
+            f"- Turn {index // 2 + 1}: {note}"
+            for index, note in sorted(conversation.turn_evaluations)
         )
+        prompt = f"Please write a very short and specific evaluation. The <user> is a human training their reflective listening skills against a chatbot. The chatbot is programmed to open up if the user utilized reflective listening and react neutrally or even hostilely otherwise. Summarize these notes on the user's turns into the evaluation: Context: {conversation.context} Notes:\n{notes}"
+    else:
+        prompt = f"Please write a very short and specific evaluation. The <user> is a human training their reflective listening skills against a chatbot. The chatbot is programmed to open up if the user utilized reflective listening and react neutrally or even hostilely otherwise: Context: {conversation.context} Conversation: {conversation.format_messages_for_prompt()}"
+    return [{"role": "assistant", "content": prompt}]
+
+
+def build_turn_evaluation_messages(
+    conversation: Conversation, index: int
+) -> list[dict]:
+    """
+    Builds the chat messages used to score a single user turn while the conversation goes on.
+
+    Args:
+        conversation (Conversation): The conversation object holding the turn.
+        index (int): The index of the user message to score.
+
+    Returns:
+        list[dict]: The messages to be sent to the chat completion API.
+    """
+    # The user message and the two messages before it
+    transcript = conversation.format_messages_for_prompt(max(index - 2, 0))
+    later = conversation.format_messages_for_prompt(index + 1)
+    excerpt = transcript[: len(transcript) - len(later)]
+    prompt = f"In one short sentence, note whether the <USER> reflected the <CHATBOT>'s words and feelings in their last message, or instead gave advice, opinions or asked probing questions. Context: {conversation.context} Conversation: {excerpt}"
+    return [{"role": "user", "content": prompt}]
+
+
+QUALITY_RATING = re.compile(r"\b(10|[1-9])\b")
+
+
+def build_quality_messages(conversation: Conversation) -> list[dict]:
+    """
+    Builds the chat messages used to rate how well the agent played its role, the quality
+    signal of the A/B test in experiments.py.
+
+    Args:
+        conversation (Conversation): The finished conversation object to be rated.
+
+    Returns:
+        list[dict]: The messages to be sent to the chat completion API.
+    """
+    prompt = f"Rate from 1 to 10 how believably the CHATBOT played a person with the hidden context below: opening up gradually when the USER listened reflectively, and holding back otherwise. Answer with a number only. Context: {conversation.context} Conversation: {conversation.format_messages_for_prompt()}"
+    return [{"role": "user", "content": prompt}]
+
+
+def parse_quality_rating(text: str) -> float | None:
+    """
+    Maps the first rating from 1 to 10 in a reply to [0, 1].
+    """
+    match = QUALITY_RATING.search(text or "")
+    return None if match is None else (int(match.group(1)) - 1) / 9
+
+
+def record_usage(
+    conversation: Conversation, model: str, prompt_tokens: int, completion_tokens: int
+):
+    """
+    Stores the token usage of a completion on the conversation and in the metrics.
+    """
+    conversation.record_usage(prompt_tokens, completion_tokens)
+    metrics.add_tokens(
+        model,
+        conversation.starter_id or "custom",
+        prompt_tokens,
+        completion_tokens,
+    )
+
+
+def count_parsed_response(model: str, path: str, agent_response: str | None) -> str:
+    """
+    Counts how the agent message was parsed from the model output.
+
+    Raises:
+        ValueError: If no agent message could be parsed.
+    """
+    metrics.increment(
+        "agent_response.parse",
+        model=model,
+        path=path if agent_response is not None else "failed",
+    )
+    if agent_response is None:
+        raise ValueError("The model output does not contain an agent_response.")
+    return agent_response
+
+
+def build_repair_request(text: str) -> dict:
+    """
+    Builds the arguments of the completion request repairing unparsable model output.
+    """
+    return {
+        "messages": build_repair_messages(text, RESPONSE_REPAIR_MAX_CHARACTERS),
+        "model": RESPONSE_REPAIR_MODEL,
+        "temperature": 0.0,
+        "max_tokens": RESPONSE_REPAIR_MAX_TOKENS,
+        "response_format": response_format_for(RESPONSE_REPAIR_MODEL),
+    }
+
+
+def record_repair_usage(conversation: Conversation, completion: Completion):
+    """
+    Stores the usage of a repair call, which is paid for because of unparsable output.
+    """
+    record_usage(
+        conversation,
+        RESPONSE_REPAIR_MODEL,
+        completion.prompt_tokens,
+        completion.completion_tokens,
+    )
+    metrics.increment("agent_response.repair_calls")
+    metrics.increment(
+        "agent_response.repair_tokens",
+        completion.prompt_tokens + completion.completion_tokens,
+    )
 
 
 class LLMAgent:
 
+    def __init__(
+        self,
+        backend: LLMBackend | None = None,
+        cache: ResponseCache | None = None,
+        budget: PromptBudgetManager | None = None,
+    ):
+        # The OpenAI API is used unless another backend, e.g. a FakeBackend, is passed in
+        self.backend = backend if backend is not None else OpenAIBackend()
+        # Responses and evaluations are only cached when a cache is passed in
+        self.cache = cache
+        # Without a budget manager the full transcript is always sent
+        self.budget = budget
+
+    def _build_response_messages(self, conversation: Conversation, model: str):
+        transcript = None
+        if self.budget is not None:
+            with span("compact_transcript"):
+                transcript = self.budget.compact_transcript(
+                    conversation, model, self.backend.complete
+                )
+        return build_response_messages(conversation, transcript)
+
     def generate_response(
         self, conversation: Conversation, model: str, temperature: float
     ):
@@ -174,24 +763,114 @@ class LLMAgent:
         Returns:
             str: The generated response from the LLM.
         """
-        prompt = next_message_prompt.format(
-            instructions=INSTRUCTIONS,
-            num_of_remaining_messages=conversation.get_remaining_agent_messages(),
-            context=conversation.context,
-            conversation=conversation.format_messages_for_prompt(),
-        )
-        response = openai.chat.completions.create(
-            model=model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a chatbot designed to help the user practice reflective listening skills.",
-                },
-                {"role": "user", "content": prompt},
-            ],
-            temperature=temperature,
-        )
-        return json.loads(response.choices[0].message.content)["agent_response"]
+        if self.cache is not None:
+            cached, ticket = self.cache.lookup_response(
+                conversation, model, temperature
+            )
+            if cached is not None:
+                return cached
+        messages = self._build_response_messages(conversation, model)
+        with span("completion", model=model):
+            completion = self.backend.complete(
+                messages,
+                model,
+                temperature,
+                response_format=response_format_for(model),
+            )
+        record_usage(
+            conversation, model, completion.prompt_tokens, completion.completion_tokens
+        )
+        agent_response = self._parse_response(conversation, completion.text, model)
+        if self.cache is not None:
+            self.cache.store(ticket, agent_response)
+        return agent_response
+
+    def stream_response(
+        self, conversation: Conversation, model: str, temperature: float
+    ) -> Iterator[str]:
+        """
+        Streaming variant of generate_response. The completion is requested as a stream and the
+        text of agent_response is yielded as soon as it is decoded.
+
+        Args:
+            conversation (Conversation): The conversation object holding the conversation.
+            model (str): The OpenAI model to be used.
+            temperature (float): The temperature of the model.
+
+        Yields:
+            str: Consecutive pieces of the agent message.
+        """
+        if self.cache is not None:
+            cached, ticket = self.cache.lookup_response(
+                conversation, model, temperature
+            )
+            if cached is not None:
+                yield cached
+                return
+        messages = self._build_response_messages(conversation, model)
+        started = time.perf_counter()
+        chunks = self.backend.stream(
+            messages,
+            model,
+            temperature,
+            on_usage=lambda prompt_tokens, completion_tokens: record_usage(
+                conversation, model, prompt_tokens, completion_tokens
+            ),
+            response_format=response_format_for(model),
+        )
+        parser = AgentResponseStreamParser()
+        output = []
+        pieces = []
+        try:
+            # The stream is read to the end, its last chunk carries the token usage
+            for chunk in chunks:
+                output.append(chunk)
+                text = parser.feed(chunk)
+                if text:
+                    if not pieces:
+                        metrics.observe(
+                            "completion.first_token",
+                            time.perf_counter() - started,
+                            model=model,
+                        )
+                    pieces.append(text)
+                    yield text
+        finally:
+            # Generators are closed, so that the HTTP response of the stream is released
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+            metrics.observe(
+                "completion", time.perf_counter() - started, model=model, stream=True
+            )
+        if not parser.started:
+            # Nothing was shown yet, so the output can still be repaired
+            agent_response = self._parse_response(conversation, "".join(output), model)
+            yield agent_response
+            pieces = [agent_response]
+        else:
+            metrics.increment("agent_response.parse", model=model, path="streamed")
+        if self.cache is not None and (parser.done or not parser.started):
+            self.cache.store(ticket, "".join(pieces))
+
+    def _parse_response(self, conversation: Conversation, text: str, model: str):
+        """
+        Parses the agent message from the model output. Output that is not even near-JSON is
+        sent back to the model with a repair prompt, at most RESPONSE_REPAIR_ATTEMPTS times.
+
+        Raises:
+            ValueError: If the output cannot be parsed, not even after repairing it.
+        """
+        with span("parse_agent_response"):
+            agent_response, path = parse_agent_response(text)
+        for _ in range(RESPONSE_REPAIR_ATTEMPTS if agent_response is None else 0):
+            with span("completion", model=RESPONSE_REPAIR_MODEL, kind="repair"):
+                completion = self.backend.complete(**build_repair_request(text))
+            record_repair_usage(conversation, completion)
+            agent_response, path = parse_agent_response(completion.text)[0], "repaired"
+            if agent_response is not None:
+                break
+        return count_parsed_response(model, path, agent_response)
 
     def evaluate_conversation(
         self, conversation: Conversation, model: str, temperature: float
@@ -207,17 +886,410 @@ class LLMAgent:
         Returns:
             str: The evaluation of the conversation.
         """
-        prompt = f"Please write a very short and specific evaluation. The <user> is a human training their reflective listening skills against a chatbot. The chatbot is programmed to open up if the user utilized reflective listening and react neutrally or even hostilely otherwise: Context: {conversation.context} Conversation: {conversation.format_messages_for_prompt()}"
-        response = openai.chat.completions.create(
-            model=model,
-            messages=[{"role": "assistant", "content": prompt}],
-            temperature=temperature,
-            max_tokens=150,
+        if self.cache is not None:
+            cached, ticket = self.cache.lookup_evaluation(
+                conversation, model, temperature
+            )
+            if cached is not None:
+                return cached
+        messages = build_evaluation_messages(conversation)
+        with span("completion", model=model, kind="evaluation"):
+            completion = self.backend.complete(
+                messages, model, temperature, max_tokens=150
+            )
+        record_usage(
+            conversation, model, completion.prompt_tokens, completion.completion_tokens
+        )
+        evaluation = completion.text
+        if self.cache is not None:
+            self.cache.store(ticket, evaluation)
+        return evaluation
+
+    def evaluate_turn(self, conversation: Conversation, index: int, model: str):
+        """
+        Scores a single user turn, for the incremental evaluation of a running conversation.
+
+        Args:
+            conversation (Conversation): The conversation object holding the turn.
+            index (int): The index of the user message to score.
+            model (str): The OpenAI model to be used.
+
+        Returns:
+            str: A one sentence note on the turn.
+        """
+        with span("completion", model=model, kind="turn_evaluation"):
+            completion = self.backend.complete(
+                build_turn_evaluation_messages(conversation, index),
+                model,
+                0.0,
+                max_tokens=60,
+            )
+        record_usage(
+            conversation, model, completion.prompt_tokens, completion.completion_tokens
+        )
+        return completion.text.strip()
+
+    def rate_conversation(
+        self,
+        conversation: Conversation,
+        model: str,
+        on_usage: Callable[[int], None] | None = None,
+    ):
+        """
+        Rates how well the agent played its role in a finished conversation.
+
+        Args:
+            conversation (Conversation): The conversation object to be rated.
+            model (str): The OpenAI model to be used.
+            on_usage (Callable[[int], None] | None): Called with the tokens the rating used,
+                e.g. to charge them to the rate limits.
+
+        Returns:
+            float | None: The rating in [0, 1], or None if the reply held no rating.
+        """
+        with span("completion", model=model, kind="quality"):
+            completion = self.backend.complete(
+                build_quality_messages(conversation), model, 0.0, max_tokens=5
+            )
+        metrics.add_tokens(
+            model,
+            "quality-rating",
+            completion.prompt_tokens,
+            completion.completion_tokens,
         )
-        return response.choices[0].message.content
+        if on_usage is not None:
+            on_usage(completion.prompt_tokens + completion.completion_tokens)
+        return parse_quality_rating(completion.text)
+
+
+class AsyncLLMAgent:
+    """
+    This class is the asynchronous counterpart of LLMAgent. With the default OpenAIBackend all
+    requests share one pooled HTTP client with keep-alive, so many conversations can be served
+    from a single event loop.
+    """
+
+    def __init__(
+        self,
+        backend: LLMBackend | None = None,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        max_retries: int = LLM_MAX_RETRIES,
+        backoff_base: float = LLM_BACKOFF_BASE_SECONDS,
+        backoff_max: float = LLM_BACKOFF_MAX_SECONDS,
+        cache: ResponseCache | None = None,
+        budget: PromptBudgetManager | None = None,
+    ):
+        self.backend = backend if backend is not None else OpenAIBackend()
+        self.cache = cache
+        self.budget = budget
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def _backoff_delay(self, attempt: int) -> float:
+        """
+        Exponential backoff with full jitter for the given (zero based) retry attempt.
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+    async def _complete(self, *args, **kwargs) -> Completion:
+        """
+        Sends a chat completion request, retrying transient errors with backoff.
+        The concurrency slot is released while waiting between attempts.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self._semaphore:
+                    return await self.backend.acomplete(*args, **kwargs)
+            except retryable_errors():
+                if attempt == self.max_retries:
+                    raise
+            await asyncio.sleep(self._backoff_delay(attempt))
+        raise AssertionError("unreachable")
+
+    async def complete(
+        self,
+        messages: list[dict],
+        model: str,
+        temperature: float,
+        max_tokens: int | None = None,
+    ) -> Completion:
+        """
+        Sends other chat messages, e.g. those of a simulated user, with the agent's retries and
+        concurrency limit.
+        """
+        with span("completion", model=model, kind="other"):
+            return await self._complete(
+                messages, model, temperature, max_tokens=max_tokens
+            )
+
+    async def generate_response(
+        self, conversation: Conversation, model: str, temperature: float
+    ):
+        """
+        Generates a response from the LLM based on the given prompt.
+
+        Args:
+            conversation (Conversation): The conversation object holding the conversation.
+            model (str): The OpenAI model to be used.
+            temperature (float): The temperature of the model.
+
+        Returns:
+            str: The generated response from the LLM.
+        """
+        if self.cache is not None:
+            cached, ticket = self.cache.lookup_response(
+                conversation, model, temperature
+            )
+            if cached is not None:
+                return cached
+        transcript = None
+        if self.budget is not None:
+            with span("compact_transcript"):
+                transcript = await self.budget.acompact_transcript(
+                    conversation, model, self._complete
+                )
+        messages = build_response_messages(conversation, transcript)
+        with span("completion", model=model):
+            completion = await self._complete(
+                messages,
+                model,
+                temperature,
+                response_format=response_format_for(model),
+            )
+        record_usage(
+            conversation, model, completion.prompt_tokens, completion.completion_tokens
+        )
+        agent_response = await self._parse_response(
+            conversation, completion.text, model
+        )
+        if self.cache is not None:
+            self.cache.store(ticket, agent_response)
+        return agent_response
+
+    async def stream_response(
+        self, conversation: Conversation, model: str, temperature: float
+    ) -> AsyncIterator[str]:
+        """
+        Asynchronous variant of LLMAgent.stream_response. The request holds one of the agent's
+        concurrency slots until the stream ends; it is not retried.
+
+        Yields:
+            str: Consecutive pieces of the agent message.
+        """
+        if self.cache is not None:
+            cached, ticket = self.cache.lookup_response(
+                conversation, model, temperature
+            )
+            if cached is not None:
+                yield cached
+                return
+        transcript = None
+        if self.budget is not None:
+            with span("compact_transcript"):
+                transcript = await self.budget.acompact_transcript(
+                    conversation, model, self._complete
+                )
+        messages = build_response_messages(conversation, transcript)
+        parser = AgentResponseStreamParser()
+        output = []
+        pieces = []
+        async with self._semaphore:
+            started = time.perf_counter()
+            chunks = self.backend.astream(
+                messages,
+                model,
+                temperature,
+                on_usage=lambda prompt_tokens, completion_tokens: record_usage(
+                    conversation, model, prompt_tokens, completion_tokens
+                ),
+                response_format=response_format_for(model),
+            )
+            try:
+                # The stream is read to the end, its last chunk carries the token usage
+                async for chunk in chunks:
+                    output.append(chunk)
+                    text = parser.feed(chunk)
+                    if text:
+                        if not pieces:
+                            metrics.observe(
+                                "completion.first_token",
+                                time.perf_counter() - started,
+                                model=model,
+                            )
+                        pieces.append(text)
+                        yield text
+            finally:
+                aclose = getattr(chunks, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+                metrics.observe(
+                    "completion",
+                    time.perf_counter() - started,
+                    model=model,
+                    stream=True,
+                )
+        if not parser.started:
+            # Nothing was shown yet, so the output can still be repaired
+            agent_response = await self._parse_response(
+                conversation, "".join(output), model
+            )
+            yield agent_response
+            pieces = [agent_response]
+        else:
+            metrics.increment("agent_response.parse", model=model, path="streamed")
+        if self.cache is not None and (parser.done or not parser.started):
+            self.cache.store(ticket, "".join(pieces))
+
+    async def _parse_response(self, conversation: Conversation, text: str, model: str):
+        """
+        Asynchronous variant of LLMAgent._parse_response.
+        """
+        with span("parse_agent_response"):
+            agent_response, path = parse_agent_response(text)
+        for _ in range(RESPONSE_REPAIR_ATTEMPTS if agent_response is None else 0):
+            with span("completion", model=RESPONSE_REPAIR_MODEL, kind="repair"):
+                completion = await self._complete(**build_repair_request(text))
+            record_repair_usage(conversation, completion)
+            agent_response, path = parse_agent_response(completion.text)[0], "repaired"
+            if agent_response is not None:
+                break
+        return count_parsed_response(model, path, agent_response)
+
+    async def evaluate_conversation(
+        self, conversation: Conversation, model: str, temperature: float
+    ):
+        """
+        Generates an evaluation of the conversation based on the context and conversation history.
+
+        Args:
+            conversation (Conversation): The conversation object to be evaluated.
+            model (str): The OpenAI model to be used.
+            temperature (float): The temperature of the model.
+
+        Returns:
+            str: The evaluation of the conversation.
+        """
+        if self.cache is not None:
+            cached, ticket = self.cache.lookup_evaluation(
+                conversation, model, temperature
+            )
+            if cached is not None:
+                return cached
+        messages = build_evaluation_messages(conversation)
+        with span("completion", model=model, kind="evaluation"):
+            completion = await self._complete(
+                messages, model, temperature, max_tokens=150
+            )
+        record_usage(
+            conversation, model, completion.prompt_tokens, completion.completion_tokens
+        )
+        evaluation = completion.text
+        if self.cache is not None:
+            self.cache.store(ticket, evaluation)
+        return evaluation
+
+    async def evaluate_turn(self, conversation: Conversation, index: int, model: str):
+        """
+        Scores a single user turn, for the incremental evaluation of a running conversation.
+
+        Args:
+            conversation (Conversation): The conversation object holding the turn.
+            index (int): The index of the user message to score.
+            model (str): The OpenAI model to be used.
+
+        Returns:
+            str: A one sentence note on the turn.
+        """
+        with span("completion", model=model, kind="turn_evaluation"):
+            completion = await self._complete(
+                build_turn_evaluation_messages(conversation, index),
+                model,
+                0.0,
+                max_tokens=60,
+            )
+        record_usage(
+            conversation, model, completion.prompt_tokens, completion.completion_tokens
+        )
+        return completion.text.strip()
+
+    async def rate_conversation(
+        self,
+        conversation: Conversation,
+        model: str,
+        on_usage: Callable[[int], None] | None = None,
+    ):
+        """
+        Rates how well the agent played its role in a finished conversation.
+
+        Args:
+            conversation (Conversation): The conversation object to be rated.
+            model (str): The OpenAI model to be used.
+            on_usage (Callable[[int], None] | None): Called with the tokens the rating used,
+                e.g. to charge them to the rate limits.
+
+        Returns:
+            float | None: The rating in [0, 1], or None if the reply held no rating.
+        """
+        with span("completion", model=model, kind="quality"):
+            completion = await self._complete(
+                build_quality_messages(conversation), model, 0.0, max_tokens=5
+            )
+        metrics.add_tokens(
+            model,
+            "quality-rating",
+            completion.prompt_tokens,
+            completion.completion_tokens,
+        )
+        if on_usage is not None:
+            on_usage(completion.prompt_tokens + completion.completion_tokens)
+        return parse_quality_rating(completion.text)
+
+    async def generate_responses(
+        self,
+        conversations: Sequence[Conversation],
+        model: str,
+        temperature: float,
+        return_exceptions: bool = False,
+    ) -> list:
+        """
+        Generates the next agent message for many conversations concurrently. The number of
+        requests in flight is bounded by the agent's concurrency limit.
+
+        Args:
+            conversations (Sequence[Conversation]): The conversations waiting for an agent turn.
+            model (str): The OpenAI model to be used.
+            temperature (float): The temperature of the model.
+            return_exceptions (bool): Return failures in place of results instead of raising.
+
+        Returns:
+            list: The generated responses, in the same order as the conversations.
+        """
+        return await asyncio.gather(
+            *(
+                self.generate_response(conversation, model, temperature)
+                for conversation in conversations
+            ),
+            return_exceptions=return_exceptions,
+        )
+
+    async def aclose(self):
+        """
+        Releases the backend, e.g. the pooled HTTP client of the OpenAIBackend.
+        """
+        await self.backend.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
 
 
 if __name__ == "__main__":
+    import openai
+
     openai.api_key = os.getenv("OPENAI_KEY")
     conv_builder = ConversationBuilder()
     conv = conv_builder.build()
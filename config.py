@@ -1,8 +1,149 @@
-from langchain.prompts import PromptTemplate
-
 MAX_MESSAGES = 20
 MAX_CALLS_PER_DAY = 1000  # Set your daily limit
 
+# Budgets enforced by rate_limiter.RateLimiter across all sessions
+MAX_CALLS_PER_MINUTE = 60  # Bursts above this rate wait in line
+MAX_CALLS_PER_USER_PER_DAY = 100
+MAX_TOKENS_PER_DAY = 3_000_000
+MAX_TOKENS_PER_USER_PER_DAY = 300_000
+ESTIMATED_COMPLETION_TOKENS = 150  # Reserved per call before the actual usage is known
+RATE_LIMIT_MAX_WAIT_SECONDS = 10.0
+RATE_LIMIT_MAX_TRACKED_USERS = 100_000
+RATE_LIMIT_SHARED = False  # Share the daily budgets across processes through MongoDB
+
+# Settings of the shared, pooled client used by AsyncLLMAgent
+LLM_MAX_CONCURRENCY = 16  # Requests in flight at once
+LLM_MAX_CONNECTIONS = 32
+LLM_MAX_KEEPALIVE_CONNECTIONS = 16
+LLM_TIMEOUT_SECONDS = 60.0
+LLM_MAX_RETRIES = 3
+LLM_BACKOFF_BASE_SECONDS = 0.5
+LLM_BACKOFF_MAX_SECONDS = 8.0
+
+# Batched conversation writes to MongoDB
+MONGO_BATCH_SIZE = 50  # Insert as soon as this many conversations are queued
+MONGO_FLUSH_INTERVAL_SECONDS = 2.0  # ... or once the oldest queued one is this old
+MONGO_WRITE_QUEUE_SIZE = 1000
+MONGO_WRITE_ATTEMPTS = 4  # A failed batch is written again this many times in all
+MONGO_WRITE_BACKOFF_SECONDS = 0.5  # Doubles after every failed attempt
+MONGO_PAGE_SIZE = 100  # Conversations per page of MongoPersistence.find_conversations
+MONGO_MAX_PAGE_SIZE = 1000
+
+# Opt-in cache of agent responses and evaluations
+RESPONSE_CACHE_ENABLED = False
+RESPONSE_CACHE_NEAR_DUPLICATES = (
+    False  # Also match similar last user messages by embedding
+)
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RESPONSE_CACHE_TTL_SECONDS = 24 * 60 * 60
+RESPONSE_CACHE_SIMILARITY_THRESHOLD = 0.95
+
+# Offline re-evaluation of stored conversations (batch_evaluation.py)
+BATCH_EVALUATION_CHUNK_SIZE = 200  # Conversations read, evaluated and written per step
+BATCH_EVALUATION_CHECKPOINT = "batch_evaluation_checkpoint.json"
+
+# Evaluation of finished conversations in the background (background_evaluation.py)
+EVALUATION_MODEL = "gpt-4-turbo"
+EVALUATION_TEMPERATURE = 0.5
+BACKGROUND_EVALUATION_WORKERS = 8
+INCREMENTAL_EVALUATION = False  # Score every user turn as it arrives
+INCREMENTAL_EVALUATION_MODEL = "gpt-3.5-turbo"
+BACKGROUND_EVALUATION_MAX_PENDING = 10_000  # Conversations with unmerged results
+BACKGROUND_EVALUATION_TTL_SECONDS = 60 * 60  # Unmerged results are dropped after this
+
+# Parsing of agent responses (response_parsing.py)
+JSON_MODE_MODELS = ("gpt-4-turbo", "gpt-4o", "gpt-4o-mini", "gpt-3.5-turbo")
+JSON_SCHEMA_MODELS = ("gpt-4o", "gpt-4o-mini")  # Support schema-constrained output
+RESPONSE_REPAIR_ATTEMPTS = 1  # Paid calls to repair output that cannot be parsed
+RESPONSE_REPAIR_MODEL = "gpt-3.5-turbo"
+RESPONSE_REPAIR_MAX_CHARACTERS = 2000  # Of the broken output sent back
+RESPONSE_REPAIR_MAX_TOKENS = 300
+
+# Self-play generation of conversations with simulated users (self_play.py)
+SELF_PLAY_AGENT_MODEL = "gpt-4-turbo"
+SELF_PLAY_AGENT_TEMPERATURE = 0.5
+SELF_PLAY_USER_MODEL = "gpt-3.5-turbo"
+SELF_PLAY_USER_TEMPERATURE = 0.9
+SELF_PLAY_CONCURRENCY = 32  # Conversations played at once
+SELF_PLAY_REPORT_INTERVAL_SECONDS = 10.0
+
+# HTTP and WebSocket service (api.py)
+API_MODEL = "gpt-4-turbo"
+API_TEMPERATURE = 0.5
+CONVERSATION_STORE_MAX_SESSIONS = 100_000  # Of the in-memory store
+CONVERSATION_STORE_TTL_SECONDS = 24 * 60 * 60  # Idle sessions are removed after this
+
+# Replay of saved conversations against a stored baseline (replay_benchmark.py)
+REPLAY_BASELINE_PATH = "replay_baseline.json"
+REPLAY_REPEAT = 20  # Timed replays, the median is compared
+REPLAY_MAX_SLOWDOWN = 0.30  # Of the CPU time of a stage or of the turn latency
+REPLAY_MAX_ALLOCATION_GROWTH = 0.10
+# Differences below these are noise, however large relative to the baseline
+REPLAY_MIN_TIME_DIFFERENCE_US = 10.0
+REPLAY_MIN_LATENCY_DIFFERENCE_MS = 0.1
+REPLAY_MIN_ALLOCATION_DIFFERENCE_KB = 1.0
+# And so are time differences below this many interquartile ranges of the timed replays
+REPLAY_NOISE_SPREADS = 3.0
+
+# Per-turn feature extraction into Parquet (feature_extraction.py)
+FEATURE_EXTRACTION_CHUNK_SIZE = 2000  # Conversations per batch handed to a worker
+FEATURE_EXTRACTION_WORKERS = None  # Defaults to the number of CPUs
+
+# Export of the timing spans and token counts (instrumentation.py)
+METRICS_EXPORTER = "log"  # "log", "prometheus", "jsonl" or None to disable
+METRICS_EXPORT_INTERVAL_SECONDS = 60.0
+METRICS_EXPORT_PATH = None  # Output file of the prometheus and jsonl exporters
+
+# Compaction of long transcripts into a rolling summary (prompt_budget.py)
+PROMPT_BUDGET_ENABLED = False
+PROMPT_BUDGET_TOKENS = 2500  # Summarize older messages once the prompt exceeds this
+PROMPT_KEEP_RECENT_MESSAGES = 6  # Always sent verbatim
+PROMPT_SUMMARY_CHUNK_MESSAGES = (
+    4  # The summary is extended by at least this many messages
+)
+PROMPT_SUMMARY_MODEL = "gpt-3.5-turbo"
+PROMPT_SUMMARY_MAX_TOKENS = 200
+
+# Online A/B test of the agent's settings (experiments.py)
+EXPERIMENT_ENABLED = False
+EXPERIMENT_NAME = "agent-settings-1"  # Rename when changing the arms
+EXPERIMENT_ARMS = [
+    {"id": "gpt-4-turbo-0.5", "model": "gpt-4-turbo", "temperature": 0.5},
+    {"id": "gpt-4-turbo-0.9", "model": "gpt-4-turbo", "temperature": 0.9},
+    {"id": "gpt-3.5-turbo-0.5", "model": "gpt-3.5-turbo", "temperature": 0.5},
+    {
+        "id": "gpt-4-turbo-0.5-v0",
+        "model": "gpt-4-turbo",
+        "temperature": 0.5,
+        "instructions_version": "v0",
+    },
+]
+EXPERIMENT_QUALITY_MODEL = "gpt-3.5-turbo"  # Rates the agent once a conversation ends
+# A mean turn latency or a cost at the scale or above lowers the reward in [0, 1] by the weight
+EXPERIMENT_LATENCY_WEIGHT = 0.2
+EXPERIMENT_LATENCY_SCALE_SECONDS = 10.0
+EXPERIMENT_COST_WEIGHT = 0.3
+EXPERIMENT_COST_SCALE_USD = 0.10
+# USD per 1000 prompt and completion tokens
+MODEL_PRICES_PER_1K_TOKENS = {
+    "gpt-4-turbo": (0.01, 0.03),
+    "gpt-4o": (0.005, 0.015),
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+}
+
+# Catalog of conversation starters (conversation_starters.py)
+STARTER_CATALOG_PATH = "starters.json"  # Relative to the app's directory
+STARTER_CATALOG_BALANCED = True  # Favor starters that have been served less often
+
+PROMPT_SECTIONS_CACHE_SIZE = (
+    1024  # Pre-rendered static prompt sections, one per starter
+)
+
+# Prompt caching of the providers (prompt_cache_check.py). OpenAI caches prompts of at least
+# 1024 tokens, in increments of 128 tokens
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_INCREMENT_TOKENS = 128
+
 # Instantiation using initializer
 INSTRUCTIONS_V0 = """
 Reflective listening is a conversational technique that is designed to make the speaker feel heard
@@ -29,27 +170,25 @@ The output should be a valid json which can be parsed:
 {"agent_response": 'your response'}
 """
 
+# Instructions versions the experiment arms can choose from
+INSTRUCTIONS_VERSIONS = {"v0": INSTRUCTIONS_V0, "v1": INSTRUCTIONS}
+DEFAULT_INSTRUCTIONS_VERSION = "v1"
+
+# Static fields first, then the append-only transcript, then the per-turn values, so that the
+# prompt of a turn starts with the whole prompt of the turn before it up to the transcript's end
+# and providers can serve that prefix from their prompt cache (checked by prompt_cache_check.py)
 TEMPLATE = """
 Instructions:
 {instructions}
 
-Number of message left for agent:
-{num_of_remaining_messages}
-
 Context: 
 {context}
 
 Conversation so far:
 <start>
 {conversation}
-"""
+<end>
 
-next_message_prompt = PromptTemplate(
-    input_variables=[
-        "instructions",
-        "num_of_remaining_messages",
-        "context",
-        "conversation",
-    ],
-    template=TEMPLATE,
-)
+Number of message left for agent:
+{num_of_remaining_messages}
+"""
@@ -1,115 +1,239 @@
-STARTERS = [
-    {
-        "initial_message": "Something funny happened at the store today",
-        "user_visible_context": "Your close friend messages you on Facebook.",
-        "context": """The agent messages their long-time friend on Facebook. It wants to tell their 
-        friend about the frustrations it is facing with its spouse, but is hesitant to talk about
-        the subject directly. Instead, it randomly tells the user about something it experienced at
-        the store that day to gauge the user's reaction.
-        """,
-    },
-    {
-        "initial_message": "I saw a weird dream last night about flying fish!",
-        "user_visible_context": "You receive a message from a coworker late at night.",
-        "context": """The agent, your coworker, is actually feeling quite burnt out and stressed from work 
-        but doesn't know how to start discussing this topic directly. The agent mentions a bizarre dream,
-        hoping to transition the conversation to discuss feelings about work and stress indirectly.
-        """,
-    },
-    {
-        "initial_message": "Have you ever thought about what it's like to be an astronaut?",
-        "user_visible_context": "A message from an old school friend pops up on your chat.",
-        "context": """The agent has been feeling trapped and wants to change careers, dreaming about doing something 
-        drastically different. It starts with a light, adventurous topic to eventually discuss major life changes 
-        and the idea of taking big risks.
-        """,
-    },
-    {
-        "initial_message": "Guess who I bumped into at the gym today?",
-        "user_visible_context": "Your gym buddy sends you a message after a long time.",
-        "context": """The agent feels lonely and misses the old days spent with friends, including you. By starting 
-        the conversation with a nostalgic and seemingly happy occurrence, it hopes to steer the discussion towards 
-        rekindling old friendships and expressing feelings of loneliness.
-        """,
-    },
-    {
-        "initial_message": "Do you remember that little bakery by our old school? I passed by it today.",
-        "user_visible_context": "A text from someone you used to go to school with.",
-        "context": """The agent has been experiencing a mix of nostalgia and midlife crisis. It mentions the bakery 
-        as a segue into talking about dissatisfaction with the current life phase and to reminisce about youth, 
-        hoping to discuss deeper feelings of fulfillment and happiness.
-        """,
-    },
-    {
-        "initial_message": "I tried a new recipe for dinner tonight and it turned out surprisingly well!",
-        "user_visible_context": "Chatting with a friend who enjoys cooking.",
-        "context": """The agent has been struggling with personal motivation and self-care, including proper nutrition.
-        By mentioning a successful cooking attempt, the agent aims to open up about broader issues of health and lifestyle changes
-        they've been considering to improve their overall well-being.
-        """,
-    },
-    {
-        "initial_message": "You won't believe the kind of music I've started listening to lately.",
-        "user_visible_context": "From a colleague known for their eclectic taste in music.",
-        "context": """The agent feels stuck in a rut creatively and has started exploring different music to find inspiration.
-        This message is a prelude to discussing deeper feelings of stagnation in life and creativity, seeking advice or shared experiences
-        on how to overcome creative blocks.
-        """,
-    },
-    {
-        "initial_message": "Remember our road trip last summer? I found some photos we never looked at.",
-        "user_visible_context": "A message from a friend with whom you've shared memorable adventures.",
-        "context": """The agent has been feeling nostalgic and somewhat regretful about lost time and missed opportunities.
-        By bringing up a happy memory, it hopes to discuss feelings about aging, life choices, and perhaps reigniting the
-        spark for future adventures and opportunities.
-        """,
-    },
-    {
-        "initial_message": "I read an article about mindfulness meditation today; it's quite interesting.",
-        "user_visible_context": "Conversation with a friend who is a bit of a skeptic about meditation and mindfulness.",
-        "context": """The agent is experiencing high levels of stress and is looking into mindfulness as a coping mechanism.
-        By starting with a neutral, informative statement, the agent seeks to slowly guide the conversation towards personal
-        experiences and concerns regarding stress management and mental health.
-        """,
-    },
-    {
-        "initial_message": "Have you seen the latest superhero movie? Just watched it last night.",
-        "user_visible_context": "Chatting with a friend known for being a movie buff.",
-        "context": """The agent feels disconnected from friends and popular culture due to being overly busy with work.
-        By mentioning a current popular movie, the agent hopes to reconnect and discuss broader issues of work-life balance
-        and finding time for relaxation and personal interests.
-        """,
-    },
-    {
-        "initial_message": "Lately, I've been getting into gardening. Did you know how calming it can be?",
-        "user_visible_context": "A casual conversation with a neighbor who's recently retired.",
-        "context": """The agent has been experiencing anxiety and is exploring gardening as a therapeutic activity.
-        The initial mention of gardening is an opening to discuss mental health and the search for peace in daily activities,
-        potentially exploring the neighbor's experiences with transitions and finding new passions.
-        """,
-    },
-    {
-        "initial_message": "I started biking to work; it’s quite refreshing!",
-        "user_visible_context": "From a colleague who’s known for not being a morning person.",
-        "context": """The agent is actually trying to adopt a healthier lifestyle and combat a sedentary routine.
-        By sharing an update about biking, the agent aims to segue into broader discussions about health, motivation,
-        and improving fitness.
-        """,
-    },
-    {
-        "initial_message": "I've been thinking about writing a book. Ever thought of doing something completely out of your comfort zone?",
-        "user_visible_context": "A message from an old friend who's usually quite reserved.",
-        "context": """The agent feels unfulfilled with current career achievements and is contemplating a drastic change.
-        The conversation starter is designed to probe the user’s thoughts on taking risks and making significant life changes,
-        providing a pathway to discuss fears, aspirations, and the idea of pursuing one's passions.
-        """,
-    },
-    {
-        "initial_message": "Do you remember that cozy little cafe we found in the city last year? I went back there today.",
-        "user_visible_context": "Chatting with someone you shared a memorable trip with.",
-        "context": """The agent has been feeling nostalgic and lonely, longing for the days spent in good company.
-        Mentioning the cafe is a way to reminisce about better times and to subtly bring up current feelings of loneliness
-        or changes in social life, inviting a deeper conversation about dealing with such emotions.
-        """,
-    },
-]
+"""
+This module holds the catalog of conversation starters.
+
+Starters are loaded from a JSON data file (config.STARTER_CATALOG_PATH) and indexed by ID,
+topic and difficulty. Their pre-rendered static prompt sections are computed once at load time,
+their token counts on first use, as counting loads the tokenizer. Sampling uses alias tables, so
+drawing a starter takes constant time however large the catalog grows. By default the draws are
+weighted towards starters that have been served less often.
+"""
+
+import json
+import os
+import random
+import threading
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Iterator
+
+from config import INSTRUCTIONS, STARTER_CATALOG_BALANCED, STARTER_CATALOG_PATH
+from prompt_budget import count_tokens
+from prompts import compile_next_message_prompt
+
+
+@dataclass(slots=True)
+class Starter:
+    """
+    This class holds a conversation starter and the metadata precomputed for it.
+    """
+
+    id: str
+    topic: str
+    difficulty: str
+    initial_message: str
+    user_visible_context: str
+    context: str
+    weight: float = 1.0
+    # The template rendered with the instructions and this context, see prompts.py
+    prompt_sections: tuple = field(init=False, repr=False)
+    # Token counts by attribute name, filled in on first use
+    _tokens: dict = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.prompt_sections = compile_next_message_prompt(INSTRUCTIONS, self.context)
+        self._tokens = {}
+
+    def _count(self, name: str, text: str) -> int:
+        if name not in self._tokens:
+            self._tokens[name] = count_tokens(text)
+        return self._tokens[name]
+
+    @property
+    def initial_message_tokens(self) -> int:
+        return self._count("initial_message", self.initial_message)
+
+    @property
+    def context_tokens(self) -> int:
+        return self._count("context", self.context)
+
+    @property
+    def static_prompt_tokens(self) -> int:
+        return self._count(
+            "static_prompt", "".join(text for text, _ in self.prompt_sections)
+        )
+
+
+class AliasSampler:
+    """
+    This class draws indices with probabilities proportional to fixed weights in O(1), using
+    Vose's alias method. Building the tables takes O(n).
+    """
+
+    __slots__ = ("_probabilities", "_aliases")
+
+    def __init__(self, weights: list[float]):
+        total = sum(weights)
+        if not weights or total <= 0:
+            raise ValueError("At least one weight must be positive.")
+        scaled = [weight * len(weights) / total for weight in weights]
+        self._probabilities = [1.0] * len(weights)
+        self._aliases = list(range(len(weights)))
+        small = [index for index, value in enumerate(scaled) if value < 1]
+        large = [index for index, value in enumerate(scaled) if value >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self._probabilities[less] = scaled[less]
+            self._aliases[less] = more
+            scaled[more] += scaled[less] - 1
+            (small if scaled[more] < 1 else large).append(more)
+
+    def sample(self, rng: random.Random) -> int:
+        index = int(rng.random() * len(self._probabilities))
+        return (
+            index if rng.random() < self._probabilities[index] else self._aliases[index]
+        )
+
+
+class StarterCatalog:
+    """
+    This class indexes the conversation starters and samples them.
+
+    Args:
+        starters (list[Starter]): The starters, with unique IDs.
+        balance_served (bool): Whether to weight the draws towards starters that have been served
+            less often. The alias tables are rebuilt after every len(catalog) draws, so the
+            balancing lags a little behind but sampling stays O(1) amortized.
+    """
+
+    def __init__(self, starters: list[Starter], balance_served: bool = True):
+        self.balance_served = balance_served
+        self._starters: dict[str, Starter] = {}
+        self._ids_by_context: dict[str, str] = {}
+        self._ids_by_topic: dict[str, set[str]] = {}
+        self._ids_by_difficulty: dict[str, set[str]] = {}
+        for starter in starters:
+            if starter.id in self._starters:
+                raise ValueError(f"Duplicate starter ID {starter.id!r}.")
+            self._starters[starter.id] = starter
+            self._ids_by_context.setdefault(starter.context, starter.id)
+            self._ids_by_topic.setdefault(starter.topic, set()).add(starter.id)
+            self._ids_by_difficulty.setdefault(starter.difficulty, set()).add(
+                starter.id
+            )
+        self._served = dict.fromkeys(self._starters, 0)
+        self._draws_since_rebuild = 0
+        # (topic, difficulty) -> candidates and the alias table over them
+        self._samplers: dict[tuple, tuple[list[Starter], AliasSampler]] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path: str = STARTER_CATALOG_PATH, **kwargs) -> "StarterCatalog":
+        """
+        Loads the starters from a JSON file holding a list of objects with the fields of Starter.
+        Relative paths are resolved against the directory of this module.
+        """
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+        with open(path, encoding="utf-8") as file:
+            return cls([Starter(**data) for data in json.load(file)], **kwargs)
+
+    def __len__(self):
+        return len(self._starters)
+
+    def __iter__(self) -> Iterator[Starter]:
+        return iter(self._starters.values())
+
+    def __contains__(self, starter_id):
+        return starter_id in self._starters
+
+    def __getitem__(self, starter_id: str) -> Starter:
+        return self._starters[starter_id]
+
+    def get(self, starter_id: str | None) -> Starter | None:
+        return self._starters.get(starter_id)
+
+    def id_for_context(self, context: str | None) -> str | None:
+        """
+        Returns the ID of the starter with the given context, if there is one.
+        """
+        return self._ids_by_context.get(context)
+
+    @property
+    def topics(self) -> list[str]:
+        return sorted(self._ids_by_topic)
+
+    @property
+    def difficulties(self) -> list[str]:
+        return sorted(self._ids_by_difficulty)
+
+    def select(
+        self, topic: str | None = None, difficulty: str | None = None
+    ) -> list[Starter]:
+        """
+        Returns the starters matching the topic and the difficulty, in catalog order. None
+        matches any value.
+        """
+        ids = None
+        for index, value in (
+            (self._ids_by_topic, topic),
+            (self._ids_by_difficulty, difficulty),
+        ):
+            if value is not None:
+                matching = index.get(value, set())
+                ids = matching if ids is None else ids & matching
+        if ids is None:
+            return list(self._starters.values())
+        return [starter for starter in self._starters.values() if starter.id in ids]
+
+    def sample(
+        self,
+        topic: str | None = None,
+        difficulty: str | None = None,
+        rng: random.Random | None = None,
+    ) -> Starter:
+        """
+        Draws a starter matching the topic and the difficulty and records it as served.
+
+        Raises:
+            LookupError: If no starter matches.
+        """
+        key = (topic, difficulty)
+        with self._lock:
+            if self._draws_since_rebuild >= len(self._starters):
+                self._samplers.clear()
+                self._draws_since_rebuild = 0
+            entry = self._samplers.get(key)
+            if entry is None:
+                candidates = self.select(topic, difficulty)
+                if not candidates:
+                    raise LookupError(
+                        f"No starter with topic {topic!r} and difficulty {difficulty!r}."
+                    )
+                entry = self._samplers[key] = (
+                    candidates,
+                    AliasSampler([self._weight(starter) for starter in candidates]),
+                )
+            candidates, sampler = entry
+            starter = candidates[sampler.sample(rng or random)]
+            self._served[starter.id] += 1
+            self._draws_since_rebuild += 1
+        return starter
+
+    def _weight(self, starter: Starter) -> float:
+        if not self.balance_served:
+            return starter.weight
+        return starter.weight / (1 + self._served[starter.id])
+
+    def served_counts(self) -> dict[str, int]:
+        """
+        Returns how often every starter has been served by this process.
+        """
+        with self._lock:
+            return dict(self._served)
+
+
+@lru_cache(maxsize=None)
+def get_starter_catalog() -> StarterCatalog:
+    """
+    Returns the process-wide StarterCatalog loaded from config.STARTER_CATALOG_PATH.
+    """
+    return StarterCatalog.from_file(balance_served=STARTER_CATALOG_BALANCED)
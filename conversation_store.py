@@ -0,0 +1,177 @@
+"""
+This module keeps the state of running conversations outside of the process serving them.
+
+Conversations are stored as binary snapshots (Conversation.to_bytes) under their
+conversation_id, together with a version number. Saving checks the version the conversation was
+loaded with, so when two workers handle the same session at once, the second write is rejected
+instead of silently dropping a message. MemoryConversationStore serves a single process, e.g. in
+tests; MongoConversationStore lets any number of worker processes serve any session.
+"""
+
+import asyncio
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from classes import Conversation
+from config import (
+    CONVERSATION_STORE_MAX_SESSIONS,
+    CONVERSATION_STORE_TTL_SECONDS,
+)
+
+
+class ConversationConflict(Exception):
+    """
+    Raised when a conversation was changed by someone else since it was loaded.
+    """
+
+
+class ConversationStore(ABC):
+    """
+    This class defines the interface of a conversation store.
+    """
+
+    @abstractmethod
+    async def load(self, conversation_id: str) -> tuple[Conversation, int] | None:
+        """
+        Returns the conversation and its version, or None if there is no such conversation.
+        """
+
+    @abstractmethod
+    async def save(self, conversation: Conversation, version: int) -> int:
+        """
+        Stores the conversation, which was loaded at `version`, 0 for a new conversation.
+
+        Returns:
+            int: The new version.
+
+        Raises:
+            ConversationConflict: If the stored version is not `version` anymore.
+        """
+
+    @abstractmethod
+    async def delete(self, conversation_id: str):
+        """
+        Removes the conversation, if it exists.
+        """
+
+
+class MemoryConversationStore(ConversationStore):
+    """
+    This class stores the conversations in the memory of the process. The least recently used
+    ones are dropped beyond `max_sessions`, and any older than `ttl` seconds.
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = CONVERSATION_STORE_MAX_SESSIONS,
+        ttl: float = CONVERSATION_STORE_TTL_SECONDS,
+    ):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        # conversation_id -> (snapshot, version, time of the last save)
+        self._sessions: OrderedDict[str, tuple[bytes, int, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def load(self, conversation_id):
+        with self._lock:
+            entry = self._sessions.get(conversation_id)
+            if entry is None or time.monotonic() - entry[2] > self.ttl:
+                self._sessions.pop(conversation_id, None)
+                return None
+            self._sessions.move_to_end(conversation_id)
+        snapshot, version, _ = entry
+        return Conversation.from_bytes(snapshot), version
+
+    async def save(self, conversation, version):
+        snapshot = conversation.to_bytes()
+        with self._lock:
+            entry = self._sessions.get(conversation.conversation_id)
+            if (entry[1] if entry is not None else 0) != version:
+                raise ConversationConflict(conversation.conversation_id)
+            self._sessions[conversation.conversation_id] = (
+                snapshot,
+                version + 1,
+                time.monotonic(),
+            )
+            self._sessions.move_to_end(conversation.conversation_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return version + 1
+
+    async def delete(self, conversation_id):
+        with self._lock:
+            self._sessions.pop(conversation_id, None)
+
+
+class MongoConversationStore(ConversationStore):
+    """
+    This class stores the conversations in a MongoDB collection. Every save is a single atomic
+    update conditioned on the version, and MongoDB removes sessions idle for `ttl` seconds.
+    pymongo blocks, so its calls run in the default thread pool.
+    """
+
+    def __init__(
+        self,
+        uri: str | None = None,
+        client=None,
+        ttl: float = CONVERSATION_STORE_TTL_SECONDS,
+    ):
+        # An existing client (e.g. mongomock.MongoClient()) can be passed instead of a uri
+        if client is None:
+            from pymongo import MongoClient
+
+            client = MongoClient(uri)
+        self.collection = client["chatbot_database"]["sessions"]
+        self.collection.create_index("updated_at", expireAfterSeconds=int(ttl))
+
+    async def load(self, conversation_id):
+        document = await asyncio.to_thread(
+            self.collection.find_one, {"_id": conversation_id}
+        )
+        if document is None:
+            return None
+        return Conversation.from_bytes(document["snapshot"]), document["version"]
+
+    async def save(self, conversation, version):
+        from pymongo.errors import DuplicateKeyError
+
+        fields = {
+            "snapshot": conversation.to_bytes(),
+            "version": version + 1,
+            "updated_at": datetime.now(timezone.utc),
+        }
+        try:
+            if version == 0:
+                await asyncio.to_thread(
+                    self.collection.insert_one,
+                    {"_id": conversation.conversation_id, **fields},
+                )
+                return version + 1
+            result = await asyncio.to_thread(
+                self.collection.update_one,
+                {"_id": conversation.conversation_id, "version": version},
+                {"$set": fields},
+            )
+        except DuplicateKeyError as error:
+            raise ConversationConflict(conversation.conversation_id) from error
+        if result.matched_count == 0:
+            raise ConversationConflict(conversation.conversation_id)
+        return version + 1
+
+    async def delete(self, conversation_id):
+        await asyncio.to_thread(self.collection.delete_one, {"_id": conversation_id})
+
+
+@lru_cache(maxsize=None)
+def get_conversation_store(uri: str | None = None) -> ConversationStore:
+    """
+    Returns the process-wide store: in MongoDB if a connection string is given, in memory
+    otherwise.
+    """
+    if uri is None:
+        return MemoryConversationStore()
+    return MongoConversationStore(uri)
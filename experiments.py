@@ -0,0 +1,250 @@
+"""
+This module runs the online A/B test of the agent's model, temperature and instructions.
+
+Every new conversation is assigned to an arm by Thompson sampling. When the conversation ends,
+its reward combines the quality rating of the agent with the mean turn latency and the token
+cost of the agent turns, so traffic drifts to the cheapest and fastest arm that still performs
+well. The arm and its measured results are stored on the conversation, and with it in MongoDB,
+from where every process replays them into its posteriors when it starts. Until it restarts,
+a process only learns from the conversations it rated itself.
+"""
+
+import random
+import threading
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+from typing import Iterable
+
+from config import (
+    DEFAULT_INSTRUCTIONS_VERSION,
+    EXPERIMENT_ARMS,
+    EXPERIMENT_COST_SCALE_USD,
+    EXPERIMENT_COST_WEIGHT,
+    EXPERIMENT_LATENCY_SCALE_SECONDS,
+    EXPERIMENT_LATENCY_WEIGHT,
+    EXPERIMENT_NAME,
+    MODEL_PRICES_PER_1K_TOKENS,
+)
+from mongodb_manager import get_persistence
+
+
+@dataclass(frozen=True)
+class Arm:
+    """
+    This class holds the settings the conversations of one arm are served with.
+    """
+
+    id: str
+    model: str
+    temperature: float
+    instructions_version: str = DEFAULT_INSTRUCTIONS_VERSION
+
+
+class _ArmStats:
+    __slots__ = ("alpha", "beta", "conversations", "reward_sum")
+
+    def __init__(self):
+        # Beta(1, 1) prior on the mean reward
+        self.alpha = 1.0
+        self.beta = 1.0
+        self.conversations = 0
+        self.reward_sum = 0.0
+
+
+def completion_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """
+    Returns the price in USD of the tokens, or 0.0 for models without a known price.
+    """
+    prompt_price, completion_price = MODEL_PRICES_PER_1K_TOKENS.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+class Experiment:
+    """
+    This class assigns conversations to arms and learns from their outcomes.
+
+    Args:
+        arms (list[Arm]): The arms to choose from.
+        name (str): The name stored with every assigned conversation.
+        latency_weight (float): How much a mean turn latency of `latency_scale` seconds or more
+            lowers the reward.
+        cost_weight (float): How much a cost of `cost_scale` USD or more lowers the reward.
+        rng (random.Random | None): The source of randomness of the assignments.
+    """
+
+    def __init__(
+        self,
+        arms: list[Arm],
+        name: str = EXPERIMENT_NAME,
+        latency_weight: float = EXPERIMENT_LATENCY_WEIGHT,
+        latency_scale: float = EXPERIMENT_LATENCY_SCALE_SECONDS,
+        cost_weight: float = EXPERIMENT_COST_WEIGHT,
+        cost_scale: float = EXPERIMENT_COST_SCALE_USD,
+        rng: random.Random | None = None,
+    ):
+        if not arms:
+            raise ValueError("An experiment needs at least one arm.")
+        self.name = name
+        self.arms = {arm.id: arm for arm in arms}
+        self.latency_weight = latency_weight
+        self.latency_scale = latency_scale
+        self.cost_weight = cost_weight
+        self.cost_scale = cost_scale
+        self._rng = rng or random.Random()
+        self._stats = {arm_id: _ArmStats() for arm_id in self.arms}
+        self._lock = threading.Lock()
+
+    def assign(self, conversation) -> Arm:
+        """
+        Draws the arm of a new conversation and stores it on the conversation.
+
+        Returns:
+            Arm: The arm whose sampled mean reward is the highest.
+        """
+        with self._lock:
+            arm_id = max(
+                self._stats,
+                key=lambda arm_id: self._rng.betavariate(
+                    self._stats[arm_id].alpha, self._stats[arm_id].beta
+                ),
+            )
+        arm = self.arms[arm_id]
+        conversation.instructions_version = arm.instructions_version
+        conversation.experiment = {
+            "name": self.name,
+            "arm": arm.id,
+            "model": arm.model,
+            "temperature": arm.temperature,
+            "instructions_version": arm.instructions_version,
+            "turns": 0,
+            "latency_seconds": 0.0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "quality": None,
+            "reward": None,
+        }
+        return arm
+
+    def arm_of(self, conversation) -> Arm | None:
+        """
+        Returns the arm of a conversation of this experiment.
+        """
+        experiment = conversation.experiment
+        if experiment is None or experiment["name"] != self.name:
+            return None
+        return self.arms.get(experiment["arm"])
+
+    @staticmethod
+    def record_turn(
+        conversation,
+        latency_seconds: float,
+        prompt_tokens: int,
+        completion_tokens: int,
+    ):
+        """
+        Adds the latency and the token usage of an agent turn to the conversation's results.
+        """
+        experiment = conversation.experiment
+        if experiment is None:
+            return
+        experiment["turns"] += 1
+        experiment["latency_seconds"] += latency_seconds
+        experiment["prompt_tokens"] += prompt_tokens
+        experiment["completion_tokens"] += completion_tokens
+
+    def reward(self, experiment: dict, quality: float) -> float:
+        """
+        Returns the reward in [0, 1] of a conversation's results with the given quality in [0, 1].
+        """
+        mean_latency = experiment["latency_seconds"] / max(experiment["turns"], 1)
+        cost = completion_cost(
+            experiment["model"],
+            experiment["prompt_tokens"],
+            experiment["completion_tokens"],
+        )
+        reward = (
+            quality
+            - self.latency_weight * min(mean_latency / self.latency_scale, 1.0)
+            - self.cost_weight * min(cost / self.cost_scale, 1.0)
+        )
+        return min(max(reward, 0.0), 1.0)
+
+    def record_outcome(self, conversation, quality: float | None) -> float | None:
+        """
+        Scores a finished conversation and updates its arm.
+
+        Args:
+            conversation (Conversation): A conversation assigned by this experiment.
+            quality (float | None): The quality rating of the agent in [0, 1], or None if it
+                could not be rated, in which case the arm is not updated.
+
+        Returns:
+            float | None: The reward, also stored on the conversation.
+        """
+        if self.arm_of(conversation) is None or quality is None:
+            return None
+        experiment = conversation.experiment
+        experiment["quality"] = quality
+        experiment["reward"] = self.reward(experiment, quality)
+        self._update(experiment["arm"], experiment["reward"])
+        return experiment["reward"]
+
+    def restore(self, results: Iterable[dict]):
+        """
+        Adds the results of stored conversations per arm, e.g. after a restart. Unknown arms
+        are skipped.
+
+        Args:
+            results (Iterable[dict]): The `arm`, the number of rated `conversations` and their
+                `reward_sum`, as returned by MongoPersistence.experiment_results.
+        """
+        for result in results:
+            if result["arm"] in self.arms:
+                self._update(
+                    result["arm"], result["reward_sum"], result["conversations"]
+                )
+
+    def _update(self, arm_id: str, reward: float, conversations: int = 1):
+        # Fractional Bernoulli update of the Beta posterior, by the sum of the rewards of the
+        # conversations
+        with self._lock:
+            stats = self._stats[arm_id]
+            stats.alpha += reward
+            stats.beta += conversations - reward
+            stats.conversations += conversations
+            stats.reward_sum += reward
+
+    def stats(self) -> list[dict]:
+        """
+        Returns the settings, the number of rated conversations and the mean reward of every arm.
+        """
+        with self._lock:
+            return [
+                {
+                    **asdict(self.arms[arm_id]),
+                    "conversations": stats.conversations,
+                    "mean_reward": (
+                        stats.reward_sum / stats.conversations
+                        if stats.conversations
+                        else None
+                    ),
+                }
+                for arm_id, stats in self._stats.items()
+            ]
+
+
+@lru_cache(maxsize=None)
+def get_experiment(mongo_uri: str | None = None) -> Experiment:
+    """
+    Returns the process-wide Experiment over config.EXPERIMENT_ARMS, restored from the
+    conversations saved in the given MongoDB if any.
+    """
+    experiment = Experiment([Arm(**arm) for arm in EXPERIMENT_ARMS])
+    if mongo_uri is not None:
+        try:
+            experiment.restore(
+                get_persistence(mongo_uri).experiment_results(experiment.name)
+            )
+        except Exception as error:  # pylint: disable=broad-except
+            print(f"Failed to restore the experiment from MongoDB: {error}")
+    return experiment
@@ -0,0 +1,289 @@
+"""
+This module extracts per-turn features from the conversations stored by MongoPersistence.
+
+Conversations are read from the collection in chunks in _id order. Worker processes turn every
+chunk into a columnar batch of turns: message lengths, how much of the previous message a reply
+reflects, the share of questions, and lexicon-based sentiment and openness proxies. All features
+are computed with Arrow compute kernels and NumPy over the whole chunk at once, never message by
+message. The batches are appended to a Parquet file, so memory use stays flat however many turns
+there are.
+
+Usage:
+    python feature_extraction.py MONGO_URI --output features.parquet [--workers 8]
+"""
+
+import argparse
+import itertools
+import multiprocessing
+import time
+from collections import deque
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from config import FEATURE_EXTRACTION_CHUNK_SIZE, FEATURE_EXTRACTION_WORKERS
+from mongodb_manager import get_persistence
+
+WORD_SEPARATORS = r"[^\w']+"
+
+# Small lexicons for proxies of sentiment and of how much the speaker opens up
+# fmt: off
+FIRST_PERSON_WORDS = ("i", "i'm", "i've", "i'd", "i'll", "me", "my", "mine", "myself")
+EMOTION_WORDS = (
+    "feel", "feeling", "feelings", "felt", "afraid", "alone", "angry", "anxious",
+    "ashamed", "burnt", "exhausted", "frustrated", "guilty", "happy", "hurt", "lonely",
+    "lost", "miss", "nervous", "overwhelmed", "sad", "scared", "stressed", "stuck",
+    "tired", "trapped", "upset", "worried",
+)
+POSITIVE_WORDS = (
+    "glad", "good", "great", "happy", "hope", "love", "nice", "relieved", "thanks",
+    "better", "fun", "calm", "excited", "enjoy", "enjoyed", "refreshing", "wonderful",
+)
+NEGATIVE_WORDS = (
+    "bad", "hard", "hate", "sad", "tired", "angry", "lonely", "stressed", "worried",
+    "upset", "awful", "terrible", "stuck", "trapped", "lost", "hurt", "afraid", "worse",
+)
+# fmt: on
+
+SCHEMA = pa.schema(
+    [
+        ("conversation_id", pa.string()),
+        ("starter_id", pa.dictionary(pa.int32(), pa.string())),
+        ("arm", pa.dictionary(pa.int32(), pa.string())),
+        ("turn", pa.int16()),
+        ("speaker", pa.dictionary(pa.int8(), pa.string())),
+        ("characters", pa.int32()),
+        ("words", pa.int32()),
+        ("questions", pa.int16()),
+        ("question_ratio", pa.float32()),
+        ("reflection_overlap", pa.float32()),
+        ("first_person_ratio", pa.float32()),
+        ("emotion_ratio", pa.float32()),
+        ("sentiment", pa.float32()),
+    ]
+)
+
+
+def _ratio(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    return np.divide(
+        numerator,
+        denominator,
+        out=np.zeros(len(numerator), dtype=np.float32),
+        where=denominator > 0,
+    )
+
+
+def _lexicon_counts(
+    words: pa.Array, parents: np.ndarray, num_messages: int, lexicon: tuple
+) -> np.ndarray:
+    matches = pc.is_in(words, value_set=pa.array(lexicon)).to_numpy(
+        zero_copy_only=False
+    )
+    return np.bincount(parents[matches], minlength=num_messages)
+
+
+def _reflection_overlap(
+    codes: np.ndarray,
+    parents: np.ndarray,
+    first_turns: np.ndarray,
+    num_messages: int,
+) -> np.ndarray:
+    """
+    Returns, for every message, the share of its distinct words that also occur in the message
+    before it in the same conversation. The first message of a conversation has no overlap.
+    """
+    vocabulary = int(codes.max()) + 1 if len(codes) else 1
+    # Distinct (message, word) pairs, as one integer key each
+    keys = np.unique(parents.astype(np.int64) * vocabulary + codes)
+    messages = keys // vocabulary
+    distinct_words = np.bincount(messages, minlength=num_messages)
+    # The same words shifted onto the next message, unless that starts a new conversation
+    has_reply = messages + 1 < num_messages
+    has_reply[has_reply] = ~first_turns[messages[has_reply] + 1]
+    shifted = keys[has_reply] + vocabulary
+    shared = np.intersect1d(keys, shifted, assume_unique=True)
+    shared_words = np.bincount(shared // vocabulary, minlength=num_messages)
+    return _ratio(shared_words, distinct_words)
+
+
+def extract_features(chunk: list[dict]) -> pa.RecordBatch:
+    """
+    Computes the features of every turn of a chunk of stored conversations.
+
+    Args:
+        chunk (list[dict]): Documents with the conversation_id, starter_id, arm and messages of
+            a conversation each.
+
+    Returns:
+        pa.RecordBatch: One row per message, with the columns of SCHEMA.
+    """
+    message_lists = pa.array(
+        [document["messages"] for document in chunk], pa.list_(pa.string())
+    )
+    lengths = pc.list_value_length(message_lists).to_numpy(zero_copy_only=False)
+    messages = pc.list_flatten(message_lists)
+    num_messages = len(messages)
+    conversation_index = np.repeat(np.arange(len(chunk)), lengths)
+    turns = np.arange(num_messages) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    first_turns = turns == 0
+
+    words = pc.split_pattern_regex(pc.utf8_lower(messages), pattern=WORD_SEPARATORS)
+    parents = pc.list_parent_indices(words).to_numpy()
+    words = pc.list_flatten(words)
+    non_empty = pc.not_equal(words, "").to_numpy(zero_copy_only=False)
+    words, parents = words.filter(pa.array(non_empty)), parents[non_empty]
+    codes = pc.dictionary_encode(words).indices.to_numpy(zero_copy_only=False)
+    word_counts = np.bincount(parents, minlength=num_messages)
+
+    sentences = np.maximum(
+        pc.count_substring_regex(messages, pattern=r"[.!?]+").to_numpy(), 1
+    )
+    questions = pc.count_substring_regex(messages, pattern=r"\?+").to_numpy()
+    positive = _lexicon_counts(words, parents, num_messages, POSITIVE_WORDS)
+    negative = _lexicon_counts(words, parents, num_messages, NEGATIVE_WORDS)
+
+    def per_message(key: str) -> pa.Array:
+        return pa.array([document[key] for document in chunk], pa.string()).take(
+            pa.array(conversation_index)
+        )
+
+    return pa.RecordBatch.from_arrays(
+        [
+            per_message("conversation_id"),
+            per_message("starter_id").dictionary_encode(),
+            per_message("arm").dictionary_encode(),
+            pa.array(turns, pa.int16()),
+            # The agent sends the first message of every conversation
+            pa.DictionaryArray.from_arrays(
+                pa.array(turns % 2, pa.int8()), pa.array(["CHATBOT", "USER"])
+            ),
+            pa.array(pc.utf8_length(messages).to_numpy(), pa.int32()),
+            pa.array(word_counts, pa.int32()),
+            pa.array(questions, pa.int16()),
+            pa.array(_ratio(questions, sentences)),
+            pa.array(_reflection_overlap(codes, parents, first_turns, num_messages)),
+            pa.array(
+                _ratio(
+                    _lexicon_counts(words, parents, num_messages, FIRST_PERSON_WORDS),
+                    word_counts,
+                )
+            ),
+            pa.array(
+                _ratio(
+                    _lexicon_counts(words, parents, num_messages, EMOTION_WORDS),
+                    word_counts,
+                )
+            ),
+            pa.array(_ratio(positive - negative, word_counts)),
+        ],
+        schema=SCHEMA,
+    )
+
+
+def iter_chunks(collection, chunk_size: int, limit: int | None = None):
+    """
+    Streams the finished conversations of the collection in _id order.
+
+    Yields:
+        list[dict]: Chunks of documents with the fields extract_features needs.
+    """
+    cursor = collection.find(
+        {"conversation.finished": True},
+        projection={
+            "conversation.conversation_id": 1,
+            "conversation.messages": 1,
+            "conversation.starter_id": 1,
+            "conversation.experiment.arm": 1,
+        },
+        sort=[("_id", 1)],
+    ).batch_size(chunk_size)
+    if limit is not None:
+        cursor = cursor.limit(limit)
+    while documents := list(itertools.islice(cursor, chunk_size)):
+        yield [
+            {
+                # Conversations stored before they had an ID fall back to the document's
+                "conversation_id": document["conversation"].get("conversation_id")
+                or str(document["_id"]),
+                "starter_id": document["conversation"].get("starter_id"),
+                "arm": (document["conversation"].get("experiment") or {}).get("arm"),
+                "messages": document["conversation"]["messages"],
+            }
+            for document in documents
+        ]
+
+
+def run(collection, output: str, chunk_size: int, workers: int, limit=None) -> dict:
+    """
+    Extracts the features of the collection's conversations into a Parquet file.
+
+    At most two chunks per worker are in flight, so reading from MongoDB cannot run ahead of
+    the workers and fill up the memory. The workers are spawned rather than forked, so they do
+    not inherit the MongoDB client's sockets and background threads.
+
+    Returns:
+        dict: The numbers of conversations and turns written and the elapsed seconds.
+    """
+    started = time.monotonic()
+    conversations = turns = 0
+    with (
+        multiprocessing.get_context("spawn").Pool(workers) as pool,
+        pq.ParquetWriter(output, SCHEMA) as writer,
+    ):
+        pending = deque()
+
+        def write_oldest():
+            nonlocal turns
+            batch = pending.popleft().get()
+            writer.write_batch(batch)
+            turns += batch.num_rows
+
+        for chunk in iter_chunks(collection, chunk_size, limit):
+            if len(pending) >= 2 * workers:
+                write_oldest()
+            pending.append(pool.apply_async(extract_features, (chunk,)))
+            conversations += len(chunk)
+        while pending:
+            write_oldest()
+    return {
+        "conversations": conversations,
+        "turns": turns,
+        "elapsed_s": time.monotonic() - started,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("mongo_uri", help="MongoDB connection string.")
+    parser.add_argument("--output", default="features.parquet")
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=FEATURE_EXTRACTION_CHUNK_SIZE,
+        help="Conversations per batch.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=FEATURE_EXTRACTION_WORKERS or multiprocessing.cpu_count(),
+    )
+    parser.add_argument("--limit", type=int, help="Stop after this many conversations.")
+    args = parser.parse_args()
+
+    report = run(
+        get_persistence(args.mongo_uri).conversations,
+        args.output,
+        args.chunk_size,
+        args.workers,
+        args.limit,
+    )
+    print(
+        f"{report['conversations']} conversations, {report['turns']} turns in "
+        f"{report['elapsed_s']:.1f} s ({report['turns'] / report['elapsed_s']:.0f} turns/s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
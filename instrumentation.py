@@ -0,0 +1,310 @@
+"""
+This module measures where the time and the tokens of a turn go.
+
+Code paths are wrapped in named timing spans, the token usage of every completion is counted
+per model and starter, and events such as the outcomes of parsing model output are counted by
+name. The aggregates are exported periodically as log lines, as a Prometheus
+text file or as JSON lines.
+"""
+
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+
+from config import (
+    METRICS_EXPORT_INTERVAL_SECONDS,
+    METRICS_EXPORT_PATH,
+    METRICS_EXPORTER,
+)
+
+# Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+logger = logging.getLogger(__name__)
+
+
+class _SpanStats:
+    __slots__ = ("count", "total", "minimum", "maximum", "bucket_counts")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = float("inf")
+        self.maximum = 0.0
+        self.bucket_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.minimum = min(self.minimum, seconds)
+        self.maximum = max(self.maximum, seconds)
+        self.bucket_counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+
+class Metrics:
+    """
+    This class aggregates span durations, token usage and event counts in memory.
+    """
+
+    def __init__(self):
+        self._spans: dict[tuple, _SpanStats] = {}
+        self._tokens: dict[tuple[str, str], list[int]] = {}
+        self._counters: dict[tuple, int] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, seconds: float, **labels):
+        """
+        Records one duration of the named span.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            stats = self._spans.get(key)
+            if stats is None:
+                stats = self._spans[key] = _SpanStats()
+            stats.add(seconds)
+
+    @contextmanager
+    def span(self, name: str, **labels):
+        """
+        Times the enclosed block, including blocks that raise.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def add_tokens(
+        self, model: str, starter: str, prompt_tokens: int, completion_tokens: int
+    ):
+        """
+        Records the token usage of one completion.
+        """
+        with self._lock:
+            totals = self._tokens.setdefault((model, starter), [0, 0, 0])
+            totals[0] += 1
+            totals[1] += prompt_tokens
+            totals[2] += completion_tokens
+
+    def increment(self, name: str, amount: int = 1, **labels):
+        """
+        Adds to the named counter.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def snapshot(self) -> dict:
+        """
+        Returns a copy of the aggregates that can be serialized as JSON.
+        """
+        with self._lock:
+            return {
+                "spans": [
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "count": stats.count,
+                        "sum": stats.total,
+                        "min": stats.minimum,
+                        "max": stats.maximum,
+                        "buckets": list(stats.bucket_counts),
+                    }
+                    for (name, labels), stats in self._spans.items()
+                ],
+                "tokens": [
+                    {
+                        "model": model,
+                        "starter": starter,
+                        "calls": calls,
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                    }
+                    for (model, starter), (
+                        calls,
+                        prompt_tokens,
+                        completion_tokens,
+                    ) in self._tokens.items()
+                ],
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in self._counters.items()
+                ],
+            }
+
+
+metrics = Metrics()
+span = metrics.span
+
+
+class LogExporter:
+    """
+    This class writes one log line per span, per model/starter token total and per counter.
+    """
+
+    def export(self, snapshot: dict):
+        for stats in snapshot["spans"]:
+            logger.info(
+                "span=%s labels=%s count=%d mean_ms=%.2f max_ms=%.2f",
+                stats["name"],
+                stats["labels"],
+                stats["count"],
+                1000 * stats["sum"] / stats["count"],
+                1000 * stats["max"],
+            )
+        for totals in snapshot["tokens"]:
+            logger.info(
+                "tokens model=%s starter=%s calls=%d prompt=%d completion=%d",
+                totals["model"],
+                totals["starter"],
+                totals["calls"],
+                totals["prompt_tokens"],
+                totals["completion_tokens"],
+            )
+        for counter in snapshot["counters"]:
+            logger.info(
+                "counter=%s labels=%s value=%d",
+                counter["name"],
+                counter["labels"],
+                counter["value"],
+            )
+
+
+def _prometheus_labels(labels: dict) -> str:
+    def escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return ",".join(f'{key}="{escape(value)}"' for key, value in labels.items())
+
+
+class PrometheusExporter:
+    """
+    This class renders the aggregates in the Prometheus text exposition format and writes them to
+    a file, e.g. for the node exporter's textfile collector.
+    """
+
+    def __init__(self, path: str = "metrics.prom"):
+        self.path = path
+
+    @staticmethod
+    def render(snapshot: dict) -> str:
+        lines = [
+            "# HELP reflective_listening_span_seconds Duration of instrumented code paths.",
+            "# TYPE reflective_listening_span_seconds histogram",
+        ]
+        for stats in snapshot["spans"]:
+            labels = {"span": stats["name"], **stats["labels"]}
+            cumulative = 0
+            for bound, count in zip(
+                (*map(str, LATENCY_BUCKETS), "+Inf"), stats["buckets"]
+            ):
+                cumulative += count
+                bucket_labels = _prometheus_labels({**labels, "le": bound})
+                lines.append(
+                    f"reflective_listening_span_seconds_bucket{{{bucket_labels}}} {cumulative}"
+                )
+            rendered = _prometheus_labels(labels)
+            lines.append(
+                f"reflective_listening_span_seconds_sum{{{rendered}}} {stats['sum']}"
+            )
+            lines.append(
+                f"reflective_listening_span_seconds_count{{{rendered}}} {stats['count']}"
+            )
+        lines += [
+            "# HELP reflective_listening_tokens_total Tokens used by completions.",
+            "# TYPE reflective_listening_tokens_total counter",
+        ]
+        for totals in snapshot["tokens"]:
+            for kind in ("prompt", "completion"):
+                rendered = _prometheus_labels(
+                    {
+                        "model": totals["model"],
+                        "starter": totals["starter"],
+                        "kind": kind,
+                    }
+                )
+                lines.append(
+                    f"reflective_listening_tokens_total{{{rendered}}} {totals[f'{kind}_tokens']}"
+                )
+        lines += [
+            "# HELP reflective_listening_events_total Counted events.",
+            "# TYPE reflective_listening_events_total counter",
+        ]
+        for counter in snapshot["counters"]:
+            rendered = _prometheus_labels(
+                {"event": counter["name"], **counter["labels"]}
+            )
+            lines.append(
+                f"reflective_listening_events_total{{{rendered}}} {counter['value']}"
+            )
+        return "\n".join(lines) + "\n"
+
+    def export(self, snapshot: dict):
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            file.write(self.render(snapshot))
+        # The collector must never read a half written file
+        os.replace(temporary_path, self.path)
+
+
+class JsonlExporter:
+    """
+    This class appends every snapshot as one JSON line to a file.
+    """
+
+    def __init__(self, path: str = "metrics.jsonl"):
+        self.path = path
+
+    def export(self, snapshot: dict):
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(
+                json.dumps({"timestamp": datetime.now().isoformat(), **snapshot}) + "\n"
+            )
+
+
+EXPORTERS = {
+    "log": LogExporter,
+    "prometheus": PrometheusExporter,
+    "jsonl": JsonlExporter,
+}
+
+
+@lru_cache(maxsize=None)
+def start_metrics_export(
+    exporter_name: str | None = METRICS_EXPORTER,
+    interval: float = METRICS_EXPORT_INTERVAL_SECONDS,
+) -> threading.Thread | None:
+    """
+    Starts the process-wide thread exporting the metrics every `interval` seconds.
+
+    Returns:
+        threading.Thread | None: The export thread, or None if exporting is disabled.
+    """
+    if exporter_name is None:
+        return None
+    exporter_class = EXPORTERS[exporter_name]
+    exporter = (
+        exporter_class(METRICS_EXPORT_PATH)
+        if METRICS_EXPORT_PATH and exporter_class is not LogExporter
+        else exporter_class()
+    )
+
+    def export_periodically():
+        while True:
+            time.sleep(interval)
+            try:
+                exporter.export(metrics.snapshot())
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Failed to export metrics.")
+
+    thread = threading.Thread(
+        target=export_periodically, name="metrics-export", daemon=True
+    )
+    thread.start()
+    return thread
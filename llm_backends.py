@@ -0,0 +1,409 @@
+"""
+This module holds the backends LLMAgent and AsyncLLMAgent send their chat completion requests to.
+
+OpenAIBackend talks to the OpenAI API. FakeBackend is a deterministic in-process stand-in with
+configurable latency, error rate and streaming speed, used to measure the app without paying
+for API calls. RecordedBackend answers with the agent messages of a saved conversation instead,
+to replay it.
+
+openai and httpx take a good part of a second to import, so they are imported on first use.
+"""
+
+import asyncio
+import hashlib
+import json
+import math
+import random
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, AsyncIterator, Callable, Iterable, Iterator
+
+from config import (
+    LLM_MAX_CONNECTIONS,
+    LLM_MAX_KEEPALIVE_CONNECTIONS,
+    LLM_TIMEOUT_SECONDS,
+)
+
+if TYPE_CHECKING:
+    import openai
+
+
+@dataclass
+class Completion:
+    """
+    This class holds the text of a completion and its token usage.
+    """
+
+    text: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+class LLMBackend(ABC):
+    """
+    This class defines the interface of a chat completion backend.
+    """
+
+    @abstractmethod
+    def complete(
+        self,
+        messages: list[dict],
+        model: str,
+        temperature: float,
+        max_tokens: int | None = None,
+        response_format: dict | None = None,
+    ) -> Completion:
+        """
+        Generates a completion for the chat messages. A response_format, as returned by
+        response_parsing.response_format_for, requests JSON output.
+        """
+
+    @abstractmethod
+    def stream(
+        self,
+        messages: list[dict],
+        model: str,
+        temperature: float,
+        on_usage: Callable[[int, int], None] | None = None,
+        response_format: dict | None = None,
+    ) -> Iterator[str]:
+        """
+        Generates a completion for the chat messages, yielding the text as it is produced.
+        Once the stream is exhausted, on_usage is called with the prompt and completion tokens.
+        """
+
+    @abstractmethod
+    async def acomplete(
+        self,
+        messages: list[dict],
+        model: str,
+        temperature: float,
+        max_tokens: int | None = None,
+        response_format: dict | None = None,
+    ) -> Completion:
+        """
+        Asynchronous variant of complete.
+        """
+
+    @abstractmethod
+    def astream(
+        self,
+        messages: list[dict],
+        model: str,
+        temperature: float,
+        on_usage: Callable[[int, int], None] | None = None,
+        response_format: dict | None = None,
+    ) -> AsyncIterator[str]:
+        """
+        Asynchronous variant of stream.
+        """
+
+    async def aclose(self):
+        """
+        Releases the resources held by the backend.
+        """
+
+
+class OpenAIBackend(LLMBackend):
+    """
+    This class sends requests to the OpenAI API. Synchronous requests go through the module-level
+    openai client; asynchronous ones share one pooled HTTP client with keep-alive.
+    """
+
+    def __init__(
+        self,
+        api_key: str | None = None,
+        max_connections: int = LLM_MAX_CONNECTIONS,
+        max_keepalive_connections: int = LLM_MAX_KEEPALIVE_CONNECTIONS,
+        timeout: float = LLM_TIMEOUT_SECONDS,
+    ):
+        self.api_key = api_key
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.timeout = timeout
+        self._async_client: "openai.AsyncOpenAI | None" = None
+
+    def _get_async_client(self) -> "openai.AsyncOpenAI":
+        """
+        Lazily creates the shared client. Retries are handled by the agent, so the SDK's own
+        retry loop is disabled.
+        """
+        if self._async_client is None:
+            import httpx
+            import openai
+
+            http_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive_connections,
+                ),
+                timeout=httpx.Timeout(self.timeout),
+            )
+            self._async_client = openai.AsyncOpenAI(
+                api_key=self.api_key or openai.api_key,
+                http_client=http_client,
+                timeout=self.timeout,
+                max_retries=0,
+            )
+        return self._async_client
+
+    @staticmethod
+    def _options(max_tokens, response_format) -> dict:
+        options = {}
+        if max_tokens is not None:
+            options["max_tokens"] = max_tokens
+        if response_format is not None:
+            options["response_format"] = response_format
+        return options
+
+    def complete(
+        self, messages, model, temperature, max_tokens=None, response_format=None
+    ):
+        import openai
+
+        response = openai.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            **self._options(max_tokens, response_format),
+        )
+        return Completion(
+            response.choices[0].message.content,
+            response.usage.prompt_tokens if response.usage else 0,
+            response.usage.completion_tokens if response.usage else 0,
+        )
+
+    def stream(self, messages, model, temperature, on_usage=None, response_format=None):
+        import openai
+
+        response = openai.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True},
+            **self._options(None, response_format),
+        )
+        try:
+            for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+                if chunk.usage is not None and on_usage is not None:
+                    on_usage(chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+        finally:
+            response.close()
+
+    async def acomplete(
+        self, messages, model, temperature, max_tokens=None, response_format=None
+    ):
+        response = await self._get_async_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            **self._options(max_tokens, response_format),
+        )
+        return Completion(
+            response.choices[0].message.content,
+            response.usage.prompt_tokens if response.usage else 0,
+            response.usage.completion_tokens if response.usage else 0,
+        )
+
+    async def astream(
+        self, messages, model, temperature, on_usage=None, response_format=None
+    ):
+        response = await self._get_async_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True},
+            **self._options(None, response_format),
+        )
+        try:
+            async for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+                if chunk.usage is not None and on_usage is not None:
+                    on_usage(chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+        finally:
+            await response.close()
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.close()
+            self._async_client = None
+
+
+FAKE_AGENT_RESPONSES = (
+    "Yeah, it was a strange day overall.",
+    "I don't know, it's just been a lot lately.",
+    "Honestly? I've been feeling kind of stuck.",
+    "Haha, maybe. Anyway, how have you been?",
+    "It's hard to explain, but thanks for asking.",
+)
+
+FAKE_USER_MESSAGES = (
+    "That sounds like it was a lot to take in.",
+    "So you're saying it caught you off guard?",
+    "Why don't you just talk to them about it?",
+    "It sounds like you've been carrying this for a while.",
+)
+
+FAKE_EVALUATION = (
+    "The user mirrored some of the agent's statements but often asked questions instead "
+    "of reflecting feelings."
+)
+
+
+class FakeBackend(LLMBackend):
+    """
+    This class imitates a chat completion API in-process.
+
+    Replies are chosen deterministically from the prompt: prompts asking for the agent_response
+    output format get a schema-valid {"agent_response": ...} JSON object, prompts asking for a
+    rating get a number from 1 to 10, prompts of the simulated user of self_play.py get a user
+    message, and any other prompt gets a plain text evaluation. Latency is drawn from a fixed,
+    uniform, exponential or lognormal distribution with the given mean, and requests fail with
+    openai.APIConnectionError at the given rate.
+    """
+
+    DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+
+    def __init__(
+        self,
+        latency_mean: float = 0.5,
+        latency_distribution: str = "lognormal",
+        latency_sigma: float = 0.5,
+        error_rate: float = 0.0,
+        chunk_size: int = 4,
+        chunks_per_second: float = 50.0,
+        seed: int | None = 0,
+    ):
+        if latency_distribution not in self.DISTRIBUTIONS:
+            raise ValueError(
+                f"Unknown latency distribution {latency_distribution!r}, "
+                f"expected one of {self.DISTRIBUTIONS}."
+            )
+        self.latency_mean = latency_mean
+        self.latency_distribution = latency_distribution
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.chunk_size = chunk_size
+        self.chunks_per_second = chunks_per_second
+        self._random = random.Random(seed)
+
+    def sample_latency(self) -> float:
+        """
+        Draws the latency of one request in seconds.
+        """
+        if self.latency_mean <= 0:
+            return 0.0
+        if self.latency_distribution == "fixed":
+            return self.latency_mean
+        if self.latency_distribution == "uniform":
+            return self._random.uniform(0, 2 * self.latency_mean)
+        if self.latency_distribution == "exponential":
+            return self._random.expovariate(1 / self.latency_mean)
+        # Lognormal with the requested mean
+        mu = math.log(self.latency_mean) - self.latency_sigma**2 / 2
+        return self._random.lognormvariate(mu, self.latency_sigma)
+
+    def _maybe_fail(self):
+        if self._random.random() < self.error_rate:
+            import httpx
+            import openai
+
+            raise openai.APIConnectionError(
+                message="Simulated connection error.",
+                request=httpx.Request("POST", "http://fake-backend/chat/completions"),
+            )
+
+    @staticmethod
+    def reply(messages: list[dict]) -> str:
+        """
+        Returns the deterministic reply to the chat messages.
+        """
+        prompt = messages[-1]["content"]
+        digest = int(hashlib.sha256(prompt.encode()).hexdigest(), 16)
+        if "Answer with a number only" in prompt:
+            return str(1 + digest % 10)
+        if "You play the USER" in prompt:
+            return FAKE_USER_MESSAGES[digest % len(FAKE_USER_MESSAGES)]
+        if "agent_response" not in prompt:
+            return FAKE_EVALUATION
+        return json.dumps(
+            {"agent_response": FAKE_AGENT_RESPONSES[digest % len(FAKE_AGENT_RESPONSES)]}
+        )
+
+    @staticmethod
+    def _completion(messages: list[dict], text: str) -> Completion:
+        # Roughly four characters per token, like the OpenAI tokenizers on English text
+        prompt_characters = sum(len(message["content"]) for message in messages)
+        return Completion(text, prompt_characters // 4 + 1, len(text) // 4 + 1)
+
+    def _chunks(self, text: str) -> list[str]:
+        return [
+            text[start : start + self.chunk_size]
+            for start in range(0, len(text), self.chunk_size)
+        ]
+
+    def complete(
+        self, messages, model, temperature, max_tokens=None, response_format=None
+    ):
+        time.sleep(self.sample_latency())
+        self._maybe_fail()
+        return self._completion(messages, self.reply(messages))
+
+    def stream(self, messages, model, temperature, on_usage=None, response_format=None):
+        time.sleep(self.sample_latency())
+        self._maybe_fail()
+        completion = self._completion(messages, self.reply(messages))
+        for chunk in self._chunks(completion.text):
+            yield chunk
+            time.sleep(1 / self.chunks_per_second)
+        if on_usage is not None:
+            on_usage(completion.prompt_tokens, completion.completion_tokens)
+
+    async def acomplete(
+        self, messages, model, temperature, max_tokens=None, response_format=None
+    ):
+        await asyncio.sleep(self.sample_latency())
+        self._maybe_fail()
+        return self._completion(messages, self.reply(messages))
+
+    async def astream(
+        self, messages, model, temperature, on_usage=None, response_format=None
+    ):
+        await asyncio.sleep(self.sample_latency())
+        self._maybe_fail()
+        completion = self._completion(messages, self.reply(messages))
+        for chunk in self._chunks(completion.text):
+            yield chunk
+            await asyncio.sleep(1 / self.chunks_per_second)
+        if on_usage is not None:
+            on_usage(completion.prompt_tokens, completion.completion_tokens)
+
+
+class RecordedBackend(FakeBackend):
+    """
+    This class replays the agent messages of a recorded conversation as the agent responses, in
+    order, in the agent_response output format. Other prompts are answered like by FakeBackend.
+
+    Args:
+        replies (Iterable[str]): The recorded agent messages.
+        **kwargs: The latency and streaming settings of FakeBackend.
+    """
+
+    def __init__(self, replies: Iterable[str], **kwargs):
+        kwargs.setdefault("latency_mean", 0.0)
+        super().__init__(**kwargs)
+        self._replies = iter(replies)
+
+    def reply(self, messages: list[dict]) -> str:
+        if "agent_response" not in messages[-1]["content"]:
+            return FakeBackend.reply(messages)
+        try:
+            return json.dumps({"agent_response": next(self._replies)})
+        except StopIteration:
+            raise LookupError("No recorded agent message left to replay.") from None
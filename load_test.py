@@ -0,0 +1,399 @@
+"""
+This module drives many simulated users through the conversation loop against a FakeBackend.
+
+Every simulated user repeatedly builds a conversation with ConversationBuilder and plays it to
+the end: add a user message, generate the agent response, add it. The report lists the
+p50/p95/p99 turn latency, the throughput and the memory used.
+
+With --api, the users are sessions of the service in api.py instead, served in-process on one
+event loop like by a single uvicorn worker: each one creates its conversation over HTTP and
+streams the agent replies over the WebSocket. The report then also lists the latency of the
+first streamed piece of every reply.
+
+Usage:
+    python load_test.py [--users 50] [--conversations 4] [--latency-mean 0.2] [--stream]
+    python load_test.py --async --users 1000 [--stream]
+    python load_test.py --api --users 1000 [--store-uri mongodb://localhost]
+"""
+
+import argparse
+import asyncio
+import json
+import resource
+import statistics
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from classes import AsyncLLMAgent, ConversationBuilder, LLMAgent
+from llm_backends import FakeBackend
+
+USER_MESSAGES = (
+    "That sounds like it was a lot to take in.",
+    "So you're saying it caught you off guard?",
+    "What happened next?",
+    "It sounds like you've been carrying this for a while.",
+)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """
+    Returns the value below which the given fraction of the values falls.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class LoadTestResult:
+    """
+    This class collects the turn latencies and failures of a load test.
+    """
+
+    def __init__(self):
+        self.turn_latencies: list[float] = []
+        self.first_token_latencies: list[float] = []
+        self.failed_turns = 0
+        self.conversations = 0
+        self._lock = threading.Lock()
+
+    def record_turn(self, latency: float | None):
+        """
+        Records the latency of a turn in seconds, or a failed turn when it is None.
+        """
+        with self._lock:
+            if latency is None:
+                self.failed_turns += 1
+            else:
+                self.turn_latencies.append(latency)
+
+    def record_first_token(self, latency: float):
+        """
+        Records how many seconds it took until the first piece of a streamed reply arrived.
+        """
+        with self._lock:
+            self.first_token_latencies.append(latency)
+
+    def record_conversation(self):
+        with self._lock:
+            self.conversations += 1
+
+    def report(self, elapsed: float, peak_traced_bytes: int) -> dict:
+        """
+        Summarizes the result of a run that took `elapsed` seconds.
+        """
+        latencies = self.turn_latencies
+        report = {
+            "conversations": self.conversations,
+            "turns": len(latencies),
+            "failed_turns": self.failed_turns,
+            "elapsed_s": elapsed,
+            "turns_per_s": len(latencies) / elapsed if elapsed else 0.0,
+            "p50_ms": 1000 * percentile(latencies, 0.50),
+            "p95_ms": 1000 * percentile(latencies, 0.95),
+            "p99_ms": 1000 * percentile(latencies, 0.99),
+            "mean_ms": 1000 * statistics.fmean(latencies) if latencies else 0.0,
+            "peak_traced_mb": peak_traced_bytes / 2**20,
+            # ru_maxrss is reported in kilobytes on Linux
+            "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10,
+        }
+        if self.first_token_latencies:
+            report["first_token_p50_ms"] = 1000 * percentile(
+                self.first_token_latencies, 0.50
+            )
+            report["first_token_p95_ms"] = 1000 * percentile(
+                self.first_token_latencies, 0.95
+            )
+        return report
+
+
+def simulate_user(
+    agent: LLMAgent, conversations: int, stream: bool, result: LoadTestResult
+):
+    """
+    Plays `conversations` conversations to the end the way the Streamlit app does.
+    """
+    builder = ConversationBuilder()
+    for _ in range(conversations):
+        conversation = builder.build()
+        turn = 0
+        while not conversation.finished:
+            conversation.add_message(USER_MESSAGES[turn % len(USER_MESSAGES)])
+            start = time.perf_counter()
+            try:
+                if stream:
+                    agent_message = "".join(
+                        agent.stream_response(conversation, "fake", 0.5)
+                    )
+                else:
+                    agent_message = agent.generate_response(conversation, "fake", 0.5)
+            except Exception:  # pylint: disable=broad-except
+                # A failed turn abandons the conversation, as a user would after an error
+                result.record_turn(None)
+                break
+            conversation.add_message(agent_message)
+            result.record_turn(time.perf_counter() - start)
+            turn += 1
+        result.record_conversation()
+
+
+async def simulate_user_async(
+    agent: AsyncLLMAgent, conversations: int, stream: bool, result: LoadTestResult
+):
+    """
+    Asynchronous variant of simulate_user.
+    """
+    builder = ConversationBuilder()
+    for _ in range(conversations):
+        conversation = builder.build()
+        turn = 0
+        while not conversation.finished:
+            conversation.add_message(USER_MESSAGES[turn % len(USER_MESSAGES)])
+            start = time.perf_counter()
+            try:
+                if stream:
+                    agent_message = "".join(
+                        [
+                            text
+                            async for text in agent.stream_response(
+                                conversation, "fake", 0.5
+                            )
+                        ]
+                    )
+                else:
+                    agent_message = await agent.generate_response(
+                        conversation, "fake", 0.5
+                    )
+            except Exception:  # pylint: disable=broad-except
+                # A failed turn abandons the conversation, as a user would after an error
+                result.record_turn(None)
+                break
+            conversation.add_message(agent_message)
+            result.record_turn(time.perf_counter() - start)
+            turn += 1
+        result.record_conversation()
+
+
+class ASGIWebSocket:
+    """
+    This class is a minimal WebSocket client of an ASGI application running in the same event
+    loop, so that the service is measured without a server or network in between.
+    """
+
+    def __init__(self, app, path: str):
+        self._app = app
+        self._path = path
+        self._to_app: asyncio.Queue = asyncio.Queue()
+        self._from_app: asyncio.Queue = asyncio.Queue()
+        self._task = None
+
+    async def __aenter__(self):
+        scope = {
+            "type": "websocket",
+            "asgi": {"version": "3.0"},
+            "scheme": "ws",
+            "path": self._path,
+            "raw_path": self._path.encode(),
+            "root_path": "",
+            "query_string": b"",
+            "headers": [],
+            "client": ("load-test", 0),
+            "server": ("load-test", 80),
+            "subprotocols": [],
+        }
+        self._task = asyncio.create_task(
+            self._app(scope, self._to_app.get, self._from_app.put)
+        )
+        await self._to_app.put({"type": "websocket.connect"})
+        message = await self._from_app.get()
+        if message["type"] != "websocket.accept":
+            raise ConnectionError(f"WebSocket not accepted: {message}")
+        return self
+
+    async def send_json(self, data):
+        await self._to_app.put({"type": "websocket.receive", "text": json.dumps(data)})
+
+    async def receive_json(self):
+        message = await self._from_app.get()
+        if message["type"] == "websocket.close":
+            raise ConnectionError(f"WebSocket closed: {message}")
+        return json.loads(message["text"])
+
+    async def __aexit__(self, *exc_info):
+        await self._to_app.put({"type": "websocket.disconnect", "code": 1000})
+        await self._task
+
+
+async def simulate_session(app, client, conversations: int, result: LoadTestResult):
+    """
+    Plays `conversations` conversations through the service, streaming every reply.
+    """
+    for _ in range(conversations):
+        response = await client.post("/conversations")
+        response.raise_for_status()
+        conversation_id = response.json()["conversation_id"]
+        async with ASGIWebSocket(
+            app, f"/conversations/{conversation_id}/stream"
+        ) as websocket:
+            finished = False
+            turn = 0
+            while not finished:
+                start = time.perf_counter()
+                await websocket.send_json(
+                    {"message": USER_MESSAGES[turn % len(USER_MESSAGES)]}
+                )
+                first_token = True
+                while True:
+                    event = await websocket.receive_json()
+                    if event["type"] == "delta" and first_token:
+                        result.record_first_token(time.perf_counter() - start)
+                        first_token = False
+                    elif event["type"] != "delta":
+                        break
+                if event["type"] == "error":
+                    # A failed turn abandons the conversation, as a user would after an error
+                    result.record_turn(None)
+                    break
+                result.record_turn(time.perf_counter() - start)
+                finished = event["conversation"]["finished"]
+                turn += 1
+        result.record_conversation()
+
+
+async def run_api_sessions(
+    backend: FakeBackend, sessions: int, conversations: int, store_uri: str | None
+) -> LoadTestResult:
+    """
+    Serves the sessions from one instance of the service in this event loop.
+    """
+    import httpx
+
+    from api import create_app
+    from conversation_store import MemoryConversationStore, MongoConversationStore
+
+    result = LoadTestResult()
+    store = (
+        MongoConversationStore(store_uri)
+        if store_uri is not None
+        else MemoryConversationStore()
+    )
+    async with AsyncLLMAgent(backend=backend, max_concurrency=sessions) as agent:
+        app = create_app(agent, store)
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://load-test"
+        ) as client:
+            await asyncio.gather(
+                *(
+                    simulate_session(app, client, conversations, result)
+                    for _ in range(sessions)
+                )
+            )
+    return result
+
+
+def run_load_test(
+    backend: FakeBackend,
+    users: int,
+    conversations: int,
+    stream: bool = False,
+    use_async: bool = False,
+    api: bool = False,
+    store_uri: str | None = None,
+) -> dict:
+    """
+    Runs the simulated users concurrently, one thread each, or all on one event loop when
+    `use_async` is set, or as sessions of the service in api.py when `api` is set.
+
+    Returns:
+        dict: The report of LoadTestResult.report.
+    """
+    result = LoadTestResult()
+    tracemalloc.start()
+    start = time.perf_counter()
+    if api:
+        result = asyncio.run(run_api_sessions(backend, users, conversations, store_uri))
+    elif use_async:
+
+        async def main():
+            async with AsyncLLMAgent(backend=backend, max_concurrency=users) as agent:
+                await asyncio.gather(
+                    *(
+                        simulate_user_async(agent, conversations, stream, result)
+                        for _ in range(users)
+                    )
+                )
+
+        asyncio.run(main())
+    else:
+        agent = LLMAgent(backend=backend)
+        with ThreadPoolExecutor(max_workers=users) as executor:
+            for future in [
+                executor.submit(simulate_user, agent, conversations, stream, result)
+                for _ in range(users)
+            ]:
+                future.result()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result.report(elapsed, peak)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument(
+        "--conversations", type=int, default=4, help="Conversations per user."
+    )
+    parser.add_argument("--latency-mean", type=float, default=0.2)
+    parser.add_argument(
+        "--latency-distribution",
+        default="lognormal",
+        choices=FakeBackend.DISTRIBUTIONS,
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="Serve all users from one event loop through AsyncLLMAgent.",
+    )
+    parser.add_argument(
+        "--api",
+        action="store_true",
+        help="Serve all users as WebSocket sessions of api.py from one event loop.",
+    )
+    parser.add_argument(
+        "--store-uri",
+        help="MongoDB connection string of the conversation store of --api, in memory if unset.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    backend = FakeBackend(
+        latency_mean=args.latency_mean,
+        latency_distribution=args.latency_distribution,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    report = run_load_test(
+        backend,
+        args.users,
+        args.conversations,
+        args.stream,
+        args.use_async,
+        args.api,
+        args.store_uri,
+    )
+    for name, value in report.items():
+        print(
+            f"{name:>16}: {value:.2f}"
+            if isinstance(value, float)
+            else f"{name:>16}: {value}"
+        )
+
+
+if __name__ == "__main__":
+    main()
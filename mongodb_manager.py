@@ -1,23 +1,495 @@
+import atexit
+import queue
+import threading
+import time
 from datetime import datetime
+from functools import lru_cache
 
-from pymongo import MongoClient
+from config import (
+    MONGO_BATCH_SIZE,
+    MONGO_FLUSH_INTERVAL_SECONDS,
+    MONGO_MAX_PAGE_SIZE,
+    MONGO_PAGE_SIZE,
+    MONGO_WRITE_ATTEMPTS,
+    MONGO_WRITE_BACKOFF_SECONDS,
+    MONGO_WRITE_QUEUE_SIZE,
+)
+from instrumentation import metrics, span
+
+# Raised by MongoDB when an insert repeats an existing _id
+DUPLICATE_KEY_ERROR = 11000
+
+# Control messages for the writer thread
+_FLUSH = object()
+_STOP = object()
+
+# Indexes of the conversations collection: (name, keys, options), the default name if None.
+# Every filter of MongoPersistence.find_conversations on its own has an index that also serves
+# the newest-first sort, except evaluated=False: conversations are evaluated as soon as they
+# are saved, so the few unevaluated ones are found by scanning the timestamp index.
+INDEXES = [
+    # Also created by earlier deployments, under the default name
+    (None, [("conversation.conversation_id", 1)], {}),
+    ("timestamp", [("timestamp", -1), ("_id", -1)], {}),
+    (
+        "starter_timestamp",
+        [("conversation.starter_id", 1), ("timestamp", -1), ("_id", -1)],
+        {},
+    ),
+    # An arm has a single model, so filters on both use this one
+    (
+        "arm_timestamp",
+        [("conversation.experiment.arm", 1), ("timestamp", -1), ("_id", -1)],
+        {},
+    ),
+    (
+        "model_timestamp",
+        [("conversation.experiment.model", 1), ("timestamp", -1), ("_id", -1)],
+        {},
+    ),
+    (
+        "finished_timestamp",
+        [("conversation.finished", 1), ("timestamp", -1), ("_id", -1)],
+        {},
+    ),
+    # Evaluations are long texts, so only the evaluated documents are indexed, not their text
+    (
+        "evaluated_timestamp",
+        [("timestamp", -1), ("_id", -1)],
+        {"partialFilterExpression": {"conversation.evaluation": {"$type": "string"}}},
+    ),
+    # Rated conversations of the A/B test, see experiment_results
+    (
+        "experiment_rewards",
+        [("conversation.experiment.name", 1), ("conversation.experiment.arm", 1)],
+        {
+            "partialFilterExpression": {
+                "conversation.experiment.reward": {"$type": "number"}
+            }
+        },
+    ),
+]
+
+# Fields computed on the server that can be requested from find_conversations
+COMPUTED_FIELDS = {
+    "message_count": {"$size": "$conversation.messages"},
+}
+
+
+class _Update:
+    """A queued update of the fields of a saved conversation."""
+
+    __slots__ = ("conversation_id", "fields")
+
+    def __init__(self, conversation_id, fields):
+        self.conversation_id = conversation_id
+        self.fields = fields
 
 
 class MongoPersistence:
-    def __init__(self, uri):
-        self.client = MongoClient(uri)
+    """
+    Persists conversations to MongoDB. Writes are queued in memory and inserted in batches by
+    a background thread, so saving a conversation does not block on the database.
+
+    Saved conversations are read back page by page with only the requested fields, and reports
+    are aggregated on the server. INDEXES covers the filters of both.
+    """
+
+    def __init__(
+        self,
+        uri=None,
+        client=None,
+        batch_size=MONGO_BATCH_SIZE,
+        flush_interval=MONGO_FLUSH_INTERVAL_SECONDS,
+        max_queue_size=MONGO_WRITE_QUEUE_SIZE,
+        write_attempts=MONGO_WRITE_ATTEMPTS,
+        write_backoff=MONGO_WRITE_BACKOFF_SECONDS,
+    ):
+        # An existing client (e.g. mongomock.MongoClient()) can be passed instead of a uri
+        if client is None:
+            # pymongo is slow to import, so app reruns that never persist do not pay for it
+            from pymongo import MongoClient
+
+            client = MongoClient(uri)
+        self.client = client
         self.db = self.client[
             "chatbot_database"
         ]  # Change 'chatbot_database' to your database name
         self.conversations = self.db[
             "conversations"
         ]  # Change 'conversations' to your collection name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.write_attempts = write_attempts
+        self.write_backoff = write_backoff
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._closed = False
+        self._worker = threading.Thread(
+            target=self._run, name="mongo-writer", daemon=True
+        )
+        self._worker.start()
+        atexit.register(self.close)
 
     def save_conversation(self, conversation):
-        """Saves the conversation to MongoDB."""
-        conversation_data = {
-            "conversation": conversation.to_dict(),
-            "timestamp": datetime.now(),
-        }
-        self.conversations.insert_one(conversation_data)
-        print("Conversation saved to MongoDB.")
+        """Queues the conversation to be saved to MongoDB.
+
+        Blocks only when the write queue is full.
+        """
+        with span("save_conversation"):
+            conversation_data = {
+                "conversation": conversation.to_dict(),
+                "timestamp": datetime.now(),
+            }
+            self._queue.put(conversation_data)
+
+    def update_conversation(self, conversation_id, fields):
+        """Queues an update of fields of a saved conversation, e.g. its evaluation.
+
+        The update is written after every save queued before it, so a conversation can be
+        updated right after it was queued to be saved.
+        """
+        self._queue.put(_Update(conversation_id, dict(fields)))
+
+    def ensure_indexes(self):
+        """Creates the indexes of the conversations collection that do not exist yet.
+
+        An index that cannot be created, e.g. because it exists with other options, is reported
+        and skipped.
+        """
+        for name, keys, options in INDEXES:
+            if name is not None:
+                options = {**options, "name": name}
+            try:
+                self.conversations.create_index(keys, **options)
+            except Exception as error:  # pylint: disable=broad-except
+                print(f"Failed to create the MongoDB index {name or keys}: {error}")
+
+    @staticmethod
+    def _query(
+        start=None,
+        end=None,
+        starter_id=None,
+        arm=None,
+        model=None,
+        finished=None,
+        evaluated=None,
+    ):
+        """Builds the filter of the conversations saved in [start, end) matching the values."""
+        query = {}
+        if start is not None or end is not None:
+            query["timestamp"] = {
+                operator: value
+                for operator, value in (("$gte", start), ("$lt", end))
+                if value is not None
+            }
+        for field, value in (
+            ("conversation.starter_id", starter_id),
+            ("conversation.experiment.arm", arm),
+            ("conversation.experiment.model", model),
+            ("conversation.finished", finished),
+        ):
+            if value is not None:
+                query[field] = value
+        if evaluated is not None:
+            query["conversation.evaluation"] = (
+                {"$type": "string"} if evaluated else None
+            )
+        return query
+
+    def find_conversations(
+        self, fields=None, page_size=MONGO_PAGE_SIZE, after=None, **filters
+    ):
+        """Returns a page of saved conversations, newest first.
+
+        Args:
+            fields (list[str] | None): The conversation fields to return, e.g. ["evaluation"],
+                or names of COMPUTED_FIELDS such as "message_count". All fields if None.
+            page_size (int): The maximal number of documents, at most MONGO_MAX_PAGE_SIZE.
+            after (dict | None): The `next` token of the previous page.
+            **filters: start, end, starter_id, arm, model, finished and evaluated, see _query.
+
+        Returns:
+            dict: The `documents` with their _id and timestamp, and the `next` token, which is
+            None on the last page. Pages continue after the last document instead of skipping,
+            so deep pages are as fast as the first one.
+        """
+        query = self._query(**filters)
+        if after is not None:
+            query = {
+                "$and": [
+                    query,
+                    {
+                        "$or": [
+                            {"timestamp": {"$lt": after["timestamp"]}},
+                            {
+                                "timestamp": after["timestamp"],
+                                "_id": {"$lt": after["_id"]},
+                            },
+                        ]
+                    },
+                ]
+            }
+        page_size = min(page_size, MONGO_MAX_PAGE_SIZE)
+        pipeline = [
+            {"$match": query},
+            {"$sort": {"timestamp": -1, "_id": -1}},
+            {"$limit": page_size},
+        ]
+        if fields is not None:
+            projection = {"timestamp": 1}
+            for field in fields:
+                if field in COMPUTED_FIELDS:
+                    projection[field] = COMPUTED_FIELDS[field]
+                else:
+                    projection[f"conversation.{field}"] = 1
+            pipeline.append({"$project": projection})
+        with span("mongo.find_conversations"):
+            documents = list(self.conversations.aggregate(pipeline))
+        next_token = None
+        if len(documents) == page_size:
+            next_token = {
+                "timestamp": documents[-1]["timestamp"],
+                "_id": documents[-1]["_id"],
+            }
+        return {"documents": documents, "next": next_token}
+
+    def iter_conversations(self, fields=None, page_size=MONGO_PAGE_SIZE, **filters):
+        """Yields all matching conversations page by page, see find_conversations."""
+        after = None
+        while True:
+            page = self.find_conversations(fields, page_size, after, **filters)
+            yield from page["documents"]
+            after = page["next"]
+            if after is None:
+                return
+
+    def daily_counts(self, **filters):
+        """Counts the matching conversations per day on the server.
+
+        Returns:
+            list[dict]: The `day` (YYYY-MM-DD), the number of `conversations` and how many of
+            them are `finished` and `evaluated`, oldest day first.
+        """
+        pipeline = [
+            {"$match": self._query(**filters)},
+            {
+                "$group": {
+                    "_id": {
+                        "$dateToString": {"format": "%Y-%m-%d", "date": "$timestamp"}
+                    },
+                    "conversations": {"$sum": 1},
+                    "finished": {"$sum": {"$cond": ["$conversation.finished", 1, 0]}},
+                    # Strings sort after null, and missing fields before it
+                    "evaluated": {
+                        "$sum": {
+                            "$cond": [{"$gt": ["$conversation.evaluation", None]}, 1, 0]
+                        }
+                    },
+                }
+            },
+            {"$sort": {"_id": 1}},
+        ]
+        with span("mongo.daily_counts"):
+            return [
+                {"day": group.pop("_id"), **group}
+                for group in self.conversations.aggregate(pipeline)
+            ]
+
+    def average_turns(self, group_by=None, **filters):
+        """Averages the number of messages of the matching conversations on the server.
+
+        Args:
+            group_by (str | None): A conversation field to average per value of, e.g.
+                "starter_id" or "experiment.arm". One overall average if None.
+
+        Returns:
+            list[dict]: The `group` value, the number of `conversations` and their
+            `average_turns`.
+        """
+        pipeline = [
+            {"$match": self._query(**filters)},
+            {
+                "$group": {
+                    "_id": None if group_by is None else f"$conversation.{group_by}",
+                    "conversations": {"$sum": 1},
+                    "average_turns": {"$avg": {"$size": "$conversation.messages"}},
+                }
+            },
+            {"$sort": {"_id": 1}},
+        ]
+        with span("mongo.average_turns"):
+            return [
+                {"group": group.pop("_id"), **group}
+                for group in self.conversations.aggregate(pipeline)
+            ]
+
+    def experiment_results(self, name):
+        """Sums the rewards of the rated conversations of an A/B test per arm on the server.
+
+        Args:
+            name (str): The name of the experiment, see experiments.py.
+
+        Returns:
+            list[dict]: The `arm`, its number of rated `conversations` and their `reward_sum`.
+        """
+        pipeline = [
+            {
+                "$match": {
+                    "conversation.experiment.name": name,
+                    "conversation.experiment.reward": {"$type": "number"},
+                }
+            },
+            {
+                "$group": {
+                    "_id": "$conversation.experiment.arm",
+                    "conversations": {"$sum": 1},
+                    "reward_sum": {"$sum": "$conversation.experiment.reward"},
+                }
+            },
+        ]
+        with span("mongo.experiment_results"):
+            return [
+                {"arm": group.pop("_id"), **group}
+                for group in self.conversations.aggregate(pipeline)
+            ]
+
+    def flush(self):
+        """Blocks until every queued conversation has been written."""
+        if self._closed:
+            return
+        self._queue.put(_FLUSH)
+        self._queue.join()
+
+    def close(self):
+        """Writes the remaining conversations and stops the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._worker.join()
+
+    def _run(self):
+        """Collects queued documents and inserts them once the batch is full or old enough."""
+        batch = []
+        received = 0  # Queue items to mark as done once the batch is written
+        deadline = None
+        self.ensure_indexes()
+        while True:
+            timeout = (
+                None if deadline is None else max(0.0, deadline - time.monotonic())
+            )
+            try:
+                item = self._queue.get(timeout=timeout)
+                received += 1
+            except queue.Empty:
+                item = _FLUSH
+            if item is not _FLUSH and item is not _STOP:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                if len(batch) < self.batch_size:
+                    continue
+            self._write(batch)
+            for _ in range(received):
+                self._queue.task_done()
+            batch = []
+            received = 0
+            deadline = None
+            if item is _STOP:
+                return
+
+    def _write(self, batch):
+        """Writes a batch of conversations and updates.
+
+        A failed write is retried with exponential backoff for the items that were not written.
+        Items still failing after the last attempt are reported and counted in the
+        mongo_write_failures metric, but do not stop the writer.
+        """
+        pending = batch
+        for attempt in range(self.write_attempts):
+            if not pending:
+                return
+            if attempt:
+                metrics.increment("mongo_write_retries")
+                time.sleep(self.write_backoff * 2 ** (attempt - 1))
+            try:
+                self._write_once(pending)
+                return
+            except Exception as error:  # pylint: disable=broad-except
+                pending = self._unwritten(pending, error)
+                if pending:
+                    print(f"Failed to write {len(pending)} item(s) to MongoDB: {error}")
+        if pending:
+            metrics.increment("mongo_write_failures", len(pending))
+            print(
+                f"Dropped {len(pending)} item(s) that could not be written to MongoDB."
+            )
+
+    def _write_once(self, batch):
+        from bson import ObjectId
+
+        for item in batch:
+            # Set before the first attempt, so that a retried insert is recognized
+            if not isinstance(item, _Update):
+                item.setdefault("_id", ObjectId())
+        updates = sum(isinstance(item, _Update) for item in batch)
+        if not updates:
+            with span("mongo.insert_many"):
+                self.conversations.insert_many(batch, ordered=False)
+        else:
+            from pymongo import InsertOne, UpdateOne
+
+            # Ordered, so that updates follow the inserts of their conversations
+            with span("mongo.bulk_write"):
+                self.conversations.bulk_write(
+                    [
+                        (
+                            UpdateOne(
+                                {"conversation.conversation_id": item.conversation_id},
+                                {
+                                    "$set": {
+                                        f"conversation.{field}": value
+                                        for field, value in item.fields.items()
+                                    }
+                                },
+                            )
+                            if isinstance(item, _Update)
+                            else InsertOne(item)
+                        )
+                        for item in batch
+                    ],
+                    ordered=True,
+                )
+        if len(batch) > updates:
+            print(f"{len(batch) - updates} conversation(s) saved to MongoDB.")
+        if updates:
+            print(f"{updates} conversation update(s) written to MongoDB.")
+
+    @staticmethod
+    def _unwritten(batch, error):
+        """Returns the items of a batch that a failed write did not write."""
+        from pymongo.errors import BulkWriteError
+
+        if not isinstance(error, BulkWriteError):
+            # Unknown, so everything is written again. Updates are idempotent, and inserts that
+            # did succeed fail as duplicates next time.
+            return batch
+        failed = {}
+        for write_error in error.details.get("writeErrors", []):
+            # Duplicates were written by an earlier attempt
+            if write_error.get("code") != DUPLICATE_KEY_ERROR:
+                failed[write_error["index"]] = write_error
+        if any(isinstance(item, _Update) for item in batch):
+            # Ordered, so the write stopped at the first error
+            errors = error.details.get("writeErrors", [])
+            if not errors:
+                return []
+            first = errors[0]["index"]
+            return batch[first if first in failed else first + 1 :]
+        return [item for index, item in enumerate(batch) if index in failed]
+
+
+@lru_cache(maxsize=None)
+def get_persistence(uri):
+    """Returns the process-wide MongoPersistence for the given connection string."""
+    return MongoPersistence(uri)
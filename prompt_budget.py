@@ -0,0 +1,245 @@
+"""
+This module keeps the prompt of long conversations under a token budget.
+
+Tokens are counted locally with the model's tokenizer. While the full prompt fits the budget
+it is sent unchanged. Once it does not, the most recent messages are kept verbatim and the
+older ones are folded into a rolling summary stored on the Conversation. The summary is
+extended a chunk of messages at a time, not on every turn, and the tokens saved are added
+to Conversation.prompt_tokens_saved. The summary requests are sent through the agent building
+the prompt, with its retries and concurrency limit, and their usage is added to the
+conversation's token counts and to the metrics.
+"""
+
+import logging
+from functools import lru_cache
+from typing import Awaitable, Callable
+
+from config import (
+    INSTRUCTIONS_VERSIONS,
+    PROMPT_BUDGET_TOKENS,
+    PROMPT_KEEP_RECENT_MESSAGES,
+    PROMPT_SUMMARY_CHUNK_MESSAGES,
+    PROMPT_SUMMARY_MAX_TOKENS,
+    PROMPT_SUMMARY_MODEL,
+)
+from instrumentation import metrics, span
+from llm_backends import Completion, LLMBackend
+from prompts import render_next_message_prompt
+
+logger = logging.getLogger(__name__)
+
+# Tokens of the "<CHATBOT>: " prefix and the newline around every message
+SPEAKER_TAG_TOKENS = 5
+
+SUMMARY_PROMPT = """Summarize the earlier part of a conversation between a CHATBOT and a USER in at most five sentences.
+Keep what the CHATBOT has revealed about itself and how the USER reacted, i.e. whether they reflected the CHATBOT's words and feelings, asked questions, gave advice or opinions.
+
+Summary of the messages before these:
+{summary}
+
+Messages to add to the summary:
+{messages}"""
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: str):
+    """
+    Returns the tokenizer of the model, or None if tiktoken or its vocabulary is unavailable.
+    """
+    try:
+        # Imported here as loading it slows down the start of the app
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:  # pylint: disable=broad-except
+        # The vocabulary is downloaded on first use, which fails without network access
+        logger.warning("No tokenizer available for %s, estimating tokens.", model)
+        return None
+
+
+@lru_cache(maxsize=16384)
+def count_tokens(text: str, model: str = "gpt-4-turbo") -> int:
+    """
+    Counts the tokens of a text with the tokenizer of the model. Without a tokenizer the count
+    is estimated at four characters per token.
+    """
+    encoding = _encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
+
+class PromptBudgetManager:
+    """
+    This class compacts conversation transcripts so that the prompt stays within the budget.
+    """
+
+    def __init__(
+        self,
+        backend: LLMBackend,
+        budget_tokens: int = PROMPT_BUDGET_TOKENS,
+        keep_recent_messages: int = PROMPT_KEEP_RECENT_MESSAGES,
+        summary_chunk_messages: int = PROMPT_SUMMARY_CHUNK_MESSAGES,
+        summary_model: str = PROMPT_SUMMARY_MODEL,
+    ):
+        self.backend = backend
+        self.budget_tokens = budget_tokens
+        self.keep_recent_messages = keep_recent_messages
+        self.summary_chunk_messages = summary_chunk_messages
+        self.summary_model = summary_model
+
+    def _prompt_tokens(self, conversation, model: str) -> tuple[int, list[int]]:
+        """
+        Returns the tokens of the prompt without the transcript and of every message's line.
+        """
+        static_tokens = count_tokens(
+            render_next_message_prompt(
+                instructions=INSTRUCTIONS_VERSIONS[conversation.instructions_version],
+                num_of_remaining_messages=conversation.get_remaining_agent_messages(),
+                context=conversation.context,
+                conversation="",
+            ),
+            model,
+        )
+        line_tokens = [
+            count_tokens(message, model) + SPEAKER_TAG_TOKENS
+            for message in conversation.messages
+        ]
+        return static_tokens, line_tokens
+
+    def _messages_to_summarize(
+        self, conversation, static_tokens: int, line_tokens: list[int]
+    ) -> int | None:
+        """
+        Returns up to which message the summary should be extended, or None if it is not due.
+        """
+        if static_tokens + sum(line_tokens) <= self.budget_tokens:
+            return None
+        summarize_until = len(conversation.messages) - self.keep_recent_messages
+        if (
+            summarize_until - conversation.summarized_messages
+            < self.summary_chunk_messages
+        ):
+            return None
+        return summarize_until
+
+    def _summary_messages(self, conversation, summarize_until: int) -> list[dict]:
+        unsummarized = conversation.format_messages_for_prompt(
+            conversation.summarized_messages
+        )
+        kept = conversation.format_messages_for_prompt(summarize_until)
+        prompt = SUMMARY_PROMPT.format(
+            summary=conversation.summary or "(none)",
+            messages=unsummarized[: len(unsummarized) - len(kept)],
+        )
+        return [{"role": "user", "content": prompt}]
+
+    def _render(
+        self, conversation, static_tokens: int, line_tokens: list[int], model: str
+    ) -> str:
+        """
+        Renders the summary followed by the verbatim messages and records the savings.
+        """
+        if not conversation.summary:
+            return conversation.format_messages_for_prompt()
+        summary_line = f"<SUMMARY OF EARLIER MESSAGES>: {conversation.summary}\n"
+        transcript = summary_line + conversation.format_messages_for_prompt(
+            conversation.summarized_messages
+        )
+        conversation.prompt_tokens_saved += sum(
+            line_tokens[: conversation.summarized_messages]
+        ) - count_tokens(summary_line, model)
+        return transcript
+
+    def compact_transcript(
+        self,
+        conversation,
+        model: str,
+        complete: Callable[..., Completion] | None = None,
+    ) -> str:
+        """
+        Returns the transcript to put in the prompt, extending the summary first if it is due.
+
+        Args:
+            conversation (Conversation): The conversation waiting for an agent message.
+            model (str): The model the prompt is for, which determines the tokenizer.
+            complete (Callable | None): Sends the summary request like LLMBackend.complete,
+                e.g. through the agent. The backend's own if None.
+
+        Returns:
+            str: The transcript, possibly starting with a summary of the earlier messages.
+        """
+        static_tokens, line_tokens = self._prompt_tokens(conversation, model)
+        summarize_until = self._messages_to_summarize(
+            conversation, static_tokens, line_tokens
+        )
+        if summarize_until is not None:
+            complete = complete or self.backend.complete
+            with span("completion", model=self.summary_model, kind="summary"):
+                completion = complete(
+                    self._summary_messages(conversation, summarize_until),
+                    self.summary_model,
+                    0.0,
+                    max_tokens=PROMPT_SUMMARY_MAX_TOKENS,
+                )
+            self._apply_summary(conversation, completion, summarize_until)
+        return self._render(conversation, static_tokens, line_tokens, model)
+
+    async def acompact_transcript(
+        self,
+        conversation,
+        model: str,
+        complete: Callable[..., Awaitable[Completion]] | None = None,
+    ) -> str:
+        """
+        Asynchronous variant of compact_transcript, `complete` is like LLMBackend.acomplete.
+        """
+        static_tokens, line_tokens = self._prompt_tokens(conversation, model)
+        summarize_until = self._messages_to_summarize(
+            conversation, static_tokens, line_tokens
+        )
+        if summarize_until is not None:
+            complete = complete or self.backend.acomplete
+            with span("completion", model=self.summary_model, kind="summary"):
+                completion = await complete(
+                    self._summary_messages(conversation, summarize_until),
+                    self.summary_model,
+                    0.0,
+                    max_tokens=PROMPT_SUMMARY_MAX_TOKENS,
+                )
+            self._apply_summary(conversation, completion, summarize_until)
+        return self._render(conversation, static_tokens, line_tokens, model)
+
+    def _apply_summary(self, conversation, completion, summarize_until: int):
+        conversation.summary = completion.text.strip()
+        conversation.summarized_messages = summarize_until
+        # The summary call is paid for, so it counts against the savings and, through the
+        # conversation's token counts, against the rate limits of the app
+        conversation.record_usage(
+            completion.prompt_tokens, completion.completion_tokens
+        )
+        metrics.add_tokens(
+            self.summary_model,
+            "prompt-summary",
+            completion.prompt_tokens,
+            completion.completion_tokens,
+        )
+        conversation.prompt_tokens_saved -= (
+            completion.prompt_tokens + completion.completion_tokens
+        )
+
+    @staticmethod
+    def report(conversation) -> dict:
+        """
+        Returns the token savings of a conversation.
+        """
+        return {
+            "prompt_tokens": conversation.prompt_tokens,
+            "completion_tokens": conversation.completion_tokens,
+            "summarized_messages": conversation.summarized_messages,
+            "prompt_tokens_saved": conversation.prompt_tokens_saved,
+        }
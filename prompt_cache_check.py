@@ -0,0 +1,248 @@
+"""
+This module checks how much of the agent's prompts providers can serve from their prompt cache.
+
+Conversations are replayed turn by turn: their messages are added one at a time and the chat
+messages of every agent turn are built the way LLMAgent builds them, through the
+PromptBudgetManager with --budget. A prompt can be read from the cache as far as it starts with
+the prompt of the turn before, in whole increments of PROMPT_CACHE_INCREMENT_TOKENS once that
+shared prefix is PROMPT_CACHE_MIN_TOKENS long. The report lists the share of cacheable prompt
+tokens per conversation, the share of tokens in prefixes shared with the previous turn whatever
+their length, and the turns at which the shared prefix got shorter than on the turn
+before, i.e. where something ahead of the new messages changed. Without --input or --mongo-uri,
+conversations of catalog starters are played against a FakeBackend.
+
+Usage:
+    python prompt_cache_check.py [--input self_play.jsonl | --mongo-uri mongodb://...]
+    python prompt_cache_check.py --conversations 20 --budget --min-ratio 0.5
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+from typing import Iterable, Iterator
+
+from classes import (
+    Conversation,
+    ConversationBuilder,
+    LLMAgent,
+    Speaker,
+    build_response_messages,
+)
+from config import PROMPT_CACHE_INCREMENT_TOKENS, PROMPT_CACHE_MIN_TOKENS
+from llm_backends import FAKE_USER_MESSAGES, FakeBackend
+from mongodb_manager import get_persistence
+from prompt_budget import PromptBudgetManager, count_tokens
+
+
+def serialize_prompt(messages: list[dict]) -> str:
+    """
+    Joins chat messages into the text the provider matches against its cache, roles included.
+    """
+    return "".join(f"{message['role']}\n{message['content']}\n" for message in messages)
+
+
+def cacheable_tokens(
+    prefix_tokens: int,
+    min_tokens: int = PROMPT_CACHE_MIN_TOKENS,
+    increment: int = PROMPT_CACHE_INCREMENT_TOKENS,
+) -> int:
+    """
+    Returns how many tokens of a shared prefix the provider serves from its cache.
+    """
+    if prefix_tokens < min_tokens:
+        return 0
+    return prefix_tokens - prefix_tokens % increment
+
+
+def start_replay(recorded: dict) -> Conversation:
+    """
+    Returns a conversation like the recorded one, as it was after its opening message.
+
+    Args:
+        recorded (dict): The conversation, as returned by Conversation.to_dict.
+    """
+    return Conversation.from_dict(
+        {
+            **recorded,
+            "messages": recorded["messages"][:1],
+            "current_speaker": Speaker.USER,
+            "finished": False,
+            "num_of_messages_sent_by_agent": 1,
+            "evaluation": None,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "summary": "",
+            "summarized_messages": 0,
+            "prompt_tokens_saved": 0,
+            "turn_evaluations": [],
+        }
+    )
+
+
+def replay_prompts(
+    recorded: dict, model: str, budget: PromptBudgetManager | None = None
+) -> Iterator[list[dict]]:
+    """
+    Replays a recorded conversation and yields the chat messages of every agent turn after the
+    opening message.
+
+    Args:
+        recorded (dict): The conversation, as returned by Conversation.to_dict.
+        model (str): The model the prompts are for.
+        budget (PromptBudgetManager | None): Compacts the transcripts if given.
+    """
+    conversation = start_replay(recorded)
+    for message in recorded["messages"][1:]:
+        if conversation.current_speaker == Speaker.CHATBOT:
+            transcript = (
+                budget.compact_transcript(conversation, model)
+                if budget is not None
+                else None
+            )
+            yield build_response_messages(conversation, transcript)
+        conversation.add_message(message)
+
+
+def check_prompts(prompts: Iterable[list[dict]], model: str) -> dict:
+    """
+    Measures the prefix every prompt shares with the prompt before it.
+
+    Returns:
+        dict: The number of `turns`, the `prompt_tokens` of all of them, the `shared_tokens` in
+        prefixes shared with the previous prompt, the `cacheable_tokens` of those, their ratios
+        to the prompt tokens, and the `breaks`, the turns (from 1) at which the shared prefix got
+        shorter.
+    """
+    report = {
+        "turns": 0,
+        "prompt_tokens": 0,
+        "shared_tokens": 0,
+        "cacheable_tokens": 0,
+        "breaks": [],
+    }
+    previous = None
+    previous_prefix = 0
+    for turn, messages in enumerate(prompts, start=1):
+        prompt = serialize_prompt(messages)
+        report["turns"] += 1
+        report["prompt_tokens"] += count_tokens(prompt, model)
+        if previous is not None:
+            prefix = len(os.path.commonprefix([previous, prompt]))
+            if prefix < previous_prefix:
+                report["breaks"].append(turn)
+            shared = count_tokens(prompt[:prefix], model)
+            report["shared_tokens"] += shared
+            report["cacheable_tokens"] += cacheable_tokens(shared)
+            previous_prefix = prefix
+        previous = prompt
+    for name in ("shared", "cacheable"):
+        report[f"{name}_ratio"] = (
+            report[f"{name}_tokens"] / report["prompt_tokens"]
+            if report["prompt_tokens"]
+            else 0.0
+        )
+    return report
+
+
+def play_conversations(count: int, model: str) -> Iterator[dict]:
+    """
+    Plays conversations of random catalog starters against a FakeBackend.
+
+    Yields:
+        dict: The finished conversations, as returned by Conversation.to_dict.
+    """
+    agent = LLMAgent(FakeBackend(latency_mean=0.0))
+    builder = ConversationBuilder()
+    for _ in range(count):
+        conversation = builder.build()
+        while not conversation.finished:
+            conversation.add_message(
+                FAKE_USER_MESSAGES[
+                    len(conversation.messages) // 2 % len(FAKE_USER_MESSAGES)
+                ]
+            )
+            conversation.add_message(agent.generate_response(conversation, model, 0.5))
+        yield conversation.to_dict()
+
+
+def read_conversations(path: str) -> Iterator[dict]:
+    """
+    Reads conversations from a JSONL file of documents in the shape MongoPersistence saves.
+    """
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)["conversation"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--input", help="JSONL file of saved conversations.")
+    source.add_argument("--mongo-uri", help="MongoDB connection string.")
+    parser.add_argument(
+        "--conversations",
+        type=int,
+        help="Conversations to check, all of --input or --mongo-uri, or 10 played ones if "
+        "unset.",
+    )
+    parser.add_argument("--model", default="gpt-4-turbo")
+    parser.add_argument(
+        "--budget",
+        action="store_true",
+        help="Compact the transcripts with a PromptBudgetManager like the app.",
+    )
+    parser.add_argument(
+        "--min-ratio",
+        type=float,
+        default=0.0,
+        help="Exit with status 1 if a smaller share of the prompt tokens is shared with the "
+        "previous turn overall.",
+    )
+    args = parser.parse_args()
+
+    if args.input is not None:
+        conversations = read_conversations(args.input)
+    elif args.mongo_uri is not None:
+        conversations = (
+            document["conversation"]
+            for document in get_persistence(args.mongo_uri).iter_conversations(
+                finished=True
+            )
+        )
+    else:
+        conversations = play_conversations(args.conversations or 10, args.model)
+    conversations = itertools.islice(conversations, args.conversations)
+    budget = PromptBudgetManager(FakeBackend(latency_mean=0.0)) if args.budget else None
+
+    total = {"conversations": 0, "turns": 0}
+    for recorded in conversations:
+        report = check_prompts(replay_prompts(recorded, args.model, budget), args.model)
+        print(
+            f"{recorded.get('conversation_id')}: {report['turns']} turns, "
+            f"{report['prompt_tokens']} prompt tokens, {report['shared_ratio']:.0%} "
+            f"shared with the previous turn, {report['cacheable_ratio']:.0%} cacheable"
+            + (
+                f", prefix broken at turns {report['breaks']}"
+                if report["breaks"]
+                else ""
+            )
+        )
+        total["conversations"] += 1
+        for name in ("turns", "prompt_tokens", "shared_tokens", "cacheable_tokens"):
+            total[name] = total.get(name, 0) + report[name]
+    prompt_tokens = total.get("prompt_tokens", 0) or 1
+    shared_ratio = total.get("shared_tokens", 0) / prompt_tokens
+    print(
+        f"{total['conversations']} conversations, {total['turns']} turns: "
+        f"{shared_ratio:.1%} of the prompt tokens shared with the previous turn, "
+        f"{total.get('cacheable_tokens', 0) / prompt_tokens:.1%} cacheable"
+    )
+    if shared_ratio < args.min_ratio:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
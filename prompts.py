@@ -0,0 +1,107 @@
+"""
+This module renders the prompt for the next agent message from config.TEMPLATE.
+
+The template is split once per (instructions, context) pair. The static fields are filled in
+ahead of time, so a turn only has to join the precomputed sections with the per-turn values.
+The output is identical to TEMPLATE.format.
+
+The template must be laid out for prompt caching: the static fields first, then the append-only
+transcript, then the fields that change on every turn. The prompt of a turn then starts with the
+prompt of the previous turn up to the end of its transcript, which providers serve from their
+prompt cache. A template in another order is rejected when this module is imported.
+"""
+
+from functools import lru_cache
+from string import Formatter
+
+from config import PROMPT_SECTIONS_CACHE_SIZE, TEMPLATE
+
+STATIC_FIELDS = ("instructions", "context")
+# Fields that only grow at their end from one turn to the next
+APPEND_ONLY_FIELDS = ("conversation",)
+
+
+def check_template_layout(template: str):
+    """
+    Checks that the static fields of a template come first, followed by at most one append-only
+    field and then the per-turn fields.
+
+    Raises:
+        ValueError: If a field comes after one that changes more often.
+    """
+    fields = [field for _, field, _, _ in Formatter().parse(template) if field]
+    ranks = [
+        0 if field in STATIC_FIELDS else 1 if field in APPEND_ONLY_FIELDS else 2
+        for field in fields
+    ]
+    if ranks != sorted(ranks) or ranks.count(1) > 1:
+        raise ValueError(
+            f"The template fields {fields} break the prompt prefix between turns, order them "
+            f"as {STATIC_FIELDS}, one of {APPEND_ONLY_FIELDS}, then the per-turn fields."
+        )
+
+
+check_template_layout(TEMPLATE)
+
+
+@lru_cache(maxsize=PROMPT_SECTIONS_CACHE_SIZE)
+def compile_next_message_prompt(
+    instructions: str, context: str
+) -> tuple[tuple[str, str | None], ...]:
+    """
+    Pre-renders the static parts of the template.
+
+    Args:
+        instructions (str): The instructions for the agent.
+        context (str): The hidden context of the conversation starter.
+
+    Returns:
+        tuple: Pairs of (rendered text, name of the per-turn field that follows it). The field
+        of the last pair is None.
+    """
+    static_values = {"instructions": instructions, "context": context}
+    sections = []
+    text = ""
+    for literal, field, format_spec, _ in Formatter().parse(TEMPLATE):
+        text += literal
+        if field is None:
+            continue
+        if field in STATIC_FIELDS:
+            text += format(static_values[field], format_spec or "")
+        else:
+            sections.append((text, field))
+            text = ""
+    sections.append((text, None))
+    return tuple(sections)
+
+
+def render_next_message_prompt(
+    instructions: str, context: str, **per_turn_values
+) -> str:
+    """
+    Renders the prompt for the next agent message.
+
+    Args:
+        instructions (str): The instructions for the agent.
+        context (str): The hidden context of the conversation starter.
+        **per_turn_values: The remaining template fields, e.g. num_of_remaining_messages and
+            conversation.
+
+    Returns:
+        str: The rendered prompt.
+    """
+    return render_prompt_sections(
+        compile_next_message_prompt(instructions, context), **per_turn_values
+    )
+
+
+def render_prompt_sections(
+    sections: tuple[tuple[str, str | None], ...], **per_turn_values
+) -> str:
+    """
+    Joins sections returned by compile_next_message_prompt with the per-turn values.
+    """
+    return "".join(
+        text if field is None else text + str(per_turn_values[field])
+        for text, field in sections
+    )
@@ -0,0 +1,323 @@
+"""
+This module enforces the API call and token budgets of the whole deployment.
+
+Budgets are token buckets shared by every session of the process: one set for the deployment
+and one set per user. Checks and updates are O(1). When a short burst exhausts a bucket,
+requests wait in FIFO order for it to refill instead of being rejected right away. An optional
+MongoQuotaStore additionally enforces daily budgets across processes with atomic increments.
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+from config import (
+    ESTIMATED_COMPLETION_TOKENS,
+    MAX_CALLS_PER_DAY,
+    MAX_CALLS_PER_MINUTE,
+    MAX_CALLS_PER_USER_PER_DAY,
+    MAX_TOKENS_PER_DAY,
+    MAX_TOKENS_PER_USER_PER_DAY,
+    RATE_LIMIT_MAX_TRACKED_USERS,
+    RATE_LIMIT_MAX_WAIT_SECONDS,
+)
+from mongodb_manager import get_persistence
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class TokenBucket:
+    """
+    This class holds up to `capacity` units which are refilled continuously at
+    `refill_per_second`. The level may become negative when usage is charged after the fact.
+    """
+
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        # A bucket created after `now` was taken is not refilled backwards
+        if now <= self.updated:
+            return
+        self.level = min(
+            self.capacity, self.level + (now - self.updated) * self.refill_per_second
+        )
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """
+        Returns how many seconds it takes until `amount` units are available.
+        """
+        self._refill(now)
+        missing = amount - self.level
+        if missing <= 0:
+            return 0.0
+        if amount > self.capacity or self.refill_per_second <= 0:
+            return float("inf")
+        return missing / self.refill_per_second
+
+    def consume(self, amount: float, now: float):
+        """
+        Takes `amount` units out of the bucket.
+        """
+        self._refill(now)
+        self.level -= amount
+
+    @property
+    def full(self) -> bool:
+        """
+        Whether the bucket is full, i.e. equivalent to a newly created one.
+        """
+        self._refill(time.monotonic())
+        return self.level >= self.capacity
+
+
+class MongoQuotaStore:
+    """
+    This class keeps daily usage counters in a MongoDB collection so that several processes
+    share the same budgets. Every check is a single atomic find_one_and_update.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        # Counters of past days are removed by MongoDB once they expire
+        self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    @staticmethod
+    def _window(now: datetime) -> tuple[str, datetime]:
+        day = now.date()
+        expires_at = datetime.combine(day, datetime.min.time(), timezone.utc)
+        return day.isoformat(), expires_at + timedelta(days=2)
+
+    def try_increment(self, key: str, amount: int, limit: int) -> bool:
+        """
+        Atomically adds `amount` to today's counter of `key` unless that exceeds `limit`.
+
+        Returns:
+            bool: Whether the amount was added.
+        """
+        from pymongo import ReturnDocument
+
+        day, expires_at = self._window(datetime.now(timezone.utc))
+        document = self.collection.find_one_and_update(
+            {"_id": f"{key}:{day}"},
+            {"$inc": {"count": amount}, "$setOnInsert": {"expires_at": expires_at}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        if document["count"] <= limit:
+            return True
+        self.increment(key, -amount)
+        return False
+
+    def increment(self, key: str, amount: int):
+        """
+        Adds `amount` to today's counter of `key` without checking any limit.
+        """
+        day, expires_at = self._window(datetime.now(timezone.utc))
+        self.collection.update_one(
+            {"_id": f"{key}:{day}"},
+            {"$inc": {"count": amount}, "$setOnInsert": {"expires_at": expires_at}},
+            upsert=True,
+        )
+
+
+class RateLimiter:
+    """
+    This class enforces deployment-wide and per-user call and token budgets.
+
+    A call first reserves one call and an estimate of its tokens with acquire(); the actual
+    token usage can be settled afterwards with record_tokens().
+    """
+
+    def __init__(
+        self,
+        calls_per_day: int = MAX_CALLS_PER_DAY,
+        calls_per_minute: int = MAX_CALLS_PER_MINUTE,
+        tokens_per_day: int = MAX_TOKENS_PER_DAY,
+        user_calls_per_day: int = MAX_CALLS_PER_USER_PER_DAY,
+        user_tokens_per_day: int = MAX_TOKENS_PER_USER_PER_DAY,
+        max_wait: float = RATE_LIMIT_MAX_WAIT_SECONDS,
+        max_tracked_users: int = RATE_LIMIT_MAX_TRACKED_USERS,
+        store: MongoQuotaStore | None = None,
+    ):
+        self.calls_per_day = calls_per_day
+        self.tokens_per_day = tokens_per_day
+        self.user_calls_per_day = user_calls_per_day
+        self.user_tokens_per_day = user_tokens_per_day
+        self.max_wait = max_wait
+        self.max_tracked_users = max_tracked_users
+        self.store = store
+        self._daily_calls = TokenBucket(calls_per_day, calls_per_day / SECONDS_PER_DAY)
+        self._burst_calls = TokenBucket(calls_per_minute, calls_per_minute / 60.0)
+        self._daily_tokens = TokenBucket(
+            tokens_per_day, tokens_per_day / SECONDS_PER_DAY
+        )
+        # user id -> (calls bucket, tokens bucket), least recently used first
+        self._users: OrderedDict[str, tuple[TokenBucket, TokenBucket]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._turn_changed = threading.Condition(self._lock)
+        self._waiting: deque[object] = deque()
+
+    def _user_buckets(self, user_id: str) -> tuple[TokenBucket, TokenBucket]:
+        buckets = self._users.get(user_id)
+        if buckets is None:
+            buckets = (
+                TokenBucket(
+                    self.user_calls_per_day,
+                    self.user_calls_per_day / SECONDS_PER_DAY,
+                ),
+                TokenBucket(
+                    self.user_tokens_per_day,
+                    self.user_tokens_per_day / SECONDS_PER_DAY,
+                ),
+            )
+            self._users[user_id] = buckets
+            if len(self._users) > self.max_tracked_users:
+                self._forget_idle_user(keep=user_id)
+        else:
+            self._users.move_to_end(user_id)
+        return buckets
+
+    def _forget_idle_user(self, keep: str):
+        """
+        Drops the least recently seen user other than `keep`. Users whose buckets are full
+        carry no state, so they are dropped first.
+        """
+        for user_id, (calls, tokens) in self._users.items():
+            if user_id != keep and calls.full and tokens.full:
+                del self._users[user_id]
+                return
+        self._users.popitem(last=False)
+
+    def acquire(
+        self, user_id: str, estimated_tokens: int = 0, timeout: float | None = None
+    ) -> bool:
+        """
+        Reserves one API call and `estimated_tokens` tokens for the user. Waits in FIFO order
+        while a bucket refills, unless the wait would take longer than `timeout`.
+
+        Args:
+            user_id (str): The identifier of the user, e.g. the id of their session.
+            estimated_tokens (int): The expected number of prompt and completion tokens.
+            timeout (float | None): The longest acceptable wait, defaults to max_wait.
+
+        Returns:
+            bool: Whether the call may proceed.
+        """
+        deadline = time.monotonic() + (self.max_wait if timeout is None else timeout)
+        ticket = object()
+        with self._lock:
+            self._waiting.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    if self._waiting[0] is ticket:
+                        user_calls, user_tokens = self._user_buckets(user_id)
+                        wait = max(
+                            self._daily_calls.wait_time(1, now),
+                            self._burst_calls.wait_time(1, now),
+                            self._daily_tokens.wait_time(estimated_tokens, now),
+                            user_calls.wait_time(1, now),
+                            user_tokens.wait_time(estimated_tokens, now),
+                        )
+                        if wait == 0:
+                            for bucket in (
+                                self._daily_calls,
+                                self._burst_calls,
+                                user_calls,
+                            ):
+                                bucket.consume(1, now)
+                            for bucket in (self._daily_tokens, user_tokens):
+                                bucket.consume(estimated_tokens, now)
+                            break
+                        if now + wait > deadline:
+                            return False
+                    else:
+                        wait = deadline - now
+                        if wait <= 0:
+                            return False
+                    self._turn_changed.wait(wait)
+            finally:
+                self._waiting.remove(ticket)
+                self._turn_changed.notify_all()
+        if self.store is not None and not self._acquire_shared(
+            user_id, estimated_tokens
+        ):
+            self.release(user_id, estimated_tokens)
+            return False
+        return True
+
+    def _acquire_shared(self, user_id: str, estimated_tokens: int) -> bool:
+        """
+        Checks the daily budgets shared with the other processes.
+        """
+        reserved = []
+        for key, amount, limit in (
+            ("calls", 1, self.calls_per_day),
+            (f"calls:{user_id}", 1, self.user_calls_per_day),
+            ("tokens", estimated_tokens, self.tokens_per_day),
+            (f"tokens:{user_id}", estimated_tokens, self.user_tokens_per_day),
+        ):
+            if not self.store.try_increment(key, amount, limit):
+                for reserved_key, reserved_amount in reserved:
+                    self.store.increment(reserved_key, -reserved_amount)
+                return False
+            reserved.append((key, amount))
+        return True
+
+    def release(self, user_id: str, estimated_tokens: int = 0):
+        """
+        Returns a reservation made by acquire() that was not used, e.g. because the call failed
+        before reaching the API. Only the local buckets are refunded.
+        """
+        with self._lock:
+            now = time.monotonic()
+            user_calls, user_tokens = self._user_buckets(user_id)
+            for bucket in (self._daily_calls, self._burst_calls, user_calls):
+                bucket.consume(-1, now)
+            for bucket in (self._daily_tokens, user_tokens):
+                bucket.consume(-estimated_tokens, now)
+            self._turn_changed.notify_all()
+
+    def record_tokens(self, user_id: str, tokens: int):
+        """
+        Charges tokens that were used on top of the estimate passed to acquire(). A negative
+        value refunds an over-estimate.
+        """
+        with self._lock:
+            now = time.monotonic()
+            _, user_tokens = self._user_buckets(user_id)
+            self._daily_tokens.consume(tokens, now)
+            user_tokens.consume(tokens, now)
+            if tokens < 0:
+                self._turn_changed.notify_all()
+        if self.store is not None:
+            self.store.increment("tokens", tokens)
+            self.store.increment(f"tokens:{user_id}", tokens)
+
+
+def estimate_tokens(messages: list[dict]) -> int:
+    """
+    Roughly estimates the tokens of a chat completion call from the length of its prompt,
+    assuming about four characters per token.
+    """
+    prompt_characters = sum(len(message["content"]) for message in messages)
+    return prompt_characters // 4 + ESTIMATED_COMPLETION_TOKENS
+
+
+@lru_cache(maxsize=None)
+def get_rate_limiter(mongo_uri: str | None = None) -> RateLimiter:
+    """
+    Returns the process-wide RateLimiter. When a MongoDB connection string is given, the
+    daily budgets are also shared with the other processes through a MongoQuotaStore.
+    """
+    if mongo_uri is None:
+        return RateLimiter()
+    persistence = get_persistence(mongo_uri)
+    return RateLimiter(store=MongoQuotaStore(persistence.db["rate_limits"]))
@@ -0,0 +1,472 @@
+"""
+This module replays saved conversations turn by turn and checks them against a baseline.
+
+Every user message of a conversation is added with Conversation.add_message and answered by
+LLMAgent.generate_response, with its response cache lookup, prompt building, spans and response
+parsing, from a RecordedBackend answering with the saved agent message, or from a FakeBackend.
+Every conversation gets a new ResponseCache, so its lookups miss like those of a live one.
+Finished conversations are serialized like MongoPersistence and the conversation store do, and
+saved to MongoDB with --persist-uri. The CPU time of every stage and the turn latency are
+measured over several replays, the memory allocated by every stage with tracemalloc in a
+separate one. A stored baseline is compared against, and the exit status is 1 if a stage got
+slower or allocates more than the thresholds in config.py allow. Differences within the spread
+of the timed replays are taken as noise.
+
+Usage:
+    python replay_benchmark.py --save-baseline [--input conversations.jsonl]
+    python replay_benchmark.py [--baseline replay_baseline.json] [--repeat 20]
+    python replay_benchmark.py --mongo-uri mongodb://... --limit 500 --backend fake --budget
+"""
+
+import argparse
+import itertools
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+from classes import ConversationBuilder, LLMAgent, Speaker
+from config import (
+    REPLAY_BASELINE_PATH,
+    REPLAY_MAX_ALLOCATION_GROWTH,
+    REPLAY_MAX_SLOWDOWN,
+    REPLAY_MIN_ALLOCATION_DIFFERENCE_KB,
+    REPLAY_MIN_LATENCY_DIFFERENCE_MS,
+    REPLAY_MIN_TIME_DIFFERENCE_US,
+    REPLAY_NOISE_SPREADS,
+    REPLAY_REPEAT,
+)
+from conversation_starters import get_starter_catalog
+from llm_backends import FAKE_USER_MESSAGES, FakeBackend, RecordedBackend
+from load_test import percentile
+from mongodb_manager import MongoPersistence, get_persistence
+from prompt_budget import PromptBudgetManager
+from prompt_cache_check import read_conversations, start_replay
+from response_cache import ResponseCache
+
+MODEL = "gpt-4-turbo"
+TEMPERATURE = 0.5
+
+
+class StageRecorder:
+    """
+    This class adds up the CPU time of the calling thread and, while tracemalloc is tracing,
+    the peak memory allocated in every stage of a replay.
+    """
+
+    def __init__(self):
+        self.calls: dict[str, int] = defaultdict(int)
+        self.cpu_seconds: dict[str, float] = defaultdict(float)
+        self.allocated_bytes: dict[str, int] = defaultdict(int)
+        self.turn_latencies: list[float] = []
+
+    @contextmanager
+    def stage(self, name: str):
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.thread_time()
+        try:
+            yield
+        finally:
+            self.cpu_seconds[name] += time.thread_time() - start
+            self.calls[name] += 1
+            if tracing:
+                self.allocated_bytes[name] += (
+                    tracemalloc.get_traced_memory()[1] - start_memory
+                )
+
+
+def calibrate() -> float:
+    """
+    Returns the CPU seconds of a fixed workload of string, list and dict operations, a measure
+    of how fast the machine runs Python code at the moment.
+    """
+    start = time.thread_time()
+    for _ in range(200):
+        words = [f"word{index % 97}" for index in range(500)]
+        counts = {}
+        for word in words:
+            counts[word] = counts.get(word, 0) + 1
+        " ".join(sorted(counts)).split()
+    return time.thread_time() - start
+
+
+def spread(values: list[float]) -> float:
+    """
+    Returns the interquartile range of the values, 0.0 for fewer than two.
+    """
+    if len(values) < 2:
+        return 0.0
+    quartiles = statistics.quantiles(values, n=4)
+    return quartiles[2] - quartiles[0]
+
+
+def scripted_conversations() -> list[dict]:
+    """
+    Plays one conversation per catalog starter against a FakeBackend, the same ones on every
+    run, for when no saved conversations are given.
+    """
+    agent = LLMAgent(FakeBackend(latency_mean=0.0))
+    conversations = []
+    for starter in get_starter_catalog():
+        conversation = ConversationBuilder.build_from_starter(starter)
+        conversation.conversation_id = f"scripted:{starter.id}"
+        while not conversation.finished:
+            conversation.add_message(
+                FAKE_USER_MESSAGES[
+                    len(conversation.messages) // 2 % len(FAKE_USER_MESSAGES)
+                ]
+            )
+            conversation.add_message(
+                agent.generate_response(conversation, MODEL, TEMPERATURE)
+            )
+        conversations.append(conversation.to_dict())
+    return conversations
+
+
+def replay_conversation(
+    recorded: dict,
+    recorder: StageRecorder,
+    fake_backend: FakeBackend | None = None,
+    budget: PromptBudgetManager | None = None,
+    persistence: MongoPersistence | None = None,
+):
+    """
+    Replays a saved conversation turn by turn, recording every stage.
+
+    Args:
+        recorded (dict): The conversation, as returned by Conversation.to_dict.
+        recorder (StageRecorder): Where the measurements are added.
+        fake_backend (FakeBackend | None): Generates the agent replies, the saved ones are
+            replayed if None.
+        budget (PromptBudgetManager | None): Compacts the transcripts if given.
+        persistence (MongoPersistence | None): Where the replayed conversation is saved.
+    """
+    messages = recorded["messages"]
+    agent = LLMAgent(
+        fake_backend if fake_backend is not None else RecordedBackend(messages[2::2]),
+        cache=ResponseCache(),
+        budget=budget,
+    )
+    conversation = start_replay(recorded)
+    # The saved user messages, each answered by the agent
+    for user_message in messages[1::2]:
+        if conversation.finished:
+            break
+        start = time.perf_counter()
+        with recorder.stage("add_message"):
+            conversation.add_message(user_message)
+        if conversation.current_speaker != Speaker.CHATBOT:
+            break
+        with recorder.stage("generate_response"):
+            agent_response = agent.generate_response(conversation, MODEL, TEMPERATURE)
+        with recorder.stage("add_message"):
+            conversation.add_message(agent_response)
+        recorder.turn_latencies.append(time.perf_counter() - start)
+    with recorder.stage("to_dict"):
+        conversation.to_dict()
+    with recorder.stage("to_bytes"):
+        conversation.to_bytes()
+    if persistence is not None:
+        with recorder.stage("save_conversation"):
+            persistence.save_conversation(conversation)
+
+
+def run_replay(
+    conversations: list[dict],
+    repeat: int = REPLAY_REPEAT,
+    fake_backend: FakeBackend | None = None,
+    budget: PromptBudgetManager | None = None,
+    persistence: MongoPersistence | None = None,
+) -> dict:
+    """
+    Replays the conversations once to warm up, `repeat` times timed, and once traced by
+    tracemalloc.
+
+    Returns:
+        dict: The numbers of `conversations` and `turns`, the median CPU time (`cpu_us`), its
+        interquartile range over the timed replays (`cpu_us_spread`) and the allocated memory
+        (`alloc_kb`) per call of every stage, the `turn_latency_ms` percentiles and their
+        `turn_latency_spread_ms` over the timed replays, the `peak_mb` traced during the
+        replay, the `calibration_ms` of the machine and the `simulated_latency_s` of the
+        completions.
+    """
+
+    def replay(recorder: StageRecorder):
+        for recorded in conversations:
+            replay_conversation(recorded, recorder, fake_backend, budget, persistence)
+
+    replay(StageRecorder())
+    timed = []
+    calibrations = []
+    for _ in range(repeat):
+        calibrations.append(calibrate())
+        recorder = StageRecorder()
+        replay(recorder)
+        timed.append(recorder)
+    traced = StageRecorder()
+    tracemalloc.start()
+    try:
+        replay(traced)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    def cpu_us(name: str) -> list[float]:
+        return [
+            1e6 * recorder.cpu_seconds[name] / recorder.calls[name]
+            for recorder in timed
+        ]
+
+    def latency_ms(fraction: float, recorders: list[StageRecorder]) -> float:
+        latencies = [
+            latency for recorder in recorders for latency in recorder.turn_latencies
+        ]
+        return 1000 * percentile(latencies, fraction)
+
+    percentiles = {"p50": 0.50, "p95": 0.95}
+    return {
+        "conversations": len(conversations),
+        "turns": len(traced.turn_latencies),
+        "stages": {
+            name: {
+                "cpu_us": statistics.median(cpu_us(name)),
+                "cpu_us_spread": spread(cpu_us(name)),
+                "alloc_kb": traced.allocated_bytes[name] / calls / 2**10,
+            }
+            for name, calls in traced.calls.items()
+        },
+        "turn_latency_ms": {
+            name: latency_ms(fraction, timed) for name, fraction in percentiles.items()
+        },
+        "turn_latency_spread_ms": {
+            name: spread([latency_ms(fraction, [recorder]) for recorder in timed])
+            for name, fraction in percentiles.items()
+        },
+        "peak_mb": peak_bytes / 2**20,
+        "calibration_ms": 1000 * statistics.median(calibrations),
+        "simulated_latency_s": (
+            fake_backend.latency_mean if fake_backend is not None else 0.0
+        ),
+    }
+
+
+def compare(
+    report: dict,
+    baseline: dict,
+    max_slowdown: float = REPLAY_MAX_SLOWDOWN,
+    max_allocation_growth: float = REPLAY_MAX_ALLOCATION_GROWTH,
+) -> list[dict]:
+    """
+    Compares a report of run_replay with a baseline report. The CPU times of the baseline are
+    scaled by how much slower or faster calibrate ran, so that the speed of the machine does
+    not count as a change of the code, and so are the turn latencies unless they include a
+    simulated latency. A time only counts as slower by more than REPLAY_NOISE_SPREADS times the
+    larger spread of the two runs, and by more than the minimal differences in config.py.
+
+    Returns:
+        list[dict]: One row per metric of the baseline with its `name`, the `baseline` and
+        `current` values, the relative `change` and whether it is a `regression`. A metric
+        missing from the report, e.g. a stage that was renamed, is a regression.
+    """
+    speed = report["calibration_ms"] / baseline["calibration_ms"]
+    latency_speed = speed if not baseline["simulated_latency_s"] else 1.0
+
+    def noise(floor: float, spread: float, current_spread: float | None) -> float:
+        return max(floor, REPLAY_NOISE_SPREADS * max(spread, current_spread or 0.0))
+
+    metrics = []
+    for name, stage in baseline["stages"].items():
+        current = report["stages"].get(name, {})
+        metrics.append(
+            (
+                f"{name}.cpu_us",
+                stage["cpu_us"] * speed,
+                current.get("cpu_us"),
+                max_slowdown,
+                noise(
+                    REPLAY_MIN_TIME_DIFFERENCE_US,
+                    stage["cpu_us_spread"] * speed,
+                    current.get("cpu_us_spread"),
+                ),
+            )
+        )
+        metrics.append(
+            (
+                f"{name}.alloc_kb",
+                stage["alloc_kb"],
+                current.get("alloc_kb"),
+                max_allocation_growth,
+                REPLAY_MIN_ALLOCATION_DIFFERENCE_KB,
+            )
+        )
+    for name, value in baseline["turn_latency_ms"].items():
+        metrics.append(
+            (
+                f"turn_latency_ms.{name}",
+                value * latency_speed,
+                report["turn_latency_ms"].get(name),
+                max_slowdown,
+                noise(
+                    REPLAY_MIN_LATENCY_DIFFERENCE_MS,
+                    baseline["turn_latency_spread_ms"][name] * latency_speed,
+                    report["turn_latency_spread_ms"].get(name),
+                ),
+            )
+        )
+    rows = []
+    for name, before, after, threshold, min_difference in metrics:
+        if after is None:
+            rows.append(
+                {
+                    "name": name,
+                    "baseline": before,
+                    "current": None,
+                    "change": None,
+                    "regression": True,
+                }
+            )
+            continue
+        change = (after - before) / before if before else 0.0
+        rows.append(
+            {
+                "name": name,
+                "baseline": before,
+                "current": after,
+                "change": change,
+                "regression": change > threshold and after - before > min_difference,
+            }
+        )
+    return rows
+
+
+def print_report(report: dict):
+    print(
+        f"{report['conversations']} conversations, {report['turns']} turns, "
+        f"{report['peak_mb']:.2f} MB peak traced"
+    )
+    print(f"{'stage':<20} {'cpu_us':>10} {'alloc_kb':>10}")
+    for name, stage in report["stages"].items():
+        print(f"{name:<20} {stage['cpu_us']:>10.2f} {stage['alloc_kb']:>10.2f}")
+    for name, value in report["turn_latency_ms"].items():
+        print(f"{'turn_latency_ms.' + name:<20} {value:>10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--input", help="JSONL file of saved conversations.")
+    source.add_argument("--mongo-uri", help="MongoDB connection string.")
+    parser.add_argument(
+        "--limit", type=int, help="Replay at most this many conversations."
+    )
+    parser.add_argument("--repeat", type=int, default=REPLAY_REPEAT)
+    parser.add_argument(
+        "--backend",
+        choices=("recorded", "fake"),
+        default="recorded",
+        help="Replay the saved agent messages, or generate them with a FakeBackend.",
+    )
+    parser.add_argument(
+        "--latency-mean",
+        type=float,
+        default=0.0,
+        help="Simulated latency of the completions in seconds.",
+    )
+    parser.add_argument(
+        "--budget",
+        action="store_true",
+        help="Compact the transcripts with a PromptBudgetManager like the app.",
+    )
+    parser.add_argument(
+        "--persist-uri",
+        help="MongoDB connection string to save the replayed conversations to, every "
+        "replay adds them again, so use a scratch database.",
+    )
+    parser.add_argument("--baseline", default=REPLAY_BASELINE_PATH)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Store this run as the baseline instead of comparing against it.",
+    )
+    parser.add_argument("--max-slowdown", type=float, default=REPLAY_MAX_SLOWDOWN)
+    parser.add_argument(
+        "--max-allocation-growth", type=float, default=REPLAY_MAX_ALLOCATION_GROWTH
+    )
+    args = parser.parse_args()
+
+    if args.input is not None:
+        conversations = read_conversations(args.input)
+    elif args.mongo_uri is not None:
+        conversations = (
+            document["conversation"]
+            for document in get_persistence(args.mongo_uri).iter_conversations(
+                finished=True
+            )
+        )
+    else:
+        conversations = scripted_conversations()
+    conversations = list(itertools.islice(conversations, args.limit))
+    fake_backend = (
+        FakeBackend(latency_mean=args.latency_mean, latency_distribution="fixed")
+        if args.backend == "fake"
+        else None
+    )
+    budget = PromptBudgetManager(FakeBackend(latency_mean=0.0)) if args.budget else None
+    persistence = (
+        MongoPersistence(args.persist_uri) if args.persist_uri is not None else None
+    )
+
+    report = run_replay(conversations, args.repeat, fake_backend, budget, persistence)
+    if persistence is not None:
+        persistence.close()
+    print_report(report)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+        print(f"Baseline saved to {args.baseline}.")
+        return
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, store one with --save-baseline.")
+        return
+    with open(args.baseline, encoding="utf-8") as file:
+        baseline = json.load(file)
+    settings = ("conversations", "turns", "simulated_latency_s")
+    if any(baseline[name] != report[name] for name in settings):
+        sys.exit(
+            f"The baseline replayed {baseline['conversations']} conversations with "
+            f"{baseline['turns']} turns and {baseline['simulated_latency_s']} s of latency, "
+            f"this run {report['conversations']} with {report['turns']} and "
+            f"{report['simulated_latency_s']} s. Replay the same conversations or store a "
+            "new baseline."
+        )
+    rows = compare(report, baseline, args.max_slowdown, args.max_allocation_growth)
+    print(
+        f"\nThis machine ran the calibration "
+        f"{report['calibration_ms'] / baseline['calibration_ms']:.2f}x as long as for the "
+        "baseline, its times are scaled by that."
+    )
+    print(f"{'metric':<28} {'baseline':>10} {'current':>10} {'change':>8}")
+    for row in rows:
+        current = "missing" if row["current"] is None else f"{row['current']:.2f}"
+        change = "" if row["change"] is None else f"{row['change']:+.0%}"
+        print(
+            f"{row['name']:<28} {row['baseline']:>10.2f} {current:>10} {change:>8}"
+            + ("  REGRESSION" if row["regression"] else "")
+        )
+    regressions = sum(row["regression"] for row in rows)
+    if regressions:
+        print(f"{regressions} regression(s) against {args.baseline}.")
+        sys.exit(1)
+    print(f"No regressions against {args.baseline}.")
+
+
+if __name__ == "__main__":
+    main()
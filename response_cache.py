@@ -0,0 +1,251 @@
+"""
+This module provides an opt-in cache for agent responses and conversation evaluations.
+
+Entries are keyed on the starter, the model, the temperature and the normalized transcript,
+and are evicted by LRU order, by age and by a size cap in bytes. For agent responses an
+optional near-duplicate lookup compares an embedding of the last user message with the ones
+cached for the same conversation prefix, so "what happened?" and "What happened??" share an
+entry.
+"""
+
+import hashlib
+import math
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Callable
+
+from config import (
+    RESPONSE_CACHE_MAX_BYTES,
+    RESPONSE_CACHE_SIMILARITY_THRESHOLD,
+    RESPONSE_CACHE_TTL_SECONDS,
+)
+
+Embedder = Callable[[str], list[float]]
+
+NON_WORD_CHARACTERS = re.compile(r"[^\w\s]")
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_message(message: str) -> str:
+    """
+    Lowercases a message and strips punctuation and redundant whitespace.
+    """
+    return WHITESPACE.sub(" ", NON_WORD_CHARACTERS.sub("", message.lower())).strip()
+
+
+def _digest(*parts) -> str:
+    return hashlib.sha256("\x1f".join(map(str, parts)).encode()).hexdigest()
+
+
+def _cosine_similarity(first: list[float], second: list[float]) -> float:
+    dot = sum(a * b for a, b in zip(first, second))
+    norm = math.sqrt(sum(a * a for a in first)) * math.sqrt(sum(b * b for b in second))
+    return dot / norm if norm else 0.0
+
+
+def openai_embedder(model: str = "text-embedding-3-small") -> Embedder:
+    """
+    Returns an embedding function backed by the OpenAI embeddings API.
+    """
+
+    def embed(text: str) -> list[float]:
+        import openai
+
+        return openai.embeddings.create(model=model, input=text).data[0].embedding
+
+    return embed
+
+
+@dataclass
+class CacheTicket:
+    """
+    This class carries what a lookup computed, so that storing the result does not repeat it.
+    """
+
+    key: str
+    scope: str | None = None
+    vector: list[float] | None = None
+
+
+@dataclass
+class _Entry:
+    value: str
+    size: int
+    created: float
+    scope: str | None
+    vector: list[float] | None
+
+
+class ResponseCache:
+    """
+    This class caches LLM outputs with LRU, TTL and byte-size eviction.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = RESPONSE_CACHE_MAX_BYTES,
+        ttl_seconds: float = RESPONSE_CACHE_TTL_SECONDS,
+        embed: Embedder | None = None,
+        similarity_threshold: float = RESPONSE_CACHE_SIMILARITY_THRESHOLD,
+    ):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.embed = embed
+        self.similarity_threshold = similarity_threshold
+        self.size = 0
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        # scope -> keys of the entries that can serve near-duplicate lookups in it
+        self._scopes: dict[str, set[str]] = {}
+        self._lock = threading.Lock()
+
+    def stats(self) -> dict:
+        """
+        Returns the hit and miss counters and the current size of the cache.
+        """
+        with self._lock:
+            lookups = self.hits + self.near_hits + self.misses
+            return {
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits + self.near_hits) / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.size,
+            }
+
+    def lookup_response(
+        self, conversation, model: str, temperature: float
+    ) -> tuple[str | None, CacheTicket]:
+        """
+        Looks up the next agent message of a conversation.
+
+        Returns:
+            tuple: The cached message or None, and the ticket to store the computed one with.
+        """
+        messages = [normalize_message(message) for message in conversation.messages]
+        # Arms of the A/B test may differ only by the instructions, so they are part of the key
+        settings = (
+            conversation.context,
+            conversation.instructions_version,
+            model,
+            temperature,
+        )
+        key = _digest("response", *settings, *messages)
+        ticket = CacheTicket(key)
+        value = self._get(key)
+        if value is not None or self.embed is None or not messages:
+            self._count(value is not None)
+            return value, ticket
+        ticket.scope = _digest("response", *settings, *messages[:-1])
+        ticket.vector = self.embed(messages[-1])
+        value = self._get_similar(ticket.scope, ticket.vector)
+        self._count(value is not None, near=True)
+        return value, ticket
+
+    def lookup_evaluation(
+        self, conversation, model: str, temperature: float
+    ) -> tuple[str | None, CacheTicket]:
+        """
+        Looks up the evaluation of a finished conversation with an identical transcript.
+
+        Returns:
+            tuple: The cached evaluation or None, and the ticket to store the computed one with.
+        """
+        messages = [normalize_message(message) for message in conversation.messages]
+        settings = (
+            conversation.context,
+            conversation.instructions_version,
+            model,
+            temperature,
+        )
+        key = _digest("evaluation", *settings, *messages)
+        value = self._get(key)
+        self._count(value is not None)
+        return value, CacheTicket(key)
+
+    def store(self, ticket: CacheTicket, value: str):
+        """
+        Stores a computed value under the ticket returned by the lookup.
+        """
+        size = sys.getsizeof(value) + (
+            8 * len(ticket.vector) if ticket.vector is not None else 0
+        )
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(ticket.key)
+            self._entries[ticket.key] = _Entry(
+                value, size, time.monotonic(), ticket.scope, ticket.vector
+            )
+            self.size += size
+            if ticket.scope is not None:
+                self._scopes.setdefault(ticket.scope, set()).add(ticket.key)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _count(self, hit: bool, near: bool = False):
+        with self._lock:
+            if not hit:
+                self.misses += 1
+            elif near:
+                self.near_hits += 1
+            else:
+                self.hits += 1
+
+    def _get(self, key: str) -> str | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry.created > self.ttl_seconds:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry.value
+
+    def _get_similar(self, scope: str, vector: list[float]) -> str | None:
+        with self._lock:
+            candidates = list(self._scopes.get(scope, ()))
+        best_key, best_similarity = None, self.similarity_threshold
+        for key in candidates:
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is None:
+                continue
+            similarity = _cosine_similarity(vector, entry.vector)
+            if similarity >= best_similarity:
+                best_key, best_similarity = key, similarity
+        return None if best_key is None else self._get(best_key)
+
+    def _remove(self, key: str):
+        """
+        Removes an entry. The caller must hold the lock.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry.size
+        if entry.scope is not None:
+            keys = self._scopes[entry.scope]
+            keys.discard(key)
+            if not keys:
+                del self._scopes[entry.scope]
+
+
+@lru_cache(maxsize=None)
+def get_response_cache(near_duplicates: bool = False) -> ResponseCache:
+    """
+    Returns the process-wide ResponseCache.
+    """
+    return ResponseCache(embed=openai_embedder() if near_duplicates else None)
@@ -0,0 +1,215 @@
+"""
+This module holds helpers for turning raw model output into agent messages.
+
+Models that support it are asked for JSON mode or schema-constrained output, so the reply is
+usually valid JSON and parsed as such. Near-JSON replies, e.g. wrapped in a code fence, using
+single quotes or cut off at the token limit, are handled by a tolerant single-pass extractor.
+Only output without any agent_response is sent back to the model with a short repair prompt.
+"""
+
+import json
+import re
+
+from config import JSON_MODE_MODELS, JSON_SCHEMA_MODELS
+
+# Matches the opening of the agent_response value. The instructions show the output format
+# with single quotes, so the model is allowed to use either quote character.
+AGENT_RESPONSE_VALUE_START = re.compile(r"""["']agent_response["']\s*:\s*(["'])""")
+
+AGENT_RESPONSE_SCHEMA = {
+    "name": "agent_response",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {"agent_response": {"type": "string"}},
+        "required": ["agent_response"],
+        "additionalProperties": False,
+    },
+}
+
+REPAIR_PROMPT = """The text below was supposed to be a JSON object of the form {{"agent_response": "..."}} holding a chat message, but it could not be parsed.
+Answer with only that JSON object, keeping the message as it is.
+
+Text:
+{output}"""
+
+ESCAPES = {
+    '"': '"',
+    "'": "'",
+    "\\": "\\",
+    "/": "/",
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+}
+
+
+class AgentResponseStreamParser:
+    """
+    This class incrementally extracts the value of "agent_response" from a streamed JSON
+    object. Chunks of model output are fed in as they arrive and every call returns the newly
+    decoded part of the agent message, so it can be displayed before the object is complete.
+    """
+
+    def __init__(self):
+        self._buffer = ""  # Output received before the value started
+        self._pending = ""  # Escape sequence split across chunks
+        self._quote: str | None = None
+        self.done = False
+
+    @property
+    def started(self) -> bool:
+        """
+        Whether the opening quote of the agent_response value has been seen.
+        """
+        return self._quote is not None
+
+    def feed(self, chunk: str) -> str:
+        """
+        Consumes a chunk of model output.
+
+        Args:
+            chunk (str): The next piece of the streamed completion.
+
+        Returns:
+            str: The decoded text of agent_response contained in this chunk.
+        """
+        if self.done or not chunk:
+            return ""
+        if self._quote is None:
+            self._buffer += chunk
+            match = AGENT_RESPONSE_VALUE_START.search(self._buffer)
+            if match is None:
+                return ""
+            self._quote = match.group(1)
+            chunk = self._buffer[match.end() :]
+            self._buffer = ""
+        return self._decode(self._pending + chunk)
+
+    def _decode(self, text: str) -> str:
+        """
+        Decodes string content up to the closing quote, keeping an incomplete escape sequence
+        for the next chunk.
+        """
+        self._pending = ""
+        decoded = []
+        i = 0
+        while i < len(text):
+            char = text[i]
+            if char == self._quote:
+                self.done = True
+                break
+            if char != "\\":
+                decoded.append(char)
+                i += 1
+                continue
+            if i + 1 >= len(text):
+                self._pending = text[i:]
+                break
+            escaped = text[i + 1]
+            if escaped == "u":
+                if i + 6 > len(text):
+                    self._pending = text[i:]
+                    break
+                code = int(text[i + 2 : i + 6], 16)
+                if 0xD800 <= code < 0xDC00:  # High surrogate, combine with the low one
+                    if i + 12 > len(text):
+                        self._pending = text[i:]
+                        break
+                    if text[i + 6 : i + 8] == "\\u":
+                        low = int(text[i + 8 : i + 12], 16)
+                        code = 0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)
+                        i += 6
+                decoded.append(chr(code))
+                i += 6
+                continue
+            decoded.append(ESCAPES.get(escaped, escaped))
+            i += 2
+        return "".join(decoded)
+
+
+ESCAPE_SEQUENCE = re.compile(r"\\(u[0-9a-fA-F]{4}|.)", re.DOTALL)
+
+
+def response_format_for(model: str) -> dict | None:
+    """
+    Returns the response_format requesting an agent_response object from the model, or None if
+    the model supports neither structured outputs nor JSON mode.
+    """
+    if model in JSON_SCHEMA_MODELS:
+        return {"type": "json_schema", "json_schema": AGENT_RESPONSE_SCHEMA}
+    if model in JSON_MODE_MODELS:
+        return {"type": "json_object"}
+    return None
+
+
+def _unescape(text: str) -> str:
+    def replace(match: re.Match) -> str:
+        escaped = match.group(1)
+        if len(escaped) == 5:
+            return chr(int(escaped[1:], 16))
+        return ESCAPES.get(escaped, escaped)
+
+    # Escaped surrogate pairs are decoded into two code points, which are combined here
+    return (
+        ESCAPE_SEQUENCE.sub(replace, text)
+        .encode("utf-16", "surrogatepass")
+        .decode("utf-16", "replace")
+    )
+
+
+def extract_agent_response(text: str) -> str | None:
+    """
+    Extracts the value of agent_response from near-JSON model output in a single pass. The
+    object may be surrounded by other text, use single quotes, contain raw control characters
+    or lack its end.
+
+    Returns:
+        str | None: The agent message, or None if the output has no agent_response.
+    """
+    match = AGENT_RESPONSE_VALUE_START.search(text)
+    if match is None:
+        return None
+    quote = match.group(1)
+    start = end = match.end()
+    # The value ends at the first unescaped quote followed by the end of the member, so that
+    # apostrophes inside a single-quoted value are kept
+    while (end := text.find(quote, end)) != -1:
+        backslashes = end - len(text[start:end].rstrip("\\")) - start
+        if backslashes % 2 == 0 and re.match(r"\s*(?:[,}]|$)", text[end + 1 :]):
+            break
+        end += 1
+    raw = text[start:] if end == -1 else text[start:end]
+    return _unescape(raw)
+
+
+def parse_agent_response(text: str) -> tuple[str | None, str]:
+    """
+    Parses the agent message from model output without calling the model again.
+
+    Returns:
+        tuple: The agent message or None, and how it was parsed: "json", "extracted" or
+            "unparsed".
+    """
+    try:
+        data = json.loads(text)
+    except (TypeError, ValueError):
+        data = None
+    if isinstance(data, dict) and isinstance(data.get("agent_response"), str):
+        return data["agent_response"], "json"
+    agent_response = extract_agent_response(text or "")
+    if agent_response is not None:
+        return agent_response, "extracted"
+    return None, "unparsed"
+
+
+def build_repair_messages(text: str, max_characters: int) -> list[dict]:
+    """
+    Builds the chat messages asking the model to turn unparsable output into an agent_response
+    object. Only the output is sent, cut to max_characters, not the original prompt.
+    """
+    return [
+        {"role": "user", "content": REPAIR_PROMPT.format(output=text[:max_characters])}
+    ]
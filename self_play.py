@@ -0,0 +1,312 @@
+"""
+This module generates conversations in which a simulated user talks to the agent.
+
+A second model plays the USER with a given reflective listening skill level, against the agent's
+AsyncLLMAgent.generate_response. Every starter of the catalog is played the given number of
+times per skill level, with a bounded number of conversations in flight. Finished conversations
+are appended to a JSONL file, one document per line in the shape MongoPersistence saves, i.e.
+{"conversation": Conversation.to_dict(), "timestamp": ...}, plus the settings of the simulated
+user. Every conversation has a deterministic conversation_id, so a run that is started again
+skips the conversations already in the file.
+
+Usage:
+    python self_play.py --output self_play.jsonl [--per-starter 10] [--skills poor fair good]
+    python self_play.py --output self_play.jsonl --fake --latency-mean 0.05
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import time
+from datetime import datetime
+from typing import Iterator
+
+import openai
+
+from classes import AsyncLLMAgent, Conversation, ConversationBuilder
+from config import (
+    LLM_MAX_CONCURRENCY,
+    SELF_PLAY_AGENT_MODEL,
+    SELF_PLAY_AGENT_TEMPERATURE,
+    SELF_PLAY_CONCURRENCY,
+    SELF_PLAY_REPORT_INTERVAL_SECONDS,
+    SELF_PLAY_USER_MODEL,
+    SELF_PLAY_USER_TEMPERATURE,
+)
+from conversation_starters import Starter, get_starter_catalog
+from llm_backends import FakeBackend
+
+# How the simulated user listens at every skill level
+SKILL_LEVELS = {
+    "poor": "You are a poor listener. You mostly give advice, share your own opinions and "
+    "experiences, change the subject or ask probing questions. You rarely reflect what the "
+    "CHATBOT said or felt.",
+    "fair": "You are an average listener. You sometimes reflect what the CHATBOT said, but you "
+    "often slip into giving advice, reassuring or asking many questions.",
+    "good": "You are a skilled reflective listener. You mirror the CHATBOT's words, paraphrase "
+    "its meaning and name the feelings you hear, without giving advice, opinions or "
+    "sympathy.",
+}
+
+SIMULATED_USER_PROMPT = """You play the USER in a conversation with a CHATBOT. {skill}
+Answer with the next USER message only, one to three sentences, without the "<USER>:" prefix.
+
+What the USER knows about the situation: {user_visible_context}
+
+Conversation so far:
+{conversation}"""
+
+
+def build_simulated_user_messages(conversation: Conversation, skill: str) -> list[dict]:
+    """
+    Builds the chat messages used to generate the next message of the simulated user.
+
+    Args:
+        conversation (Conversation): The conversation waiting for a user message.
+        skill (str): A key of SKILL_LEVELS.
+
+    Returns:
+        list[dict]: The messages to be sent to the chat completion API.
+    """
+    prompt = SIMULATED_USER_PROMPT.format(
+        skill=SKILL_LEVELS[skill],
+        user_visible_context=conversation.user_visible_context,
+        conversation=conversation.format_messages_for_prompt(),
+    )
+    return [{"role": "user", "content": prompt}]
+
+
+def conversation_id(starter: Starter, skill: str, repetition: int) -> str:
+    return f"self-play:{starter.id}:{skill}:{repetition}"
+
+
+def load_completed(path: str) -> set[str]:
+    """
+    Returns the conversation IDs already written to the output file. A last line cut off by
+    an interrupted run is removed, so that appending continues on a fresh line.
+    """
+    if not os.path.exists(path):
+        return set()
+    completed = set()
+    with open(path, "rb+") as file:
+        data = file.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            file.truncate(end)
+    for line in data[:end].splitlines():
+        if line.strip():
+            completed.add(json.loads(line)["conversation"]["conversation_id"])
+    return completed
+
+
+def iter_jobs(
+    skills: list[str], per_starter: int, completed: set[str]
+) -> Iterator[tuple[Starter, str, int]]:
+    """
+    Yields the (starter, skill, repetition) of every conversation still to be played,
+    interleaving the starters and skill levels.
+    """
+    starters = list(get_starter_catalog())
+    for repetition, skill, starter in itertools.product(
+        range(per_starter), skills, starters
+    ):
+        if conversation_id(starter, skill, repetition) not in completed:
+            yield starter, skill, repetition
+
+
+class SelfPlayProgress:
+    """
+    This class counts the played conversations and turns and reports the throughput.
+    """
+
+    def __init__(self, total: int, skipped: int):
+        self.total = total
+        self.skipped = skipped
+        self.conversations = 0
+        self.failed = 0
+        self.turns = 0
+        self.started = time.monotonic()
+
+    def report(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        return {
+            "conversations": self.conversations,
+            "failed": self.failed,
+            "remaining": self.total - self.conversations - self.failed,
+            "skipped": self.skipped,
+            "turns": self.turns,
+            "elapsed_s": elapsed,
+            "conversations_per_s": self.conversations / elapsed if elapsed else 0.0,
+            "turns_per_s": self.turns / elapsed if elapsed else 0.0,
+        }
+
+    def __str__(self):
+        report = self.report()
+        return (
+            f"{report['conversations']} played, {report['failed']} failed, "
+            f"{report['remaining']} remaining ({report['conversations_per_s']:.2f} "
+            f"conversations/s, {report['turns_per_s']:.1f} turns/s)"
+        )
+
+
+async def play(
+    agent: AsyncLLMAgent,
+    starter: Starter,
+    skill: str,
+    repetition: int,
+    agent_model: str,
+    agent_temperature: float,
+    user_model: str,
+    progress: SelfPlayProgress,
+) -> Conversation:
+    """
+    Plays one conversation to the end.
+
+    Raises:
+        Exception: Any error of the model calls, which abandons the conversation.
+    """
+    conversation = ConversationBuilder.build_from_starter(starter)
+    conversation.conversation_id = conversation_id(starter, skill, repetition)
+    while not conversation.finished:
+        completion = await agent.complete(
+            build_simulated_user_messages(conversation, skill),
+            user_model,
+            SELF_PLAY_USER_TEMPERATURE,
+            max_tokens=150,
+        )
+        conversation.add_message(completion.text.strip())
+        conversation.add_message(
+            await agent.generate_response(conversation, agent_model, agent_temperature)
+        )
+        progress.turns += 1
+    return conversation
+
+
+async def run(
+    agent: AsyncLLMAgent,
+    output: str,
+    skills: list[str],
+    per_starter: int,
+    concurrency: int = SELF_PLAY_CONCURRENCY,
+    agent_model: str = SELF_PLAY_AGENT_MODEL,
+    agent_temperature: float = SELF_PLAY_AGENT_TEMPERATURE,
+    user_model: str = SELF_PLAY_USER_MODEL,
+    report_interval: float = SELF_PLAY_REPORT_INTERVAL_SECONDS,
+) -> dict:
+    """
+    Plays the conversations that are not in the output file yet and appends them to it.
+
+    Returns:
+        dict: The final report of SelfPlayProgress.
+    """
+    completed = load_completed(output)
+    jobs = list(iter_jobs(skills, per_starter, completed))
+    progress = SelfPlayProgress(len(jobs), len(completed))
+    pending = iter(jobs)
+
+    with open(output, "a", encoding="utf-8") as file:
+
+        async def worker():
+            # Workers pull from one iterator, so at most `concurrency` conversations run
+            for starter, skill, repetition in pending:
+                try:
+                    conversation = await play(
+                        agent,
+                        starter,
+                        skill,
+                        repetition,
+                        agent_model,
+                        agent_temperature,
+                        user_model,
+                        progress,
+                    )
+                except Exception as error:  # pylint: disable=broad-except
+                    # Not written, so the conversation is played again when resuming
+                    progress.failed += 1
+                    print(f"Failed to play {starter.id} ({skill}): {error!r}")
+                    continue
+                document = {
+                    "conversation": conversation.to_dict(),
+                    "timestamp": datetime.now().isoformat(),
+                    "simulated_user": {"skill": skill, "model": user_model},
+                }
+                file.write(json.dumps(document) + "\n")
+                file.flush()
+                progress.conversations += 1
+
+        async def report_periodically():
+            while True:
+                await asyncio.sleep(report_interval)
+                print(progress)
+
+        reporter = asyncio.create_task(report_periodically())
+        try:
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+        finally:
+            reporter.cancel()
+    return progress.report()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--output", default="self_play.jsonl")
+    parser.add_argument(
+        "--per-starter",
+        type=int,
+        default=10,
+        help="Conversations per starter and skill level.",
+    )
+    parser.add_argument(
+        "--skills", nargs="+", default=list(SKILL_LEVELS), choices=SKILL_LEVELS
+    )
+    parser.add_argument("--concurrency", type=int, default=SELF_PLAY_CONCURRENCY)
+    parser.add_argument(
+        "--max-requests",
+        type=int,
+        default=LLM_MAX_CONCURRENCY,
+        help="Model requests in flight at once.",
+    )
+    parser.add_argument("--agent-model", default=SELF_PLAY_AGENT_MODEL)
+    parser.add_argument(
+        "--agent-temperature", type=float, default=SELF_PLAY_AGENT_TEMPERATURE
+    )
+    parser.add_argument("--user-model", default=SELF_PLAY_USER_MODEL)
+    parser.add_argument(
+        "--fake",
+        action="store_true",
+        help="Play against a FakeBackend instead of the OpenAI API.",
+    )
+    parser.add_argument("--latency-mean", type=float, default=0.2)
+    args = parser.parse_args()
+
+    openai.api_key = os.getenv("OPENAI_KEY")
+    backend = FakeBackend(latency_mean=args.latency_mean) if args.fake else None
+
+    async def main_async():
+        async with AsyncLLMAgent(
+            backend=backend, max_concurrency=args.max_requests
+        ) as agent:
+            return await run(
+                agent,
+                args.output,
+                args.skills,
+                args.per_starter,
+                args.concurrency,
+                args.agent_model,
+                args.agent_temperature,
+                args.user_model,
+            )
+
+    report = asyncio.run(main_async())
+    for name, value in report.items():
+        print(
+            f"{name:>20}: {value:.2f}"
+            if isinstance(value, float)
+            else f"{name:>20}: {value}"
+        )
+
+
+if __name__ == "__main__":
+    main()
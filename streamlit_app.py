@@ -1,39 +1,93 @@
-from datetime import datetime, timedelta
+import logging
+import os
+import time
+import uuid
 
-import openai
 import streamlit as st
 
-from classes import ConversationBuilder, LLMAgent
-from config import MAX_CALLS_PER_DAY, MAX_MESSAGES
-from mongodb_manager import MongoPersistence
+from background_evaluation import get_background_evaluator
+from classes import (
+    ConversationBuilder,
+    LLMAgent,
+    Speaker,
+    build_quality_messages,
+    build_response_messages,
+)
+from config import (
+    EXPERIMENT_ENABLED,
+    EXPERIMENT_QUALITY_MODEL,
+    MAX_MESSAGES,
+    PROMPT_BUDGET_ENABLED,
+    RATE_LIMIT_SHARED,
+    RESPONSE_CACHE_ENABLED,
+    RESPONSE_CACHE_NEAR_DUPLICATES,
+)
+from experiments import Experiment, get_experiment
+from instrumentation import metrics, span, start_metrics_export
+from llm_backends import OpenAIBackend
+from prompt_budget import PromptBudgetManager
+from rate_limiter import estimate_tokens, get_rate_limiter
+from response_cache import get_response_cache
+
+logger = logging.getLogger(__name__)
 
-openai.api_key = st.secrets["OPENAI_KEY"]
+rerun_started = time.perf_counter()
+start_metrics_export()
+
+# Read by the openai client once it is created, so openai is only imported on first use
+os.environ["OPENAI_API_KEY"] = st.secrets["OPENAI_KEY"]
 
 # Initialize the LLMAgent
-llm_agent = LLMAgent()
+backend = OpenAIBackend()
+llm_agent = LLMAgent(
+    backend=backend,
+    cache=(
+        get_response_cache(RESPONSE_CACHE_NEAR_DUPLICATES)
+        if RESPONSE_CACHE_ENABLED
+        else None
+    ),
+    budget=PromptBudgetManager(backend) if PROMPT_BUDGET_ENABLED else None,
+)
 
-RESET_INTERVAL = timedelta(days=1)  # 24-hour interval
+# Saves finished conversations and evaluates them while the last reply is rendered
+evaluator = get_background_evaluator(st.secrets["MONGO_CONNECTION_STRING"])
 
+# Online A/B test of the agent's model, temperature and instructions
+experiment = (
+    get_experiment(st.secrets["MONGO_CONNECTION_STRING"])
+    if EXPERIMENT_ENABLED
+    else None
+)
+
+# Call and token budgets shared by all sessions
+rate_limiter = get_rate_limiter(
+    st.secrets["MONGO_CONNECTION_STRING"] if RATE_LIMIT_SHARED else None
+)
+
+if "user_id" not in st.session_state:
+    st.session_state["user_id"] = uuid.uuid4().hex
+
+LIMIT_REACHED_MESSAGE = (
+    "The maximal number of daily messages has been reached. Please try again tomorrow."
+)
 
-# Check if the API call limit has been reached
-def check_limit():
-    if "api_calls" not in st.session_state:
-        st.session_state["api_calls"] = 0
-        st.session_state["last_reset"] = datetime.now()
 
-    time_since_reset = datetime.now() - st.session_state["last_reset"]
-    if time_since_reset > RESET_INTERVAL:
-        st.session_state["api_calls"] = 0
-        st.session_state["last_reset"] = datetime.now()
+def used_tokens(conversation):
+    return conversation.prompt_tokens + conversation.completion_tokens
 
-    if st.session_state["api_calls"] >= MAX_CALLS_PER_DAY:
-        return False
-    return True
 
+def response_settings(conversation):
+    arm = experiment.arm_of(conversation) if experiment is not None else None
+    if arm is None:
+        return "gpt-4-turbo", 0.5
+    return arm.model, arm.temperature
 
-# Increment the count of API calls
-def increment_call_count():
-    st.session_state["api_calls"] += 1
+
+# Replace the estimate reserved with the rate limiter by the usage the API reported, none if
+# the call failed or the response cache answered
+def settle_tokens(conversation, tokens_before, reserved_tokens):
+    tokens = used_tokens(conversation) - tokens_before
+    rate_limiter.record_tokens(st.session_state["user_id"], tokens - reserved_tokens)
 
 
 # Title and instructions
@@ -47,47 +101,54 @@ You are limited to a maximum conversation length of 20 messages, after which you
 """
 )
 
-# Initialize the conversation using ConversationBuilder
-if "conversation" not in st.session_state:
-    builder = ConversationBuilder()
-    st.session_state["conversation"] = builder.build()
-
-# Display user visible context
-st.write(
-    f"Conversation Context: {st.session_state['conversation'].user_visible_context}"
-)
-
 
-# Initialize or restart the conversation
+# Initialize the conversation using ConversationBuilder
 def init_conversation():
     builder = ConversationBuilder()
-    st.session_state["conversation"] = builder.build()
+    conversation = builder.build()
+    if experiment is not None:
+        experiment.assign(conversation)
+    # The evaluations run outside of the session, which they cannot read
+    user_id = st.session_state["user_id"]
+    evaluator.watch(
+        conversation,
+        admit=lambda messages: rate_limiter.acquire(user_id, estimate_tokens(messages)),
+    )
+    st.session_state["conversation"] = conversation
 
 
 if "conversation" not in st.session_state:
     init_conversation()
 
+# Display user visible context
+st.write(
+    f"Conversation Context: {st.session_state['conversation'].user_visible_context}"
+)
+
 
 def handle_message():
-    if not check_limit():
-        st.error(
-            "The maximal number of daily messages has been reached. Please try again tomorrow."
-        )
-        return
     user_message = st.session_state.user_input
-    if user_message:  # if the message is not empty
-        conversation = st.session_state["conversation"]
-        conversation.add_message(user_message)
-        st.session_state.user_input = (
-            ""  # Clear the input box after sending the message
-        )
-
-        # Generate LLM response
-        llm_response = llm_agent.generate_response(
-            conversation, model="gpt-4-turbo", temperature=0.5
-        )
-        conversation.add_message(llm_response)
-    increment_call_count()  # Increment the call count after a successful API call
+    conversation = st.session_state["conversation"]
+    if conversation.finished:
+        return
+    # The reply to the last message failed if it is still the agent's turn, sending again
+    # retries it
+    retry = conversation.current_speaker == Speaker.CHATBOT
+    if user_message or retry:
+        estimated_tokens = estimate_tokens(build_response_messages(conversation))
+        if not retry:
+            estimated_tokens += len(user_message) // 4
+        if not rate_limiter.acquire(st.session_state["user_id"], estimated_tokens):
+            st.error(LIMIT_REACHED_MESSAGE)
+            return
+        st.session_state["reserved_tokens"] = estimated_tokens
+        if not retry:
+            conversation.add_message(user_message)
+            st.session_state.user_input = (
+                ""  # Clear the input box after sending the message
+            )
+        # The LLM response is streamed below the conversation display during the rerun
+        st.session_state["awaiting_response"] = not conversation.finished
 
 
 # Create a text input for the user message, with a key that matches the session_state key
@@ -96,7 +157,8 @@ send_button = st.button("Send", on_click=handle_message)
 
 # Display the conversation
 conversation = st.session_state["conversation"]
-conversation_text = conversation.format_messages_for_prompt()
+with span("format_messages_for_prompt", caller="display"):
+    conversation_text = conversation.format_messages_for_prompt()
 num_lines = conversation_text.count("\n") + 1
 text_area_height = 600
 st.text_area(
@@ -106,22 +168,73 @@ st.text_area(
     key="conversation_display",
 )
 
-if conversation.finished:
-    if "logged" not in st.session_state:
-        persistence_manager = MongoPersistence(st.secrets["MONGO_CONNECTION_STRING"])
-        persistence_manager.save_conversation(conversation)
-        st.session_state["logged"] = True  # Set the flag to prevent re-logging
+# Stream the LLM response, then rerun so the conversation display includes it
+if st.session_state.get("awaiting_response"):
+    model, temperature = response_settings(conversation)
+    tokens_before = used_tokens(conversation)
+    prompt_tokens_before = conversation.prompt_tokens
+    turn_started = time.perf_counter()
+    try:
+        agent_message = st.write_stream(
+            llm_agent.stream_response(
+                conversation, model=model, temperature=temperature
+            )
+        )
+        prompt_tokens = conversation.prompt_tokens - prompt_tokens_before
+        Experiment.record_turn(
+            conversation,
+            time.perf_counter() - turn_started,
+            prompt_tokens,
+            used_tokens(conversation) - tokens_before - prompt_tokens,
+        )
+        conversation.add_message(agent_message)
+    finally:
+        settle_tokens(
+            conversation, tokens_before, st.session_state.pop("reserved_tokens", 0)
+        )
+        # A failed call is not retried on every rerun, which would spend tokens each time
+        st.session_state["awaiting_response"] = False
+    st.rerun()
 
+if conversation.finished:
     st.subheader("True Context of the Conversation")
     st.write(conversation.context)
 
+    # Rate the agent for the A/B test while the evaluation runs in the background
+    if experiment is not None and "rated" not in st.session_state:
+        reserved_tokens = estimate_tokens(build_quality_messages(conversation))
+        if rate_limiter.acquire(st.session_state["user_id"], reserved_tokens):
+            # Replace the reserved estimate by the usage the API reported
+            quality = llm_agent.rate_conversation(
+                conversation,
+                EXPERIMENT_QUALITY_MODEL,
+                on_usage=lambda tokens: rate_limiter.record_tokens(
+                    st.session_state["user_id"], tokens - reserved_tokens
+                ),
+            )
+            experiment.record_outcome(conversation, quality)
+            evaluator.persistence.update_conversation(
+                conversation.conversation_id, {"experiment": conversation.experiment}
+            )
+        st.session_state["rated"] = True
+
     if "evaluation" not in st.session_state:
-        evaluation = llm_agent.evaluate_conversation(conversation, "gpt-4-turbo", 0.5)
-        conversation.evaluation = evaluation
-        st.session_state["evaluation"] = (
-            evaluation  # Save evaluation to prevent re-computation
-        )
+        with st.spinner("Evaluating the conversation..."):
+            # Save evaluation to prevent re-computation, a failed one is not waited for again
+            try:
+                st.session_state["evaluation"] = evaluator.result(conversation)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Failed to evaluate the conversation")
+                st.session_state["evaluation"] = None
+                st.session_state["evaluation_failed"] = True
 
     st.subheader("Evaluation of Your Reflective Listening Skills:")
-    st.write(st.session_state["evaluation"])
+    if st.session_state.get("evaluation_failed"):
+        st.error("The evaluation failed. Please try again later.")
+    elif st.session_state["evaluation"] is not None:
+        st.write(st.session_state["evaluation"])
+    else:
+        st.error(LIMIT_REACHED_MESSAGE)
     st.subheader("To start a new conversation, please refresh the page.")
+
+metrics.observe("streamlit_rerun", time.perf_counter() - rerun_started)
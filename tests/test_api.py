@@ -0,0 +1,56 @@
+from fastapi.testclient import TestClient
+
+from api import create_app
+from classes import AsyncLLMAgent
+from conversation_store import MemoryConversationStore
+from llm_backends import FakeBackend
+from rate_limiter import RateLimiter
+
+
+class RecordingLimiter(RateLimiter):
+    def __init__(self, **kwargs):
+        super().__init__(max_wait=0.0, **kwargs)
+        self.settled = []
+
+    def record_tokens(self, user_id, tokens):
+        self.settled.append(tokens)
+        super().record_tokens(user_id, tokens)
+
+
+def client_and_limiter(**limits):
+    limiter = RecordingLimiter(**limits)
+    app = create_app(
+        AsyncLLMAgent(FakeBackend(latency_mean=0.0)),
+        MemoryConversationStore(),
+        rate_limiter=limiter,
+    )
+    return TestClient(app), limiter
+
+
+def test_replies_are_reserved_and_settled():
+    client, limiter = client_and_limiter()
+    conversation_id = client.post("/conversations").json()["conversation_id"]
+    response = client.post(
+        f"/conversations/{conversation_id}/messages", json={"message": "Hi"}
+    )
+    assert response.status_code == 200
+    assert len(limiter.settled) == 1
+
+
+def test_exhausted_budget_is_answered_with_429():
+    client, limiter = client_and_limiter(user_calls_per_day=1)
+    conversation_id = client.post("/conversations").json()["conversation_id"]
+    url = f"/conversations/{conversation_id}/messages"
+    assert client.post(url, json={"message": "Hi"}).status_code == 200
+    assert client.post(url, json={"message": "Hi"}).status_code == 429
+
+    with client.websocket_connect(f"/conversations/{conversation_id}/stream") as ws:
+        ws.send_json({"message": "Hi"})
+        assert ws.receive_json() == {
+            "type": "error",
+            "status": 429,
+            "detail": "The daily budget is exhausted.",
+        }
+    # The turn that was refused is not saved
+    assert len(client.get(f"/conversations/{conversation_id}").json()["messages"]) == 3
+    assert len(limiter.settled) == 1
@@ -0,0 +1,69 @@
+import time
+
+import pytest
+
+from background_evaluation import BackgroundEvaluator
+from classes import ConversationBuilder, LLMAgent
+from conversation_starters import get_starter_catalog
+from llm_backends import FakeBackend
+
+
+def evaluator(**kwargs):
+    agent = LLMAgent(FakeBackend(latency_mean=0.0))
+    return BackgroundEvaluator(agent, incremental=True, max_workers=2, **kwargs)
+
+
+def conversation():
+    return ConversationBuilder.build_from_starter(next(iter(get_starter_catalog())))
+
+
+def play(conversation, messages):
+    for index in range(messages):
+        conversation.add_message(f"Message {index}")
+
+
+def test_turns_and_evaluation_are_merged_on_the_owning_thread():
+    background = evaluator()
+    watched = conversation()
+    background.watch(watched)
+    play(watched, 1)
+    # The workers never touch the watched conversation
+    background._executor.shutdown(wait=True)
+    assert watched.turn_evaluations == []
+    assert watched.prompt_tokens == 0
+
+    watched.add_message("Message 1")
+    assert [index for index, _ in watched.turn_evaluations] == [1]
+    assert watched.prompt_tokens > 0
+
+
+def test_result_merges_the_evaluation():
+    background = evaluator()
+    watched = conversation()
+    background.watch(watched)
+    play(watched, watched.max_messages)
+    assert watched.finished
+
+    evaluation = background.result(watched, timeout=5)
+    assert evaluation and watched.evaluation == evaluation
+    assert sorted(index for index, _ in watched.turn_evaluations) == list(
+        range(1, watched.max_messages - 1, 2)
+    )
+    assert watched.prompt_tokens > 0
+    assert not background._turns and not background._evaluations
+    with pytest.raises(KeyError):
+        background.result(watched)
+
+
+def test_unmerged_results_are_dropped():
+    background = evaluator(max_pending=2)
+    watched = [conversation() for _ in range(3)]
+    for each in watched:
+        background.watch(each)
+        play(each, 2)
+    assert list(background._turns) == [each.conversation_id for each in watched[1:]]
+
+    background.ttl = 0.0
+    time.sleep(0.01)
+    play(watched[0], 2)
+    assert list(background._turns) == [watched[0].conversation_id]
@@ -0,0 +1,72 @@
+import pytest
+
+from classes import Conversation, ConversationBuilder, Speaker
+from conversation_starters import get_starter_catalog
+
+
+def played_conversation(messages=3):
+    conversation = ConversationBuilder.build_from_starter(
+        next(iter(get_starter_catalog()))
+    )
+    for index in range(messages):
+        conversation.add_message(f"Message {index} with é, \U0001f600 and a\nnew line.")
+    conversation.prompt_tokens = 120
+    conversation.completion_tokens = 30
+    conversation.evaluation = "Good listening."
+    conversation.experiment = {"name": "test", "arm": "a", "reward": 0.5}
+    conversation.turn_evaluations.append([1, "Reflected well."])
+    return conversation
+
+
+def test_snapshot_round_trip():
+    conversation = played_conversation()
+    restored = Conversation.from_bytes(conversation.to_bytes())
+    assert restored.to_dict() == conversation.to_dict()
+    assert restored.messages == conversation.messages
+    assert restored.current_speaker == conversation.current_speaker
+
+
+def test_restored_conversation_continues():
+    conversation = played_conversation(2)
+    restored = Conversation.from_bytes(conversation.to_bytes())
+    conversation.add_message("One more.")
+    restored.add_message("One more.")
+    assert restored.to_dict() == conversation.to_dict()
+
+
+def test_finished_conversation_round_trip():
+    conversation = played_conversation(0)
+    while not conversation.finished:
+        conversation.add_message("Hello.")
+    restored = Conversation.from_bytes(conversation.to_bytes())
+    assert restored.finished
+    assert restored.to_dict() == conversation.to_dict()
+
+
+def test_dict_round_trip():
+    conversation = played_conversation()
+    restored = Conversation.from_dict(conversation.to_dict())
+    assert restored.to_dict() == conversation.to_dict()
+    assert restored.current_speaker == Speaker.CHATBOT
+
+
+def test_other_data_is_not_a_snapshot():
+    with pytest.raises(ValueError):
+        Conversation.from_bytes(b"\0" * 64)
+
+
+def test_custom_context_without_a_visible_one():
+    conversation = Conversation(
+        max_messages=20,
+        messages=["Hi."],
+        current_speaker=Speaker.USER,
+        finished=False,
+        context="A context of my own.",
+        user_visible_context=None,
+        num_of_messages_sent_by_agent=1,
+    )
+    assert conversation.starter is None
+    assert conversation.context == "A context of my own."
+    assert conversation.user_visible_context == ""
+    restored = Conversation.from_bytes(conversation.to_bytes())
+    assert restored.to_dict() == conversation.to_dict()
@@ -0,0 +1,96 @@
+import random
+from collections import Counter
+
+import pytest
+
+from conversation_starters import (
+    AliasSampler,
+    Starter,
+    StarterCatalog,
+    get_starter_catalog,
+)
+
+
+def starter(starter_id, topic="work", difficulty="easy", weight=1.0):
+    return Starter(
+        id=starter_id,
+        topic=topic,
+        difficulty=difficulty,
+        initial_message=f"Opening of {starter_id}.",
+        user_visible_context=f"Visible context of {starter_id}.",
+        context=f"Context of {starter_id}.",
+        weight=weight,
+    )
+
+
+def test_alias_sampler_follows_the_weights():
+    sampler = AliasSampler([1.0, 3.0, 0.0])
+    rng = random.Random(0)
+    counts = Counter(sampler.sample(rng) for _ in range(20_000))
+    assert counts[2] == 0
+    assert counts[1] / counts[0] == pytest.approx(3.0, rel=0.1)
+
+
+def test_alias_sampler_needs_a_positive_weight():
+    with pytest.raises(ValueError):
+        AliasSampler([0.0, 0.0])
+
+
+def test_sample_matches_the_topic_and_difficulty():
+    catalog = StarterCatalog(
+        [
+            starter("a", "work", "easy"),
+            starter("b", "work", "hard"),
+            starter("c", "family", "hard"),
+        ]
+    )
+    rng = random.Random(0)
+    assert {catalog.sample("work", rng=rng).id for _ in range(50)} == {"a", "b"}
+    assert {catalog.sample(difficulty="hard", rng=rng).id for _ in range(50)} == {
+        "b",
+        "c",
+    }
+    assert catalog.sample("family", "hard", rng=rng).id == "c"
+    with pytest.raises(LookupError):
+        catalog.sample("family", "easy")
+
+
+def test_balanced_sampling_evens_out_the_served_counts():
+    catalog = StarterCatalog([starter(str(index)) for index in range(4)])
+    rng = random.Random(0)
+    for _ in range(400):
+        catalog.sample(rng=rng)
+    counts = catalog.served_counts().values()
+    assert sum(counts) == 400
+    assert max(counts) - min(counts) <= 10
+
+
+def test_unbalanced_sampling_follows_the_weights():
+    catalog = StarterCatalog(
+        [starter("light", weight=1.0), starter("heavy", weight=4.0)],
+        balance_served=False,
+    )
+    rng = random.Random(0)
+    for _ in range(5000):
+        catalog.sample(rng=rng)
+    counts = catalog.served_counts()
+    assert counts["heavy"] / counts["light"] == pytest.approx(4.0, rel=0.15)
+
+
+def test_duplicate_ids_are_rejected():
+    with pytest.raises(ValueError):
+        StarterCatalog([starter("a"), starter("a")])
+
+
+def test_lookup_by_id_and_context():
+    catalog = StarterCatalog([starter("a"), starter("b")])
+    assert catalog["b"].id == "b"
+    assert catalog.get("missing") is None
+    assert catalog.id_for_context("Context of a.") == "a"
+    assert catalog.id_for_context("Another context.") is None
+
+
+def test_the_shipped_catalog_loads():
+    catalog = get_starter_catalog()
+    assert len(catalog) > 0
+    assert all(item.initial_message_tokens > 0 for item in catalog)
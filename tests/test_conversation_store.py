@@ -0,0 +1,99 @@
+import asyncio
+
+import mongomock
+import pytest
+
+from classes import ConversationBuilder
+from conversation_starters import get_starter_catalog
+from conversation_store import (
+    ConversationConflict,
+    MemoryConversationStore,
+    MongoConversationStore,
+)
+
+
+def new_conversation():
+    return ConversationBuilder.build_from_starter(next(iter(get_starter_catalog())))
+
+
+@pytest.fixture(params=["memory", "mongo"])
+def store(request):
+    if request.param == "memory":
+        return MemoryConversationStore()
+    return MongoConversationStore(client=mongomock.MongoClient())
+
+
+def test_saved_conversation_is_loaded(store):
+    async def run():
+        conversation = new_conversation()
+        assert await store.save(conversation, 0) == 1
+        loaded, version = await store.load(conversation.conversation_id)
+        assert version == 1
+        assert loaded.to_dict() == conversation.to_dict()
+
+    asyncio.run(run())
+
+
+def test_stale_version_is_rejected(store):
+    async def run():
+        conversation = new_conversation()
+        await store.save(conversation, 0)
+        first, version = await store.load(conversation.conversation_id)
+        second, _ = await store.load(conversation.conversation_id)
+        first.add_message("From the first worker.")
+        assert await store.save(first, version) == version + 1
+        second.add_message("From the second worker.")
+        with pytest.raises(ConversationConflict):
+            await store.save(second, version)
+        with pytest.raises(ConversationConflict):
+            await store.save(new_conversation(), 1)
+        loaded, _ = await store.load(conversation.conversation_id)
+        assert loaded.messages[-1] == "From the first worker."
+
+    asyncio.run(run())
+
+
+def test_new_conversation_cannot_replace_a_saved_one(store):
+    async def run():
+        conversation = new_conversation()
+        await store.save(conversation, 0)
+        with pytest.raises(ConversationConflict):
+            await store.save(conversation, 0)
+
+    asyncio.run(run())
+
+
+def test_deleted_conversation_is_gone(store):
+    async def run():
+        conversation = new_conversation()
+        await store.save(conversation, 0)
+        await store.delete(conversation.conversation_id)
+        assert await store.load(conversation.conversation_id) is None
+        await store.delete(conversation.conversation_id)
+
+    asyncio.run(run())
+
+
+def test_memory_store_drops_the_least_recently_used():
+    async def run():
+        store = MemoryConversationStore(max_sessions=2)
+        conversations = [new_conversation() for _ in range(3)]
+        for conversation in conversations[:2]:
+            await store.save(conversation, 0)
+        await store.load(conversations[0].conversation_id)
+        await store.save(conversations[2], 0)
+        assert await store.load(conversations[1].conversation_id) is None
+        assert await store.load(conversations[0].conversation_id) is not None
+
+    asyncio.run(run())
+
+
+def test_memory_store_expires_idle_conversations():
+    async def run():
+        store = MemoryConversationStore(ttl=0.0)
+        conversation = new_conversation()
+        await store.save(conversation, 0)
+        await asyncio.sleep(0.01)
+        assert await store.load(conversation.conversation_id) is None
+
+    asyncio.run(run())
@@ -0,0 +1,56 @@
+import random
+
+import mongomock
+import pytest
+
+from experiments import Arm, Experiment
+from mongodb_manager import MongoPersistence
+
+
+def test_restore_sums_the_rewards_stored_per_arm():
+    persistence = MongoPersistence(client=mongomock.MongoClient())
+    persistence.conversations.insert_many(
+        [
+            {
+                "conversation": {
+                    "experiment": {"name": name, "arm": arm, "reward": reward}
+                }
+            }
+            for name, arm, reward in [
+                ("test", "a", 0.5),
+                ("test", "a", 1.0),
+                ("test", "b", None),
+                ("test", "gone", 1.0),
+                ("other", "b", 1.0),
+            ]
+        ]
+        + [{"conversation": {"experiment": None}}]
+    )
+    experiment = Experiment([Arm("a", "gpt-4", 0.5), Arm("b", "gpt-4", 0.9)], "test")
+    experiment.restore(persistence.experiment_results("test"))
+    persistence.close()
+    stats = {arm["id"]: arm for arm in experiment.stats()}
+    assert stats["a"]["conversations"] == 2
+    assert stats["a"]["mean_reward"] == pytest.approx(0.75)
+    assert stats["b"]["conversations"] == 0
+
+
+def test_assignments_drift_to_the_better_arm():
+    experiment = Experiment(
+        [Arm("good", "gpt-4", 0.5), Arm("bad", "gpt-4", 0.9)],
+        "test",
+        rng=random.Random(0),
+    )
+    experiment.restore(
+        [
+            {"arm": "good", "conversations": 50, "reward_sum": 45.0},
+            {"arm": "bad", "conversations": 50, "reward_sum": 5.0},
+        ]
+    )
+
+    class Conversation:
+        experiment = None
+        instructions_version = None
+
+    arms = [experiment.assign(Conversation()).id for _ in range(100)]
+    assert arms.count("good") > 90
@@ -0,0 +1,48 @@
+import mongomock
+import pytest
+
+from feature_extraction import extract_features, iter_chunks
+
+
+def document(messages, conversation_id="abc"):
+    return {
+        "conversation_id": conversation_id,
+        "starter_id": "starter",
+        "arm": None,
+        "messages": messages,
+    }
+
+
+def test_chunk_without_messages_has_no_turns():
+    assert extract_features([document([]), document([], "def")]).num_rows == 0
+
+
+def test_features_per_turn():
+    batch = extract_features(
+        [document(["How are you? Tired?", "I feel tired."]), document(["Hi."], "def")]
+    ).to_pydict()
+    assert batch["conversation_id"] == ["abc", "abc", "def"]
+    assert batch["turn"] == [0, 1, 0]
+    assert batch["speaker"] == ["CHATBOT", "USER", "CHATBOT"]
+    assert batch["questions"] == [2, 0, 0]
+    assert batch["reflection_overlap"][1] == pytest.approx(1 / 3)
+
+
+def test_chunks_use_the_conversation_id():
+    collection = mongomock.MongoClient().db.conversations
+    collection.insert_many(
+        [
+            {
+                "conversation": {
+                    "finished": True,
+                    "conversation_id": "abc",
+                    "messages": [],
+                }
+            },
+            {"conversation": {"finished": True, "messages": []}},
+            {"conversation": {"finished": False, "conversation_id": "ghi"}},
+        ]
+    )
+    (chunk,) = iter_chunks(collection, chunk_size=10)
+    assert chunk[0]["conversation_id"] == "abc"
+    assert chunk[1]["conversation_id"] == str(collection.find_one({}, skip=1)["_id"])
@@ -0,0 +1,208 @@
+import time
+from datetime import datetime, timedelta
+
+import mongomock
+import pytest
+from pymongo.errors import BulkWriteError
+
+from classes import ConversationBuilder
+from conversation_starters import get_starter_catalog
+from instrumentation import metrics
+from mongodb_manager import MongoPersistence
+
+
+@pytest.fixture
+def persistence():
+    persistence = MongoPersistence(
+        client=mongomock.MongoClient(), flush_interval=60.0, write_backoff=0.0
+    )
+    yield persistence
+    persistence.close()
+
+
+def new_conversation():
+    return ConversationBuilder.build_from_starter(next(iter(get_starter_catalog())))
+
+
+def record_batches(persistence):
+    """Wraps insert_many and bulk_write to record the sizes of the written batches."""
+    batches = []
+    collection = persistence.conversations
+    for name in ("insert_many", "bulk_write"):
+        write = getattr(collection, name)
+
+        def recorded(items, *args, write=write, **kwargs):
+            batches.append(len(items))
+            return write(items, *args, **kwargs)
+
+        setattr(collection, name, recorded)
+    return batches
+
+
+def counter(name):
+    return sum(
+        counter["value"]
+        for counter in metrics.snapshot()["counters"]
+        if counter["name"] == name
+    )
+
+
+def test_flush_writes_the_queued_conversations(persistence):
+    conversations = [new_conversation() for _ in range(3)]
+    for conversation in conversations:
+        persistence.save_conversation(conversation)
+    persistence.flush()
+    saved = {
+        document["conversation"]["conversation_id"]
+        for document in persistence.conversations.find()
+    }
+    assert saved == {conversation.conversation_id for conversation in conversations}
+
+
+def test_update_follows_the_save_of_its_conversation(persistence):
+    conversation = new_conversation()
+    persistence.save_conversation(conversation)
+    persistence.update_conversation(
+        conversation.conversation_id, {"evaluation": "Good."}
+    )
+    persistence.flush()
+    document = persistence.conversations.find_one(
+        {"conversation.conversation_id": conversation.conversation_id}
+    )
+    assert document["conversation"]["evaluation"] == "Good."
+
+
+def test_batches_are_written_once_full():
+    persistence = MongoPersistence(
+        client=mongomock.MongoClient(), batch_size=2, flush_interval=60.0
+    )
+    batches = record_batches(persistence)
+    for _ in range(5):
+        persistence.save_conversation(new_conversation())
+    deadline = time.monotonic() + 5
+    while len(batches) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert batches == [2, 2]
+    persistence.close()
+    assert batches == [2, 2, 1]
+
+
+def test_batches_are_written_once_old_enough():
+    persistence = MongoPersistence(
+        client=mongomock.MongoClient(), batch_size=100, flush_interval=0.05
+    )
+    persistence.save_conversation(new_conversation())
+    deadline = time.monotonic() + 5
+    while not persistence.conversations.count_documents({}):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    persistence.close()
+
+
+def test_close_writes_the_rest_and_can_be_repeated(persistence):
+    persistence.save_conversation(new_conversation())
+    persistence.close()
+    persistence.close()
+    persistence.flush()
+    assert persistence.conversations.count_documents({}) == 1
+
+
+def test_failed_write_is_retried_without_duplicates(persistence):
+    insert_many = persistence.conversations.insert_many
+    attempts = []
+
+    def flaky(documents, ordered):
+        attempts.append(len(documents))
+        if len(attempts) == 1:
+            insert_many(documents[:1], ordered=ordered)
+            raise ConnectionError("The connection was reset.")
+        return insert_many(documents, ordered=ordered)
+
+    persistence.conversations.insert_many = flaky
+    for _ in range(3):
+        persistence.save_conversation(new_conversation())
+    retries = counter("mongo_write_retries")
+    persistence.flush()
+    assert attempts == [3, 3]
+    assert persistence.conversations.count_documents({}) == 3
+    assert counter("mongo_write_retries") == retries + 1
+
+
+def test_write_failing_every_attempt_is_counted(persistence):
+    def failing(documents, ordered):
+        # The last document is rejected, the others are written
+        if len(documents) > 1:
+            insert_many(documents[:-1], ordered=ordered)
+        index = len(documents) - 1
+        raise BulkWriteError(
+            {"writeErrors": [{"index": index, "code": 2, "errmsg": "Bad document."}]}
+        )
+
+    insert_many = persistence.conversations.insert_many
+    persistence.conversations.insert_many = failing
+    for _ in range(2):
+        persistence.save_conversation(new_conversation())
+    failures = counter("mongo_write_failures")
+    persistence.flush()
+    assert counter("mongo_write_failures") == failures + 1
+    assert persistence.conversations.count_documents({}) == 1
+
+
+def insert_saved(persistence, count, start=datetime(2024, 5, 1, 12)):
+    """Inserts conversations saved one hour apart, every two at the same time."""
+    documents = []
+    for index in range(count):
+        conversation = new_conversation().to_dict()
+        conversation["finished"] = index % 2 == 0
+        conversation["evaluation"] = "Good." if index % 3 == 0 else None
+        documents.append(
+            {
+                "conversation": conversation,
+                "timestamp": start + timedelta(hours=index // 2 * 13),
+            }
+        )
+    persistence.conversations.insert_many(documents)
+    return documents
+
+
+def test_pages_continue_after_the_last_document(persistence):
+    documents = insert_saved(persistence, 7)
+    ids = []
+    after = None
+    while True:
+        page = persistence.find_conversations(["starter_id"], 3, after)
+        ids.extend(document["_id"] for document in page["documents"])
+        after = page["next"]
+        if after is None:
+            break
+    expected = sorted(
+        documents, key=lambda document: (document["timestamp"], document["_id"])
+    )[::-1]
+    assert ids == [document["_id"] for document in expected]
+    assert ids == [
+        document["_id"] for document in persistence.iter_conversations(page_size=2)
+    ]
+
+
+def test_pages_hold_only_the_requested_fields(persistence):
+    insert_saved(persistence, 1)
+    (document,) = persistence.find_conversations(["finished"])["documents"]
+    assert set(document) == {"_id", "timestamp", "conversation"}
+    assert document["conversation"] == {"finished": True}
+
+
+def test_filters_select_the_matching_conversations(persistence):
+    insert_saved(persistence, 6)
+    finished = persistence.find_conversations(finished=True)["documents"]
+    assert len(finished) == 3
+    assert all(document["conversation"]["finished"] for document in finished)
+    evaluated = persistence.find_conversations(evaluated=True)["documents"]
+    assert len(evaluated) == 2
+
+
+def test_daily_counts(persistence):
+    insert_saved(persistence, 6)
+    assert persistence.daily_counts() == [
+        {"day": "2024-05-01", "conversations": 2, "finished": 1, "evaluated": 1},
+        {"day": "2024-05-02", "conversations": 4, "finished": 2, "evaluated": 1},
+    ]
@@ -0,0 +1,57 @@
+import asyncio
+
+from classes import AsyncLLMAgent, ConversationBuilder, LLMAgent
+from conversation_starters import get_starter_catalog
+from llm_backends import FakeBackend
+from prompt_budget import PromptBudgetManager
+
+
+def long_conversation(messages=12, instructions_version="v1"):
+    conversation = ConversationBuilder.build_from_starter(
+        next(iter(get_starter_catalog()))
+    )
+    conversation.instructions_version = instructions_version
+    for index in range(messages):
+        conversation.add_message(f"Message {index}: " + "many words " * 40)
+    return conversation
+
+
+def test_static_prompt_follows_the_instructions_version():
+    budget = PromptBudgetManager(FakeBackend(latency_mean=0.0))
+    v0 = budget._prompt_tokens(long_conversation(instructions_version="v0"), "gpt-4")
+    v1 = budget._prompt_tokens(long_conversation(instructions_version="v1"), "gpt-4")
+    assert v0[0] != v1[0]
+    assert v0[1] == v1[1]
+
+
+def test_summary_is_sent_through_the_agent_and_counted():
+    backend = FakeBackend(latency_mean=0.0)
+    budget = PromptBudgetManager(backend, budget_tokens=500, keep_recent_messages=2)
+    sent = []
+
+    def complete(*args, **kwargs):
+        sent.append(args[1])
+        return backend.complete(*args, **kwargs)
+
+    conversation = long_conversation()
+    transcript = budget.compact_transcript(conversation, "gpt-4", complete)
+    assert sent == [budget.summary_model]
+    assert transcript.startswith("<SUMMARY OF EARLIER MESSAGES>")
+    assert conversation.summarized_messages == len(conversation.messages) - 2
+    assert conversation.prompt_tokens > 0
+
+
+def test_agents_summarize_through_their_own_requests():
+    backend = FakeBackend(latency_mean=0.0)
+    budget = PromptBudgetManager(backend, budget_tokens=500, keep_recent_messages=2)
+    conversation = long_conversation(11)
+    LLMAgent(backend, budget=budget).generate_response(conversation, "gpt-4", 0.5)
+    assert conversation.summary
+
+    async def run():
+        conversation = long_conversation(11)
+        async with AsyncLLMAgent(backend, budget=budget) as agent:
+            await agent.generate_response(conversation, "gpt-4", 0.5)
+        return conversation
+
+    assert asyncio.run(run()).summary
@@ -0,0 +1,90 @@
+import mongomock
+import pytest
+
+from rate_limiter import MongoQuotaStore, RateLimiter, TokenBucket, estimate_tokens
+
+
+def test_token_bucket_refills_up_to_its_capacity():
+    bucket = TokenBucket(10, 2.0)
+    bucket.consume(10, bucket.updated)
+    assert bucket.wait_time(4, bucket.updated) == pytest.approx(2.0)
+    assert bucket.wait_time(4, bucket.updated + 2.0) == 0.0
+    assert bucket.wait_time(1, bucket.updated + 100.0) == 0.0
+    assert bucket.level == 10
+
+
+def test_token_bucket_cannot_hold_more_than_its_capacity():
+    bucket = TokenBucket(10, 2.0)
+    assert bucket.wait_time(11, bucket.updated) == float("inf")
+
+
+def test_token_bucket_may_be_overdrawn():
+    bucket = TokenBucket(10, 1.0)
+    bucket.consume(15, bucket.updated)
+    assert bucket.level == -5
+    assert bucket.wait_time(1, bucket.updated) == pytest.approx(6.0)
+
+
+def limiter(**kwargs):
+    settings = {
+        "calls_per_day": 100,
+        "calls_per_minute": 100,
+        "tokens_per_day": 10_000,
+        "user_calls_per_day": 3,
+        "user_tokens_per_day": 1000,
+        "max_wait": 0.0,
+    }
+    return RateLimiter(**{**settings, **kwargs})
+
+
+def test_user_call_budget():
+    rate_limiter = limiter()
+    assert all(rate_limiter.acquire("alice") for _ in range(3))
+    assert not rate_limiter.acquire("alice")
+    assert rate_limiter.acquire("bob")
+
+
+def test_user_token_budget_is_settled_with_the_usage():
+    rate_limiter = limiter(user_calls_per_day=100)
+    assert rate_limiter.acquire("alice", 900)
+    assert not rate_limiter.acquire("alice", 200)
+    rate_limiter.record_tokens("alice", -500)
+    assert rate_limiter.acquire("alice", 200)
+
+
+def test_release_refunds_the_reservation():
+    rate_limiter = limiter(user_calls_per_day=1)
+    assert rate_limiter.acquire("alice", 1000)
+    rate_limiter.release("alice", 1000)
+    assert rate_limiter.acquire("alice", 1000)
+
+
+def test_burst_budget_is_not_waited_for_beyond_the_timeout():
+    rate_limiter = limiter(calls_per_minute=1, max_wait=0.0)
+    assert rate_limiter.acquire("alice")
+    assert not rate_limiter.acquire("bob")
+    # The next call is a minute away
+    assert not rate_limiter.acquire("bob", timeout=1.0)
+
+
+def test_idle_users_are_forgotten():
+    rate_limiter = limiter(max_tracked_users=2)
+    for user_id in ("alice", "bob", "carol"):
+        rate_limiter.acquire(user_id)
+    assert len(rate_limiter._users) == 2
+
+
+def test_shared_budgets_are_enforced_across_limiters():
+    collection = mongomock.MongoClient().db.quota
+    first = limiter(store=MongoQuotaStore(collection))
+    second = limiter(store=MongoQuotaStore(collection))
+    assert first.acquire("alice")
+    assert first.acquire("alice")
+    assert second.acquire("alice")
+    assert not second.acquire("alice")
+
+
+def test_estimate_tokens_grows_with_the_prompt():
+    short = estimate_tokens([{"role": "user", "content": "Hi."}])
+    long = estimate_tokens([{"role": "user", "content": "Hi. " * 1000}])
+    assert long - short >= 900
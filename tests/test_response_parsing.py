@@ -0,0 +1,66 @@
+import json
+
+import pytest
+
+from response_parsing import (
+    AgentResponseStreamParser,
+    build_repair_messages,
+    extract_agent_response,
+    parse_agent_response,
+    response_format_for,
+)
+
+
+def test_valid_json_is_parsed():
+    text = json.dumps({"agent_response": 'She said "hi" é'})
+    assert parse_agent_response(text) == ('She said "hi" é', "json")
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ('Sure! {"agent_response": "I feel lost."} Hope that helps.', "I feel lost."),
+        ("{'agent_response': 'It's hard, isn't it?'}", "It's hard, isn't it?"),
+        ('{"agent_response": "First line\nsecond line"}', "First line\nsecond line"),
+        ('{"agent_response": "Cut off in the mid', "Cut off in the mid"),
+        ('Reply: {"agent_response": "A \\"quote\\" and \\u00e9"}', 'A "quote" and é'),
+        ('Reply: {"agent_response": "\\ud83d\\ude00"}', "\U0001f600"),
+    ],
+)
+def test_near_json_is_extracted(text, expected):
+    assert parse_agent_response(text) == (expected, "extracted")
+
+
+@pytest.mark.parametrize("text", ["Just a plain reply.", "", None])
+def test_output_without_agent_response_is_unparsed(text):
+    assert parse_agent_response(text) == (None, "unparsed")
+    assert extract_agent_response(text or "") is None
+
+
+def test_stream_parser_decodes_the_value_across_chunks():
+    text = json.dumps({"agent_response": 'He said "no" é\U0001f600\nOK'})
+    parser = AgentResponseStreamParser()
+    decoded = "".join(
+        parser.feed(text[index : index + 3]) for index in range(0, len(text), 3)
+    )
+    assert parser.started
+    assert parser.done
+    assert decoded == 'He said "no" é\U0001f600\nOK'
+    assert parser.feed("ignored") == ""
+
+
+def test_stream_parser_waits_for_the_value():
+    parser = AgentResponseStreamParser()
+    assert parser.feed('{"agent_') == ""
+    assert not parser.started
+    assert parser.feed('response": "Hi') == "Hi"
+
+
+def test_repair_messages_hold_the_cut_output():
+    (message,) = build_repair_messages("x" * 100, 10)
+    assert "x" * 10 in message["content"]
+    assert "x" * 11 not in message["content"]
+
+
+def test_response_format_for_unknown_model():
+    assert response_format_for("some-other-model") is None